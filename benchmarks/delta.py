@@ -0,0 +1,128 @@
+"""
+Storage ratio and read cost of delta encoded backlogs.
+
+Saves a backlog of large, slowly changing payloads (a couple of fields
+change per save) with delta encoding off and with each keyframe interval,
+then reads records at random and whole backlogs, ex:
+
+    python benchmarks/delta.py --depth 1000 --intervals 8,32,128
+
+Interval 0 means delta encoding off. Results are printed as JSON.
+"""
+
+
+import argparse
+import json
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+
+from gcd import (
+    Packet,
+    StorageAPI
+)
+
+
+KEY = 'bench.delta'
+
+
+def payloads(depth, fields):
+    payload = {
+        'field{}'.format(x): {'value': x, 'text': 'x' * 64}
+        for x in range(fields)
+    }
+    rand = random.Random(0)
+    for seq in range(depth):
+        payload = dict(payload, seq=seq)
+        name = 'field{}'.format(rand.randrange(fields))
+        payload[name] = dict(payload[name], value=rand.random())
+        yield payload
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def run(interval, depth, fields, reads):
+    datadir = tempfile.mkdtemp()
+    # Saves diff against the cached latest packet, reads below don't go
+    # through the cache
+    storage = StorageAPI(datadir,
+                         delta={'bench': interval} if interval else None)
+    try:
+        start = time.perf_counter()
+        for payload in payloads(depth, fields):
+            storage.save(Packet(KEY, payload))
+        save = (time.perf_counter() - start) / depth
+
+        stored = sum(len(storage.db[storage._record_key(KEY, idx)])
+                     for idx in range(depth))
+
+        rand = random.Random(1)
+        latencies = []
+        for _ in range(reads):
+            cursor = rand.randrange(depth)
+            start = time.perf_counter()
+            storage.page(KEY, cursor=cursor, limit=1)
+            latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        storage.backlog(KEY, end=depth)
+        backlog = time.perf_counter() - start
+
+        return {
+            'interval': interval,
+            'stored_bytes': stored,
+            'save': save,
+            'random_read_p50': median(latencies),
+            'random_read_max': max(latencies),
+            'backlog_per_record': backlog / depth
+        }
+    finally:
+        storage.close()
+        shutil.rmtree(datadir)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--depth', type=int, default=1000)
+    parser.add_argument('--fields', type=int, default=50,
+                        help="Fields of the payload dict")
+    parser.add_argument('--intervals', default='8,32,128')
+    parser.add_argument('--reads', type=int, default=200,
+                        help="Random record reads per interval")
+
+    args = parser.parse_args()
+    intervals = [0] + [int(x) for x in args.intervals.split(',')]
+
+    results = []
+    for interval in intervals:
+        result = run(interval, args.depth, args.fields, args.reads)
+        result['ratio'] = result['stored_bytes'] / (
+            results[0]['stored_bytes'] if results else
+            result['stored_bytes'])
+        results.append(result)
+        print("interval={interval:<5} stored={stored_bytes:<10} "
+              "ratio={ratio:.3f} save={save:.6f}s "
+              "read p50={random_read_p50:.6f}s max={random_read_max:.6f}s "
+              "backlog={backlog_per_record:.6f}s/record".format(**result),
+              file=sys.stderr)
+
+    print(json.dumps({
+        'meta': {
+            'python': platform.python_version(),
+            'depth': args.depth,
+            'fields': args.fields
+        },
+        'results': results
+    }, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Per-packet cost of building, validating and (de)serializing packets.
+
+    python benchmarks/packet.py [-n NUMBER]
+"""
+
+
+import argparse
+import datetime
+import timeit
+
+
+from gcd import Packet, record
+
+
+def bench(name, fn, number):
+    elapsed = min(timeit.repeat(fn, number=number, repeat=3))
+    print("{:<32} {:>8.2f} us/packet".format(name, elapsed / number * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=100000)
+    args = parser.parse_args()
+
+    payload = {'code': 0, 'text': 'ok', 'items': list(range(10))}
+    timestamp = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+    packet = Packet('ci.build.linux', payload, timestamp=timestamp)
+    iso = packet.asdict()
+    epoch = packet.asdict(epoch=True)
+    buff = record.encode(packet)
+
+    bench("Packet()", lambda: Packet('ci.build.linux', payload,
+                                     timestamp=timestamp),
+          args.number)
+    bench("Packet(trusted=True)", lambda: Packet('ci.build.linux', payload,
+                                                 timestamp=timestamp,
+                                                 trusted=True),
+          args.number)
+    bench("Packet.asdict()", packet.asdict, args.number)
+    bench("Packet.asdict(epoch=True)", lambda: packet.asdict(epoch=True),
+          args.number)
+    bench("Packet.fromdict(iso)", lambda: Packet.fromdict(iso), args.number)
+    bench("Packet.fromdict(epoch)", lambda: Packet.fromdict(epoch),
+          args.number)
+    bench("record.encode()", lambda: record.encode(packet), args.number)
+    bench("record.decode()", lambda: record.decode(buff), args.number)
+    bench("record.decode_header()", lambda: record.decode_header(buff),
+          args.number)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+"""
+Throughput and latency of storage operations.
+
+Runs save, get, backlog, list and attachment operations against each
+backend for every combination of the swept parameters and prints the
+results as JSON, ex:
+
+    python benchmarks/storage.py --keys 10,1000 --depth 1,1000 \\
+        --concurrency 1,8 --output bench.json
+
+attachment stores new contents on every operation, attachment_dedup the
+same ones every time.
+
+Results can be checked against a previous run, the exit status is 1 if any
+p50 latency got worse by more than the tolerance:
+
+    python benchmarks/storage.py --compare old.json --tolerance 0.25
+"""
+
+
+import argparse
+import concurrent.futures
+import io
+import itertools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+
+from gcd import (
+    Client,
+    Packet,
+    StorageAPI,
+    StorageServer
+)
+
+
+OPERATIONS = ['save', 'get', 'backlog', 'list', 'attachment',
+              'attachment_dedup']
+
+
+class DBMBackend:
+    name = 'dbm'
+    operations = OPERATIONS
+
+    def __init__(self):
+        self.datadir = tempfile.mkdtemp()
+        # Without a read cache get measures reads, not cache hits
+        self.storage = StorageAPI(self.datadir, cache_size=0)
+
+    def save(self, key, payload):
+        self.storage.save(Packet(key, payload))
+
+    def get(self, key):
+        self.storage.get(key)
+
+    def backlog(self, key):
+        self.storage.backlog(key)
+
+    def list(self, namespace):
+        self.storage.list(namespace)
+
+    def attachment(self, key, data):
+        packet = self.storage.save(
+            Packet(key, None, attachments={'data': io.BytesIO(data)}))
+        self.storage.read(packet.attachments['data'])
+
+    def close(self):
+        self.storage.close()
+        shutil.rmtree(self.datadir)
+
+
+class InProcessClient(Client):
+    """
+    Client talking to a StorageServer through WSGI calls, no sockets
+    """
+    def __init__(self, app):
+        super().__init__()
+        self.app = app
+
+    def get_session(self):
+        from apistar.test import TestClient
+        return TestClient(self.app)
+
+    def request(self, method, path, *args, **kwargs):
+        return self.session.request(method, '/' + path, **kwargs)
+
+
+class HTTPBackend(DBMBackend):
+    """
+    StorageServer and Client round trips. Against an in-process server
+    unless --uri is given, in which case the server's storage is used as
+    is.
+    """
+    name = 'http'
+
+    def __init__(self, uri=None):
+        if uri:
+            self.datadir = None
+            self.client = Client(uri)
+        else:
+            super().__init__()
+            self.client = InProcessClient(StorageServer(self.storage))
+
+    def save(self, key, payload):
+        self.client.save(key, payload)
+
+    def get(self, key):
+        self.client.get(key)
+
+    def backlog(self, key):
+        self.client.page(key)
+
+    def list(self, namespace):
+        self.client.children(namespace)
+
+    def attachment(self, key, data):
+        # Client.save_many drops attachment URLs, post the batch directly
+        files = {
+            'packets': json.dumps([{'key': key, 'payload': None}]),
+            'attachment:0:data': io.BytesIO(data)
+        }
+        (saved,) = self.client.check(
+            self.client.request('POST', 'packets', files=files))
+        resp = self.client.request(
+            'GET', saved['attachments']['data'].lstrip('/'))
+        resp.raise_for_status()
+
+    def close(self):
+        if self.datadir:
+            super().close()
+
+
+class SABackend:
+    """
+    SQLAlchemy backend over a SQLite file. It has no namespaces nor
+    attachments, only save, get and backlog are measured.
+    """
+    name = 'sa'
+    operations = ['save', 'get', 'backlog']
+
+    def __init__(self):
+        from gcd.backends import sa
+
+        self.datadir = tempfile.mkdtemp()
+        self.storage = sa.Storage('sqlite:///' + self.datadir + '/db.sqlite')
+
+    def save(self, key, payload):
+        self.storage.save(Packet(key, payload))
+
+    def get(self, key):
+        self.storage.get(key)
+
+    def backlog(self, key):
+        self.storage.page(key)
+
+    def close(self):
+        self.storage.close()
+        shutil.rmtree(self.datadir)
+
+
+BACKENDS = {
+    'dbm': DBMBackend,
+    'http': HTTPBackend
+}
+
+try:
+    import gcd.backends.sa  # noqa
+    BACKENDS['sa'] = SABackend
+except ImportError:
+    pass
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[idx]
+
+
+def measure(fn, args, concurrency):
+    def timed(arg):
+        start = time.perf_counter()
+        fn(*arg)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    if concurrency == 1:
+        latencies = [timed(x) for x in args]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+            latencies = list(pool.map(timed, args))
+    elapsed = time.perf_counter() - start
+
+    return {
+        'ops': len(latencies),
+        'throughput': len(latencies) / elapsed,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99)
+    }
+
+
+def run(backend, keys, depth, payload_size, concurrency, ops):
+    names = ['bench.k{}'.format(x) for x in range(keys)]
+    payload = {'data': 'x' * payload_size}
+    # Distinct contents, the same ones would only be stored once
+    blobs = [os.urandom(payload_size) for _ in range(ops)]
+
+    for (key, _) in itertools.product(names, range(depth)):
+        backend.save(key, payload)
+
+    # Cycle over the keys so every run touches as many of them as possible
+    targets = [names[x % keys] for x in range(ops)]
+    calls = {
+        'save': (backend.save, [(x, payload) for x in targets]),
+        'get': (backend.get, [(x,) for x in targets]),
+        'backlog': (backend.backlog, [(x,) for x in targets]),
+        'list': (getattr(backend, 'list', None), [('bench',)] * ops),
+        'attachment': (getattr(backend, 'attachment', None),
+                       list(zip(targets, blobs))),
+        'attachment_dedup': (getattr(backend, 'attachment', None),
+                             [(x, blobs[0]) for x in targets])
+    }
+
+    for op in backend.operations:
+        (fn, args) = calls[op]
+        yield (op, measure(fn, args, concurrency))
+
+
+def compare(results, baseline, tolerance):
+    def index(data):
+        return {
+            (x['backend'], x['keys'], x['depth'], x['payload_size'],
+             x['concurrency'], x['op']): x
+            for x in data['results']
+        }
+
+    regressions = []
+    old = index(baseline)
+    for (case, result) in index(results).items():
+        if case in old and result['p50'] > old[case]['p50'] * (1 + tolerance):
+            regressions.append((case, old[case]['p50'], result['p50']))
+
+    return regressions
+
+
+def main():
+    def ints(value):
+        return [int(x) for x in value.split(',')]
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--backends', default=','.join(sorted(BACKENDS)),
+                        help="Available: " + ', '.join(sorted(BACKENDS)))
+    parser.add_argument('--keys', type=ints, default=[100])
+    parser.add_argument('--depth', type=ints, default=[1, 100])
+    parser.add_argument('--payload-size', type=ints, default=[100])
+    parser.add_argument('--concurrency', type=ints, default=[1])
+    parser.add_argument('--ops', type=int, default=200,
+                        help="Measured operations per case")
+    parser.add_argument('--uri', help="Run the http backend against a "
+                                      "running server")
+    parser.add_argument('--output', help="Write JSON results to a file")
+    parser.add_argument('--compare', help="Baseline JSON results")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+
+    args = parser.parse_args()
+
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        },
+        'results': []
+    }
+
+    cases = itertools.product(
+        args.backends.split(','), args.keys, args.depth, args.payload_size,
+        args.concurrency)
+    for (name, keys, depth, payload_size, concurrency) in cases:
+        if name not in BACKENDS:
+            parser.error("backend {} is not available".format(name))
+
+        if name == 'http' and args.uri:
+            backend = HTTPBackend(args.uri)
+        else:
+            backend = BACKENDS[name]()
+
+        try:
+            for (op, stats) in run(backend, keys, depth, payload_size,
+                                   concurrency, args.ops):
+                stats.update({
+                    'backend': name,
+                    'keys': keys,
+                    'depth': depth,
+                    'payload_size': payload_size,
+                    'concurrency': concurrency,
+                    'op': op
+                })
+                results['results'].append(stats)
+                print("{backend:<5} keys={keys:<6} depth={depth:<6} "
+                      "payload={payload_size:<6} conc={concurrency:<3} "
+                      "{op:<10} {throughput:>10.1f} ops/s "
+                      "p50={p50:.6f}s p99={p99:.6f}s".format(**stats),
+                      file=sys.stderr)
+        finally:
+            backend.close()
+
+    dump = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(dump)
+    else:
+        print(dump)
+
+    if args.compare:
+        with open(args.compare) as fh:
+            regressions = compare(results, json.load(fh), args.tolerance)
+
+        for (case, old, new) in regressions:
+            print("REGRESSION {}: p50 {:.6f}s -> {:.6f}s".format(
+                case, old, new), file=sys.stderr)
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
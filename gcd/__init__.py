@@ -1,14 +1,18 @@
+from .events import Event
 from .packet import Packet
 from .storage import (
 	StorageAPI,
 	StorageServer
 )
 from .client import (
+	AsyncClient,
 	Client
 )
 
 __all__ = [
+	'AsyncClient',
 	'Client',
+	'Event',
 	'Packet',
 	'StorageAPI',
 	'StorageServer'
@@ -0,0 +1,3 @@
+"""
+Storage backends other than the dbm based gcd.storage.StorageAPI
+"""
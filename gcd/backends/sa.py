@@ -0,0 +1,355 @@
+import atexit
+import json
+import logging
+import threading
+import time
+
+
+import sqlalchemy
+from sqlalchemy import (
+    event,
+    orm,
+    Column,
+    PrimaryKeyConstraint,
+    BLOB,
+    Integer,
+    String,
+    TIMESTAMP
+)
+from sqlalchemy.ext import declarative
+from sqlalchemy.pool import QueuePool, StaticPool
+
+
+from gcd import Packet
+
+
+_logger = logging.getLogger(__name__)
+
+
+Base = declarative.declarative_base()
+Base.metadata.naming_convention = {
+    "ix": 'ix_%(column_0_label)s',
+    "uq": "uq_%(table_name)s_%(column_0_name)s",
+    "ck": "ck_%(table_name)s_%(constraint_name)s",
+    "fk": "fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s",
+    "pk": "pk_%(table_name)s"
+}
+
+
+# Set once on file based SQLite databases, it is kept in the file. WAL lets
+# readers go on while a write is in progress.
+SQLITE_JOURNAL = "PRAGMA journal_mode=WAL"
+
+# Applied to every connection to file based SQLite databases. With
+# synchronous=NORMAL commits don't fsync (a power loss may lose the last
+# transactions but not corrupt the database).
+SQLITE_TUNING = [
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY"
+]
+
+
+class NativePacket(Base):
+    __tablename__ = 'packet'
+    __table_args__ = (
+        PrimaryKeyConstraint('tag', 'timestamp'),
+    )
+
+    tag = Column(String(256), nullable=False)
+    value = Column(BLOB, nullable=True)
+    timestamp = Column(TIMESTAMP, nullable=False)
+
+
+class Flusher(threading.Thread):
+    """
+    Periodically inserts the packets pending in a Storage, so saves made
+    before a quiet period don't wait for the next one
+    """
+    def __init__(self, storage, interval):
+        super().__init__(daemon=True)
+        self.storage = storage
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.storage.flush()
+            except Exception:
+                _logger.exception("Flushing pending packets failed")
+
+    def stop(self):
+        self._stopped.set()
+
+
+class Storage:
+    def __init__(self, dburi, batch_size=1, batch_interval=None,
+                 tuned=True, read_pool_size=5):
+        # Saved packets are queued and inserted with a single statement and
+        # commit once batch_size of them are pending, or at most
+        # batch_interval seconds after being saved. Reads, close() and the
+        # interpreter's exit flush the queue first.
+        #
+        # Writes go through a per thread session, get() and log() use a
+        # separate pool of read only connections.
+        (self.db, self.reader) = self._create_session(
+            dburi, tuned=tuned, read_pool_size=read_pool_size)
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self._lock = threading.Lock()
+        self._pending = []
+        self._pending_since = None
+
+        self._flusher = None
+        if batch_size > 1:
+            atexit.register(self.flush)
+            if batch_interval is not None:
+                self._flusher = Flusher(self, batch_interval)
+                self._flusher.start()
+
+    def save(self, packet):
+        self.save_many([packet])
+
+    def save_many(self, packets):
+        own = [self._gcd_to_row(x) for x in packets]
+
+        with self._lock:
+            if not self._pending:
+                self._pending_since = time.monotonic()
+
+            self._pending.extend(own)
+
+            expired = (
+                self.batch_interval is not None and
+                time.monotonic() - self._pending_since >= self.batch_interval)
+            if len(self._pending) < self.batch_size and not expired:
+                return
+
+            (rows, self._pending) = (self._pending, [])
+            self._pending_since = None
+
+        self._insert(rows, own)
+
+    def flush(self):
+        with self._lock:
+            (rows, self._pending) = (self._pending, [])
+            self._pending_since = None
+
+        if rows:
+            self._insert(rows)
+
+    def _insert(self, rows, own=()):
+        """
+        Inserts rows with a single statement, or one by one if that fails
+        so a bad row, ex: a duplicated (tag, timestamp), doesn't take the
+        others with it. Rows failing on their own are dropped: the first
+        error among own, the rows of the caller, is raised, the others are
+        logged as whoever saved them is gone.
+        """
+        try:
+            self._execute(rows)
+            return
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            failed = [(rows[0], e)] if len(rows) == 1 else None
+
+        if failed is None:
+            failed = []
+            for row in rows:
+                try:
+                    self._execute([row])
+                except sqlalchemy.exc.SQLAlchemyError as e:
+                    failed.append((row, e))
+
+        own = set(id(x) for x in own)
+        errors = []
+        for (row, error) in failed:
+            if id(row) in own:
+                errors.append(error)
+            else:
+                _logger.error("Dropped packet %s at %s: %s",
+                              row['tag'], row['timestamp'], error)
+
+        if errors:
+            raise errors[0]
+
+    def _execute(self, rows):
+        try:
+            self.db.execute(NativePacket.__table__.insert(), rows)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+
+    def close(self):
+        if self._flusher is not None:
+            self._flusher.stop()
+            self._flusher.join()
+
+        atexit.unregister(self.flush)
+        self.flush()
+        self.db.remove()
+        self.reader.dispose()
+
+    def _read(self, qs):
+        with self.reader.connect() as conn:
+            return conn.execute(qs).fetchall()
+
+    def get(self, tag):
+        self.flush()
+
+        rows = self._read(self._select_for_tag(tag).limit(1))
+        row = rows[0] if rows else None
+        if row is None:
+            raise KeyError(tag)
+
+        return self._native_to_gcd(row)
+
+    def page(self, tag, before=None, limit=100, since=None):
+        """
+        Returns up to limit packets of tag older than the before timestamp,
+        and not older than since, newest first, and the before value for the
+        next page or None if there are no more packets.
+
+        Pages are seeks on the (tag, timestamp) primary key, their cost
+        doesn't depend on how deep in the log they are.
+        """
+        self.flush()
+
+        qs = self._select_for_tag(tag)
+        if before is not None:
+            qs = qs.where(NativePacket.__table__.c.timestamp < before)
+        if since is not None:
+            qs = qs.where(NativePacket.__table__.c.timestamp >= since)
+
+        rows = self._read(qs.limit(limit))
+        cursor = rows[-1].timestamp if len(rows) == limit else None
+
+        return ([self._native_to_gcd(x) for x in rows], cursor)
+
+    def log(self, tag, page_size=100, since=None, until=None):
+        # An empty time range isn't an error, the tag may have packets
+        # outside of it
+        (packets, cursor) = self.page(tag, before=until, limit=page_size,
+                                      since=since)
+        if not packets and since is None and until is None:
+            raise KeyError(tag)
+
+        while True:
+            yield from packets
+
+            if cursor is None:
+                break
+
+            (packets, cursor) = self.page(tag, before=cursor,
+                                          limit=page_size, since=since)
+
+    def prune(self, tag, policy, now=None):
+        self.flush()
+
+        qs = self._query_set_for_tag(tag)
+        qs = qs.with_entities(
+            NativePacket.timestamp,
+            sqlalchemy.func.coalesce(
+                sqlalchemy.func.length(NativePacket.value), 0))
+        keep = policy.retained(qs, now=now)
+
+        oldest = qs.offset(keep - 1).first() if keep else None
+        if oldest is None:
+            return 0
+
+        count = self.db.query(NativePacket).filter(
+            NativePacket.tag == tag,
+            NativePacket.timestamp < oldest.timestamp
+        ).delete(synchronize_session=False)
+        self.db.commit()
+
+        return count
+
+    @staticmethod
+    def _select_for_tag(tag):
+        table = NativePacket.__table__
+        qs = sqlalchemy.select([table.c.tag, table.c.value, table.c.timestamp])
+        qs = qs.where(table.c.tag == tag)
+        qs = qs.order_by(table.c.timestamp.desc())
+        return qs
+
+    def _query_set_for_tag(self, tag):
+        qs = self.db.query(NativePacket)
+        qs = qs.filter(NativePacket.tag == tag)
+        qs = qs.order_by(NativePacket.timestamp.desc())
+        return qs
+
+    @classmethod
+    def _create_session(cls, uri='sqlite:///:memory:', echo=False,
+                        tuned=True, read_pool_size=5):
+        """
+        Returns a thread local session factory for writes and an engine for
+        reads.
+
+        For file based SQLite databases both engines pool their
+        connections, the read engine read only ones, and with tuned the
+        database is switched to WAL and both engines get SQLITE_TUNING.
+        """
+        is_sqlite = uri.startswith('sqlite://')
+        path = uri[len('sqlite:///'):] if is_sqlite else ''
+        is_file = bool(path) and path != ':memory:'
+
+        kwargs = {}
+        if is_sqlite:
+            # Pooled connections move between threads
+            kwargs['connect_args'] = {'check_same_thread': False}
+            # Every connection to :memory: would be a new database, file
+            # connections are kept instead of reconnecting on every save
+            kwargs['poolclass'] = QueuePool if is_file else StaticPool
+
+        engine = sqlalchemy.create_engine(uri, echo=echo, **kwargs)
+        if is_sqlite:
+            cls._set_pragmas(engine, tuned and is_file)
+
+        if tuned and is_file:
+            with engine.connect() as conn:
+                conn.execute(SQLITE_JOURNAL)
+
+        Base.metadata.create_all(engine)
+        sess = orm.scoped_session(orm.sessionmaker(bind=engine))
+
+        if not is_file:
+            return (sess, engine)
+
+        reader = sqlalchemy.create_engine(
+            'sqlite:///file:{}?mode=ro&uri=true'.format(path),
+            echo=echo, poolclass=QueuePool, pool_size=read_pool_size,
+            connect_args={'check_same_thread': False})
+        cls._set_pragmas(reader, tuned)
+
+        return (sess, reader)
+
+    @staticmethod
+    def _set_pragmas(engine, tuned):
+        @event.listens_for(engine, "connect")
+        def set_sqlite_pragma(conn, record):
+            cursor = conn.cursor()
+            cursor.execute("PRAGMA foreign_keys=ON")
+            if tuned:
+                for pragma in SQLITE_TUNING:
+                    cursor.execute(pragma)
+            cursor.close()
+
+    @staticmethod
+    def _gcd_to_row(packet):
+        return {
+            'tag': packet.key,
+            'value': json.dumps(packet.payload).encode('utf-8'),
+            'timestamp': packet.timestamp
+        }
+
+    @staticmethod
+    def _native_to_gcd(native):
+        return Packet(
+            native.tag,
+            json.loads(native.value.decode('utf-8')),
+            timestamp=native.timestamp,
+            trusted=True)
@@ -1,23 +1,54 @@
 from gcd import (
     Packet,
-    consts
+    consts,
+    utils
 )
+from gcd.packet import format_timestamp
 
 
+import asyncio
+import concurrent.futures
+import functools
 import json
+import threading
+import urllib.parse
 
 
 import requests
+import urllib3
 
 
 class APIError(Exception):
-    pass
+    def __init__(self, *args, status_code=None):
+        super().__init__(*args)
+        self.status_code = status_code
+
+
+def unsent(error):
+    """
+    Whether error proves the request never reached the server, requests
+    that failed otherwise may have been handled
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
 
 
 class Client:
-    def __init__(self, storage_uri=consts.DEFAULT_STORAGE_URI):
+    def __init__(self, storage_uri=consts.DEFAULT_STORAGE_URI,
+                 timeout=None, pool_size=10, cache_size=128):
         self._session = None
         self.storage_uri = storage_uri
+        self.timeout = timeout
+        self.pool_size = pool_size
+
+        # key -> (ETag, packet) of the last fetched packets, get()
+        # revalidates them instead of downloading them again. Cached
+        # packets are shared between callers, don't modify them.
+        self.cache = utils.LRUCache(cache_size)
+        self._cache_lock = threading.Lock()
 
     @property
     def session(self):
@@ -27,18 +58,47 @@ class Client:
         return self._session
 
     def get_session(self):
-        return request.Session()
+        session = requests.Session()
+
+        # Keep up to pool_size connections alive, one per concurrent caller
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        return session
 
     def request(self, method, path, *args, **kwargs):
-        path = consts.DEFAULT_STORAGE_URI + path
+        path = self.storage_uri + path
+        kwargs.setdefault('timeout', self.timeout)
         return self.session.request(method, path, *args, **kwargs)
 
-    def get(self, key):
-        resp = self.request('GET', key)
+    @staticmethod
+    def check(resp):
         if resp.status_code != 200:
-            raise APIError()
+            raise APIError(resp.reason, status_code=resp.status_code)
 
-        return Packet.fromdict(json.loads(resp.content.decode('utf-8')))
+        return json.loads(resp.content.decode('utf-8'))
+
+    def get(self, key):
+        with self._cache_lock:
+            cached = self.cache.get(key)
+
+        headers = {}
+        if cached is not None:
+            headers['If-None-Match'] = cached[0]
+
+        resp = self.request('GET', 'packet/' + key, headers=headers)
+        if resp.status_code == 304 and cached is not None:
+            return cached[1]
+
+        packet = Packet.fromdict(self.check(resp))
+        etag = resp.headers.get('ETag')
+        if etag:
+            with self._cache_lock:
+                self.cache.set(key, (etag, packet))
+
+        return packet
 
     def save(self, key, payload, attachments=None):
         kwargs = {}
@@ -52,11 +112,260 @@ class Client:
         else:
             kwargs['json'] = payload
 
-        resp = self.request('POST', key, **kwargs)
-        if resp.status_code != 200:
-            raise APIError()
+        resp = self.request('POST', 'packet/' + key, **kwargs)
+        return Packet.fromdict(self.check(resp))
+
+    def save_many(self, packets):
+        """
+        Saves a batch of packets in a single request.
+
+        Returns, for each packet, the saved packet or the APIError
+        describing why it wasn't saved.
+        """
+        items = [{'key': x.key, 'payload': x.payload} for x in packets]
+        files = {
+            'attachment:{}:{}'.format(idx, name): fh
+            for (idx, packet) in enumerate(packets)
+            for (name, fh) in packet.attachments.items()
+        }
+
+        if files:
+            files['packets'] = json.dumps(items)
+            resp = self.request('POST', 'packets', files=files)
+        else:
+            resp = self.request('POST', 'packets', json=items)
+
+        return [
+            APIError(item['error']) if 'error' in item
+            else Packet.fromdict(item)
+            for item in self.check(resp)
+        ]
+
+    def children(self, ns=''):
+        path = 'packet/' + ns + '/children' if ns else 'packets'
+        return self.check(self.request('GET', path))
+
+    def query(self, ns='', **params):
+        """
+        Latest packets of the keys below ns matching params, see gcd.query
+        """
+        path = 'packet/' + ns + '/query' if ns else 'query'
+        params = {name: json.dumps(value) for (name, value) in params.items()}
+        return [
+            Packet.fromdict(item)
+            for item in self.check(self.request('GET', path, params=params))
+        ]
+
+    def poll(self, ns='', cursor=None, timeout=30):
+        """
+        Waits up to timeout seconds for packets saved under ns after cursor,
+        returns them with the cursor for the next call and whether the
+        server dropped some changes before they could be seen.
+        """
+        path = 'packet/' + ns + '/watch' if ns else 'watch'
+        params = {'timeout': timeout}
+        if cursor is not None:
+            params['cursor'] = cursor
+
+        # Leave the server time to answer an empty long-poll
+        request_timeout = None if self.timeout is None else \
+            self.timeout + timeout
+        data = self.check(self.request('GET', path, params=params,
+                                       timeout=request_timeout))
+
+        packets = [Packet.fromdict(item) for item in data['packets']]
+        return (packets, data['cursor'], data['missed'])
+
+    def watch(self, ns='', cursor=None, timeout=30):
+        """
+        Iterates forever over packets saved under ns, a key or a namespace,
+        starting after cursor or from now on.
+        """
+        while True:
+            (packets, cursor, missed) = self.poll(ns, cursor=cursor,
+                                                  timeout=timeout)
+            yield from packets
+
+    def page(self, key, cursor=None, limit=100, since=None, until=None):
+        """
+        Fetches a page of key's backlog, returns the packets and the cursor
+        for the next page or None if this was the last one.
+
+        since and until restrict the backlog to packets saved in that time
+        range, since included.
+        """
+        params = {'limit': limit}
+        if cursor is not None:
+            params['cursor'] = cursor
+        if since is not None:
+            params['since'] = format_timestamp(since)
+        if until is not None:
+            params['until'] = format_timestamp(until)
+
+        resp = self.request('GET', 'packet/' + key + '/backlog',
+                            params=params)
+        packets = [
+            Packet.fromdict(dict(item, key=key))
+            for item in self.check(resp)
+        ]
+
+        link = resp.links.get('next')
+        if not link:
+            return (packets, None)
+
+        query = urllib.parse.urlparse(link['url']).query
+        return (packets, urllib.parse.parse_qs(query)['cursor'][0])
+
+    def backlog(self, key, limit=100, since=None, until=None):
+        """
+        Iterates over key's backlog, newest first, fetching pages of limit
+        packets as they are consumed.
+        """
+        cursor = None
+        while True:
+            (packets, cursor) = self.page(key, cursor=cursor, limit=limit,
+                                          since=since, until=until)
+            yield from packets
+
+            if cursor is None:
+                break
+
+
+class AsyncClient:
+    """
+    asyncio flavour of Client.
+
+    Requests run on a thread pool over a Client whose session keeps one
+    keep-alive connection per worker, at most `concurrency` of them are in
+    flight: requests given up on after `timeout` keep their slot until
+    their thread is done. Requests failing with connection errors,
+    timeouts or 5xx responses are retried `retries` times with exponential
+    backoff.
+
+    Saves may have been stored even if they failed that way, they are only
+    retried when the connection couldn't be established. Saves with
+    attachments are never retried, their files can't be rewound.
+    """
+    RETRY_ERRORS = (
+        asyncio.TimeoutError,
+        requests.ConnectionError,
+        requests.Timeout
+    )
+
+    def __init__(self, storage_uri=consts.DEFAULT_STORAGE_URI,
+                 concurrency=32, timeout=10, retries=3, backoff=0.1,
+                 client=None):
+        if client is None:
+            client = Client(storage_uri, timeout=timeout,
+                            pool_size=concurrency)
+
+        self.client = client
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency)
+        # Long-polls mostly wait, they get threads of their own so they
+        # never hold up other requests
+        self._poll_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency)
+        self._semaphore = None
+
+    async def _attempt(self, call):
+        # The semaphore binds to the running loop, build it on first use
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        await self._semaphore.acquire()
+        future = asyncio.get_event_loop().run_in_executor(self._executor,
+                                                          call)
+        # Free the slot once the thread is done, not once we stop waiting
+        # for it
+        future.add_done_callback(lambda _: self._semaphore.release())
+        return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+
+    async def _call(self, fn, *args, retry=True, idempotent=True, **kwargs):
+        call = functools.partial(fn, *args, **kwargs)
+
+        attempt = 0
+        while True:
+            try:
+                return await self._attempt(call)
+
+            except self.RETRY_ERRORS as e:
+                if not retry or attempt >= self.retries or \
+                   not (idempotent or unsent(e)):
+                    raise
+
+            except APIError as e:
+                if not retry or not idempotent or attempt >= self.retries \
+                   or e.status_code is None or e.status_code < 500:
+                    raise
+
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+            attempt = attempt + 1
+
+    async def get(self, key):
+        return await self._call(self.client.get, key)
+
+    async def save(self, key, payload, attachments=None):
+        return await self._call(self.client.save, key, payload,
+                                attachments=attachments,
+                                retry=not attachments, idempotent=False)
+
+    async def save_many(self, packets):
+        retry = not any(x.attachments for x in packets)
+        return await self._call(self.client.save_many, packets, retry=retry,
+                                idempotent=False)
+
+    async def children(self, ns=''):
+        return await self._call(self.client.children, ns)
+
+    async def query(self, ns='', **params):
+        return await self._call(self.client.query, ns, **params)
+
+    async def poll(self, ns='', cursor=None, timeout=30):
+        # Long-polls outlast the request timeout and don't take one of the
+        # concurrency slots
+        loop = asyncio.get_event_loop()
+        call = functools.partial(self.client.poll, ns, cursor=cursor,
+                                 timeout=timeout)
+        return await asyncio.wait_for(
+            loop.run_in_executor(self._poll_executor, call),
+            None if self.timeout is None else self.timeout + timeout)
+
+    async def watch(self, ns='', cursor=None, timeout=30):
+        while True:
+            (packets, cursor, missed) = await self.poll(ns, cursor=cursor,
+                                                        timeout=timeout)
+            for packet in packets:
+                yield packet
+
+    async def page(self, key, cursor=None, limit=100, since=None,
+                   until=None):
+        return await self._call(self.client.page, key, cursor=cursor,
+                                limit=limit, since=since, until=until)
+
+    async def backlog(self, key, limit=100, since=None, until=None):
+        """
+        Iterates over key's backlog, fetching pages as they are consumed
+        """
+        cursor = None
+        while True:
+            (packets, cursor) = await self.page(key, cursor=cursor,
+                                                limit=limit, since=since,
+                                                until=until)
+            for packet in packets:
+                yield packet
+
+            if cursor is None:
+                break
 
-        return Packet.fromdict(json.loads(resp.content.decode('utf-8')))
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self._poll_executor.shutdown(wait=False)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,252 @@
+"""
+Codecs for compressing stored payloads and attachments.
+
+Records name the codec of their payload in the header encoding field.
+Attachment files stored encoded start with a header of their own:
+
+    magic (4s) codec id (B) decoded size (Q)
+
+followed by the encoded contents. Attachments that happen to start with the
+magic are stored behind an identity header so the magic is never ambiguous.
+
+Codecs are looked up by name or id, register() adds more of them, ex:
+
+    register(Codec('zstd', 3, zstandard_open, content_encoding='zstd'))
+"""
+
+
+import gzip
+import io
+import lzma
+import struct
+
+
+MAGIC = b'GCDZ'
+
+_HEADER = struct.Struct('>4sBQ')
+HEADER_SIZE = _HEADER.size
+
+
+class Codec:
+    """
+    A codec is mostly open(fileobj, mode) returning a file object that
+    encodes on write and decodes on read. Closing it must leave fileobj
+    open, like gzip.GzipFile and lzma.LZMAFile do.
+
+    content_encoding is the HTTP Content-Encoding of the encoded stream,
+    None if clients can't be handed the stream as is.
+    """
+    def __init__(self, name, id, open, content_encoding=None):
+        # Records keep the high bit of their encoding for deltas
+        if not 0 < id < 128:
+            raise ValueError(id, "codec ids go from 1 to 127")
+
+        self.name = name
+        self.id = id
+        self.open = open
+        self.content_encoding = content_encoding
+
+    def compress(self, data):
+        buff = io.BytesIO()
+        with self.open(buff, 'wb') as fh:
+            fh.write(data)
+
+        return buff.getvalue()
+
+    def decompress(self, data):
+        with self.open(io.BytesIO(data), 'rb') as fh:
+            return fh.read()
+
+    def __repr__(self):
+        return '<Codec {}>'.format(self.name)
+
+
+class _Window(io.RawIOBase):
+    """
+    Contents of fileobj from offset on, positions relative to offset
+    """
+    def __init__(self, fileobj, offset):
+        self.fileobj = fileobj
+        self.offset = offset
+        fileobj.seek(offset)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def readinto(self, buff):
+        data = self.fileobj.read(len(buff))
+        buff[:len(data)] = data
+        return len(data)
+
+    def write(self, data):
+        return self.fileobj.write(data)
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = pos + self.offset
+
+        return self.fileobj.seek(pos, whence) - self.offset
+
+    def tell(self):
+        return self.fileobj.tell() - self.offset
+
+
+class _Identity(Codec):
+    def __init__(self):
+        self.name = 'identity'
+        self.id = 0
+        self.content_encoding = None
+
+    def open(self, fileobj, mode='rb'):
+        return _Window(fileobj, fileobj.tell())
+
+
+def _open_gzip(fileobj, mode='rb'):
+    # No timestamp, equal contents compress to equal bytes
+    return gzip.GzipFile(fileobj=fileobj, mode=mode, mtime=0)
+
+
+def _open_lzma(fileobj, mode='rb'):
+    return lzma.LZMAFile(fileobj, mode)
+
+
+IDENTITY = _Identity()
+
+_codecs = {}
+
+
+def register(codec):
+    if codec.id in _codecs and _codecs[codec.id].name != codec.name:
+        raise ValueError(codec.id, "codec id already taken")
+
+    _codecs[codec.id] = _codecs[codec.name] = codec
+
+
+def get(codec):
+    """
+    Returns the codec with the given name or id, raises KeyError
+    """
+    if codec == 0 or codec == IDENTITY.name:
+        return IDENTITY
+
+    return _codecs[codec]
+
+
+register(Codec('gzip', 1, _open_gzip, content_encoding='gzip'))
+register(Codec('lzma', 2, _open_lzma, content_encoding='xz'))
+# gzip is zlib's deflate in a framing HTTP clients understand
+_codecs['zlib'] = _codecs['gzip']
+
+
+class Rule:
+    """
+    How a namespace is compressed: contents smaller than threshold bytes
+    are stored as they are.
+    """
+    FIELDS = ('codec', 'threshold')
+
+    def __init__(self, codec, threshold=1024):
+        if threshold < 0:
+            raise ValueError(threshold, "threshold can't be negative")
+
+        self.codec = get(codec) if isinstance(codec, (str, int)) else codec
+        self.threshold = threshold
+
+    @classmethod
+    def fromstring(cls, s):
+        """
+        Builds a rule from a string like 'lzma' or 'codec=gzip,threshold=512'
+        """
+        kwargs = {}
+        for item in s.split(','):
+            (name, _, value) = item.rpartition('=')
+            name = name.strip() or 'codec'
+            try:
+                if name not in cls.FIELDS:
+                    raise KeyError(name)
+
+                kwargs[name] = int(value) if name == 'threshold' else \
+                    get(value.strip())
+            except (KeyError, ValueError) as e:
+                raise ValueError(item, "invalid compression setting") from e
+
+        if 'codec' not in kwargs:
+            raise ValueError(s, "compression needs a codec")
+
+        return cls(**kwargs)
+
+    def applies(self, size):
+        return size >= self.threshold
+
+    def __repr__(self):
+        return '<Rule codec={} threshold={}>'.format(self.codec.name,
+                                                     self.threshold)
+
+
+def header(codec, size):
+    return _HEADER.pack(MAGIC, codec.id, size)
+
+
+def read_header(fileobj):
+    """
+    Reads the header of an attachment file. Returns (codec, decoded size),
+    codec is None for attachments stored as they are, leaving fileobj at
+    the start of the contents either way.
+    """
+    start = fileobj.tell()
+    buff = fileobj.read(HEADER_SIZE)
+    if len(buff) < HEADER_SIZE or buff[:len(MAGIC)] != MAGIC:
+        fileobj.seek(start)
+        return (None, None)
+
+    (_, codec_id, size) = _HEADER.unpack(buff)
+    try:
+        return (get(codec_id), size)
+    except KeyError as e:
+        raise ValueError(codec_id, "unknown attachment codec") from e
+
+
+class DecodedFile(io.BufferedIOBase):
+    """
+    Read-only decoded view of an encoded attachment file, owning the file
+    """
+    def __init__(self, fileobj, codec):
+        self.fileobj = fileobj
+        self.codec = codec
+        self.stream = codec.open(fileobj, 'rb')
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def read1(self, size=-1):
+        return self.stream.read(size)
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        return self.stream.seek(pos, whence)
+
+    def tell(self):
+        return self.stream.tell()
+
+    def fileno(self):
+        raise io.UnsupportedOperation("decoded files have no descriptor")
+
+    def close(self):
+        if not self.closed:
+            try:
+                self.stream.close()
+            finally:
+                self.fileobj.close()
+
+        super().close()
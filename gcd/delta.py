@@ -0,0 +1,95 @@
+"""
+Structural diffs between JSON values.
+
+A patch is a JSON object turning one value into another:
+
+    {}                                  no change
+    {"=": value}                        replaces the value
+    {"-": [names], "~": {name: patch}}  removes and patches dict items
+    {"#": {"index": patch}}             patches items of a list
+    {"+": [items]}                      appends items to a list
+
+Values are compared as JSON: diff() expects values decoded from JSON, ex:
+no tuples nor int dict keys.
+"""
+
+
+def _equal(a, b):
+    # Unlike ==, 1, 1.0 and True differ
+    if type(a) is not type(b):
+        return False
+
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(_equal(a[k], b[k]) for k in a)
+
+    if isinstance(a, list):
+        return len(a) == len(b) and all(map(_equal, a, b))
+
+    return a == b
+
+
+def diff(old, new):
+    """
+    Returns the patch turning old into new
+    """
+    if _equal(old, new):
+        return {}
+
+    if isinstance(old, dict) and isinstance(new, dict):
+        changed = {}
+        for (name, value) in new.items():
+            if name not in old:
+                changed[name] = {'=': value}
+                continue
+
+            patch = diff(old[name], value)
+            if patch:
+                changed[name] = patch
+
+        removed = [name for name in old if name not in new]
+
+        patch = {}
+        if removed:
+            patch['-'] = removed
+        if changed:
+            patch['~'] = changed
+        return patch
+
+    if isinstance(old, list) and isinstance(new, list):
+        if len(new) > len(old) and _equal(old, new[:len(old)]):
+            return {'+': new[len(old):]}
+
+        if len(new) == len(old):
+            changed = {}
+            for (idx, (a, b)) in enumerate(zip(old, new)):
+                patch = diff(a, b)
+                if patch:
+                    changed[str(idx)] = patch
+
+            return {'#': changed}
+
+    return {'=': new}
+
+
+def apply(value, patch):
+    """
+    Returns value with patch applied. value is modified in place, pass a
+    copy if it is shared.
+    """
+    if '=' in patch:
+        return patch['=']
+
+    if '+' in patch:
+        value.extend(patch['+'])
+        return value
+
+    for (idx, item) in patch.get('#', {}).items():
+        value[int(idx)] = apply(value[int(idx)], item)
+
+    for name in patch.get('-', ()):
+        del value[name]
+
+    for (name, item) in patch.get('~', {}).items():
+        value[name] = apply(value.get(name), item)
+
+    return value
@@ -0,0 +1,73 @@
+import collections
+import enum
+import threading
+
+
+class Event(enum.Enum):
+    # callback(sender, packet, prev), prev is None for new keys
+    VALUE_CHANGED = 'value-changed'
+
+
+def matches(key, prefix):
+    """
+    Checks if key is prefix or lives in the prefix namespace
+    """
+    return not prefix or key == prefix or key.startswith(prefix + '.')
+
+
+class ChangeLog:
+    """
+    The latest saved packets numbered with an increasing sequence, so
+    watchers can ask for the changes after the last one they saw.
+
+    Only the last maxlen changes are kept, watchers falling further behind
+    are told they missed some.
+    """
+    def __init__(self, maxlen=1024):
+        self.seq = 0
+        self._changes = collections.deque(maxlen=maxlen)
+        self._cond = threading.Condition()
+
+    def append(self, packet):
+        with self._cond:
+            self.seq = self.seq + 1
+            self._changes.append((self.seq, packet))
+            self._cond.notify_all()
+
+    def since(self, cursor, prefix=''):
+        """
+        Returns the packets under prefix saved after cursor, the cursor to
+        continue from and whether changes were missed. A cursor ahead of
+        the log, ex: from before a restart, counts as missing changes.
+        """
+        with self._cond:
+            missed = False
+            if cursor > self.seq:
+                (cursor, missed) = (0, True)
+
+            oldest = self._changes[0][0] if self._changes else self.seq + 1
+            if cursor < oldest - 1:
+                missed = True
+
+            packets = [packet for (seq, packet) in self._changes
+                       if seq > cursor and matches(packet.key, prefix)]
+
+            return (packets, self.seq, missed)
+
+    def wait(self, cursor, prefix='', timeout=None):
+        """
+        Like since() but waits up to timeout seconds for a change under
+        prefix when there are none yet
+        """
+        def ready():
+            return self.seq > cursor and any(
+                matches(packet.key, prefix)
+                for (seq, packet) in reversed(self._changes) if seq > cursor)
+
+        with self._cond:
+            (packets, seq, missed) = self.since(cursor, prefix)
+            if packets or missed:
+                return (packets, seq, missed)
+
+            self._cond.wait_for(ready, timeout=timeout)
+            return self.since(cursor, prefix)
@@ -0,0 +1,146 @@
+"""
+In-process counters and latency histograms, rendered in the Prometheus text
+exposition format.
+
+Recording a sample is a dict update under a lock, cheap enough to leave
+instrumentation always on.
+"""
+
+
+import bisect
+import functools
+import threading
+import time
+
+
+# Upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # Last slot counts observations above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+    def cumulative(self):
+        total = 0
+        bounds = [repr(float(x)) for x in self.buckets] + ['+Inf']
+        for (bound, count) in zip(bounds, self.counts):
+            total = total + count
+            yield (bound, total)
+
+
+class Metrics:
+    """
+    Registry of labelled counters and histograms.
+
+    Collectors are callables returning (name, type, labels, value) samples
+    computed on render, for values already tracked elsewhere.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.collectors = []
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+
+            histogram.observe(value)
+
+    def counter(self, name, **labels):
+        return self._counters.get(self._key(name, labels), 0)
+
+    def histogram(self, name, **labels):
+        return self._histograms.get(self._key(name, labels))
+
+    def render(self):
+        samples = {}
+
+        with self._lock:
+            for ((name, labels), value) in self._counters.items():
+                samples.setdefault((name, 'counter'), []).append(
+                    (name, labels, value))
+
+            for ((name, labels), histogram) in self._histograms.items():
+                lines = samples.setdefault((name, 'histogram'), [])
+                for (bound, count) in histogram.cumulative():
+                    lines.append((name + '_bucket',
+                                  labels + (('le', bound),), count))
+
+                lines.append((name + '_sum', labels, histogram.sum))
+                lines.append((name + '_count', labels, histogram.count))
+
+        for collector in self.collectors:
+            for (name, type_, labels, value) in collector():
+                samples.setdefault((name, type_), []).append(
+                    (name, tuple(sorted(labels.items())), value))
+
+        out = []
+        for ((name, type_), lines) in sorted(samples.items()):
+            out.append('# TYPE {} {}'.format(name, type_))
+            out.extend('{}{} {}'.format(sample, _format_labels(labels), value)
+                       for (sample, labels, value) in lines)
+
+        return '\n'.join(out) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+
+    def escape(value):
+        return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+            '\n', r'\n')
+
+    return '{' + ','.join('{}="{}"'.format(name, escape(value))
+                          for (name, value) in labels) + '}'
+
+
+def instrument(op):
+    """
+    Decorates a method to time its calls into self.metrics, labelled with
+    op. Exceptions are counted by type and re-raised.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def _wrap(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(self, *args, **kwargs)
+            except Exception as e:
+                self.metrics.inc('gcd_storage_errors_total', op=op,
+                                 error=type(e).__name__)
+                raise
+            finally:
+                self.metrics.observe('gcd_storage_operation_seconds',
+                                     time.perf_counter() - start, op=op)
+
+        return _wrap
+
+    return decorator
@@ -0,0 +1,45 @@
+from gcd import StorageAPI
+from gcd import shards
+
+
+def main():
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(
+        description="Upgrade a storage datadir to the current format or "
+                    "change its sharding")
+    parser.add_argument('--storage', required=True)
+    parser.add_argument(
+        '--shards', type=int,
+        help="Rebalance the datadir over this number of shards, 1 for a "
+             "single file. The server must be stopped")
+    parser.add_argument('--shard-by', choices=shards.STRATEGIES,
+                        default='hash')
+    parser.add_argument(
+        '--collect', action='store_true',
+        help="Delete every attachment no record references. The server "
+             "must be stopped")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Only report what --collect would delete")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.shards:
+        count = shards.rebalance(args.storage, args.shards, args.shard_by)
+        print("{} entries moved to {} shards".format(count, args.shards))
+
+    storage = StorageAPI(args.storage)
+    count = storage.migrate()
+    print("{} records migrated".format(count))
+
+    if args.collect:
+        # No server running, nothing written recently is in flight
+        (count, size) = storage.collect(limit=None, grace=0,
+                                        dry_run=args.dry_run)
+        print("{} {} files, {} bytes".format(
+            "Would reclaim" if args.dry_run else "Reclaimed", count, size))
+
+
+if __name__ == '__main__':
+    main()
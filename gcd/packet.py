@@ -1,18 +1,93 @@
 import datetime
+import functools
 import io
 import re
 
 
+EPOCH = datetime.datetime(1970, 1, 1)
+
+_KEY_RE = re.compile(r'^[a-z0-9_\-\.]+$')
+_EPOCH_RE = re.compile(r'^\d+(\.\d*)?$')
+_TIMESTAMP_RE = re.compile(
+    r'^(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.(\d{1,6})\d*)?'
+    r'(Z|[+-]\d\d:?\d\d)?$')
+
+
+def format_timestamp(timestamp):
+    # Unlike str() it keeps the microseconds when they are zero
+    return timestamp.isoformat(sep=' ', timespec='microseconds')
+
+
+def parse_timestamp(value):
+    """
+    Parses timestamps from format_timestamp(), ISO 8601 strings with a 'T'
+    or ' ' separator, or seconds since the epoch, as numbers or strings.
+
+    Timestamps are naive UTC datetimes, ISO 8601 strings with a 'Z' or
+    '+HH:MM' offset are converted to UTC.
+    """
+    if isinstance(value, str) and _EPOCH_RE.match(value):
+        value = float(value)
+
+    if isinstance(value, (int, float)):
+        return EPOCH + datetime.timedelta(seconds=value)
+
+    match = _TIMESTAMP_RE.match(value) if isinstance(value, str) else None
+    if match is None:
+        raise ValueError(value, "invalid timestamp")
+
+    fields = [int(x) for x in match.groups()[:6]]
+    micros = int((match.group(7) or '0').ljust(6, '0'))
+    try:
+        timestamp = datetime.datetime(*fields, micros)
+    except ValueError as e:
+        raise ValueError(value, "invalid timestamp") from e
+
+    offset = match.group(8)
+    if offset and offset != 'Z':
+        offset = offset.replace(':', '')
+        minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+        timestamp = timestamp - datetime.timedelta(
+            minutes=minutes if offset[0] == '+' else -minutes)
+
+    return timestamp
+
+
+@functools.lru_cache(maxsize=4096)
+def _check_key(key):
+    if not key:
+        msg = "key can't be an empty string"
+        raise ValueError(msg)
+
+    if key[0] == '.' or key[-1] == '.':
+        msg = "key can't start or end with a dot"
+        raise ValueError(msg)
+
+    if '..' in key:
+        msg = "key has a double dot"
+        raise ValueError(msg)
+
+    if not _KEY_RE.match(key):
+        msg = "key can only contain [a-z0-9], undercores or dashes"
+        raise ValueError(msg)
+
+
 class Packet:
-    def __init__(self, key, payload, timestamp=None, attachments=None):
-        self.validate_key(key)
+    __slots__ = ('key', 'payload', 'timestamp', 'attachments')
+
+    def __init__(self, key, payload, timestamp=None, attachments=None,
+                 trusted=False):
+        # trusted packets come from the storage or from already validated
+        # packets, checks are skipped for them.
+        if not trusted:
+            self.validate_key(key)
 
         if timestamp is None:
             timestamp = datetime.datetime.utcnow()
-        else:
+        elif not trusted:
             self.validate_timestamp(timestamp)
 
-        if attachments:
+        if attachments and not trusted:
             self.validate_attachments(attachments)
 
         self.key = key
@@ -20,12 +95,19 @@ class Packet:
         self.timestamp = timestamp
         self.attachments = attachments or {}
 
+    def __getstate__(self):
+        return {x: getattr(self, x) for x in self.__slots__}
+
+    def __setstate__(self, state):
+        # Also restores packets pickled before Packet had __slots__
+        for (name, value) in state.items():
+            setattr(self, name, value)
+
     @classmethod
     def fromdict(cls, d):
         timestamp = d.get('timestamp')
-        if timestamp:
-            timestamp = datetime.datetime.strptime(timestamp,
-                                                   '%Y-%m-%d %H:%M:%S.%f')
+        if timestamp is not None:
+            timestamp = parse_timestamp(timestamp)
 
         return cls(d['key'], d['payload'], timestamp=timestamp)
 
@@ -35,21 +117,8 @@ class Packet:
             msg = "key must be a non string"
             raise TypeError(msg)
 
-        if not key:
-            msg = "key can't be an empty string"
-            raise ValueError(msg)
-
-        if key[0] == '.' or key[-1] == '.':
-            msg = "key can't start or end with a dot"
-            raise ValueError(msg)
-
-        if '..' in key:
-            msg = "key has a double dot"
-            raise ValueError(msg)
-
-        if not re.match(r'^[a-z0-9_\-\.]+$', key):
-            msg = "key can only contain [a-z0-9], undercores or dashes"
-            raise ValueError(msg)
+        # Valid keys are cached, exceptions aren't
+        _check_key(key)
 
     @staticmethod
     def validate_timestamp(timestamp):
@@ -75,11 +144,16 @@ class Packet:
             if not callable(read_meth):
                 raise TypeError(attachments, "expected dict(str->Readable)")
 
-    def asdict(self):
+    def asdict(self, epoch=False):
+        if epoch:
+            timestamp = (self.timestamp - EPOCH).total_seconds()
+        else:
+            timestamp = format_timestamp(self.timestamp)
+
         return {
             'key': self.key,
             'payload': self.payload,
-            'timestamp': str(self.timestamp),
+            'timestamp': timestamp,
         }
 
 
@@ -0,0 +1,182 @@
+"""
+Predicates over packet payloads and the secondary indexes backing them.
+
+Predicates are written as keyword arguments, path components separated by
+double underscores and an optional operator suffix, ex:
+
+    query('ci', result__code__ne=0, branch='master')
+
+matches packets whose payload['result']['code'] isn't 0 and whose
+payload['branch'] is 'master'. Payloads missing the field only match
+exists=False.
+"""
+
+
+import json
+import operator
+
+
+MISSING = object()
+
+
+def _in(value, expected):
+    return value in expected
+
+
+OPERATORS = {
+    'eq': operator.eq,
+    'ne': operator.ne,
+    'lt': operator.lt,
+    'le': operator.le,
+    'gt': operator.gt,
+    'ge': operator.ge,
+    'in': _in,
+    'exists': None
+}
+
+
+class Predicate:
+    def __init__(self, path, op, value):
+        if op not in OPERATORS:
+            raise ValueError(op, "unknown operator")
+
+        if op == 'in' and not isinstance(value, (list, tuple, set)):
+            raise ValueError(value, "'in' expects a list")
+
+        self.path = path
+        self.op = op
+        self.value = value
+
+    @classmethod
+    def fromparam(cls, name, value):
+        """
+        Builds a predicate from a name like 'result__code__ne'
+        """
+        parts = name.split('__')
+        op = 'eq'
+        if len(parts) > 1 and parts[-1] in OPERATORS:
+            op = parts.pop()
+
+        if not all(parts):
+            raise ValueError(name, "invalid field path")
+
+        return cls('.'.join(parts), op, value)
+
+    def match(self, value):
+        """
+        Checks the value found at path, MISSING if there was none
+        """
+        if self.op == 'exists':
+            return (value is not MISSING) == bool(self.value)
+
+        if value is MISSING:
+            return False
+
+        try:
+            return bool(OPERATORS[self.op](value, self.value))
+        except TypeError:
+            # Values of different types, ex: 3 < 'a'
+            return False
+
+    def __repr__(self):
+        return '<Predicate {} {} {!r}>'.format(self.path, self.op, self.value)
+
+
+def parse(params):
+    return [Predicate.fromparam(name, value)
+            for (name, value) in sorted(params.items())]
+
+
+def lookup(payload, path):
+    for part in path.split('.'):
+        if isinstance(payload, dict):
+            payload = payload.get(part, MISSING)
+        elif isinstance(payload, list) and part.isdigit():
+            idx = int(part)
+            payload = payload[idx] if idx < len(payload) else MISSING
+        else:
+            return MISSING
+
+        if payload is MISSING:
+            break
+
+    return payload
+
+
+def _normalize(value):
+    # Values equal for == share a bucket, ex: 1, 1.0 and True
+    if isinstance(value, (bool, int)):
+        return int(value)
+
+    if isinstance(value, float):
+        return int(value) if value.is_integer() else value
+
+    if isinstance(value, dict):
+        return {k: _normalize(v) for (k, v) in value.items()}
+
+    if isinstance(value, (list, tuple)):
+        return [_normalize(x) for x in value]
+
+    return value
+
+
+def _bucket(value):
+    return json.dumps(_normalize(value), sort_keys=True)
+
+
+class Index:
+    """
+    Value of a field path in the latest payload of every key under a
+    namespace.
+
+    Besides key -> value it keeps value -> keys buckets so equality and
+    'in' predicates don't need to look at every key.
+    """
+    def __init__(self, namespace, path):
+        self.namespace = namespace
+        self.path = path
+        self.values = {}
+        self.buckets = {}
+
+    def covers(self, key):
+        return (not self.namespace or
+                key.startswith(self.namespace + '.'))
+
+    def update(self, key, payload):
+        self.discard(key)
+
+        value = lookup(payload, self.path)
+        if value is MISSING:
+            return
+
+        self.values[key] = value
+        self.buckets.setdefault(_bucket(value), set()).add(key)
+
+    def discard(self, key):
+        if key not in self.values:
+            return
+
+        bucket = _bucket(self.values.pop(key))
+        self.buckets[bucket].discard(key)
+        if not self.buckets[bucket]:
+            del self.buckets[bucket]
+
+    def candidates(self, predicate):
+        """
+        Returns the keys matching predicate, None if the index can't
+        narrow them down (only exists=False needs keys missing the field)
+        """
+        if predicate.op == 'eq':
+            return set(self.buckets.get(_bucket(predicate.value), ()))
+
+        if predicate.op == 'in':
+            keys = set()
+            for value in predicate.value:
+                keys.update(self.buckets.get(_bucket(value), ()))
+            return keys
+
+        if predicate.op == 'exists' and not predicate.value:
+            return None
+
+        return set(key for (key, value) in self.values.items()
+                   if predicate.match(value))
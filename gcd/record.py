@@ -0,0 +1,188 @@
+"""
+On-disk encoding of packets.
+
+A record is a fixed preamble, a header and the payload:
+
+    preamble  magic (2s) version (B) header length (I)
+    header    timestamp in microseconds since the epoch (q)
+              payload encoding (B): the id of the codec compressing the
+              JSON, 0 for none (see gcd.compression), flagged with
+              ENCODING_DELTA when the JSON is a gcd.delta patch against
+              the payload of the previous record
+              key length (H) key (utf-8)
+              attachment count (H)
+              for each attachment: name length (H) name (utf-8) aid (20s)
+    payload   payload encoded as stated in the header
+
+The header can be decoded on its own, without touching the payload.
+"""
+
+
+import collections
+import copy
+import datetime
+import json
+import struct
+
+
+from gcd import (
+    Packet,
+    compression,
+    delta
+)
+
+
+MAGIC = b'GR'
+VERSION = 1
+
+ENCODING_JSON = 0
+ENCODING_DELTA = 0x80
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+_PREAMBLE = struct.Struct('>2sBI')
+_FIXED = struct.Struct('>qBH')
+_LENGTH = struct.Struct('>H')
+
+
+Header = collections.namedtuple(
+    'Header',
+    ['key', 'timestamp', 'attachments', 'encoding', 'payload_offset'])
+
+
+class RecordError(ValueError):
+    pass
+
+
+def is_record(buff):
+    return buff[:len(MAGIC)] == MAGIC
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(',', ':'))
+
+
+def encode(packet, compress=None, base=None):
+    """
+    Encodes packet, its payload compressed as stated by the compress
+    compression.Rule if it is worth it.
+
+    base is the previous packet of the key: when given, the payload is
+    stored as a delta against base's if that is smaller. Decoding the
+    record then needs base.
+    """
+    payload = _dumps(packet.payload)
+    encoding = ENCODING_JSON
+
+    if base is not None:
+        # Diff the values as they will be decoded
+        patch = _dumps(delta.diff(json.loads(_dumps(base.payload)),
+                                  json.loads(payload)))
+        if len(patch) < len(payload):
+            (payload, encoding) = (patch, ENCODING_DELTA)
+
+    payload = payload.encode('utf-8')
+
+    if compress and compress.applies(len(payload)):
+        compressed = compress.codec.compress(payload)
+        if len(compressed) < len(payload):
+            return encode_raw(packet, compressed,
+                              encoding | compress.codec.id)
+
+    return encode_raw(packet, payload, encoding)
+
+
+def encode_raw(packet, payload, encoding):
+    micros = (packet.timestamp - EPOCH) // datetime.timedelta(microseconds=1)
+    key = packet.key.encode('utf-8')
+
+    parts = [
+        _FIXED.pack(micros, encoding, len(key)),
+        key,
+        _LENGTH.pack(len(packet.attachments))
+    ]
+    for (name, aid) in packet.attachments.items():
+        name = name.encode('utf-8')
+        parts.extend([_LENGTH.pack(len(name)), name, bytes.fromhex(aid)])
+
+    header = b''.join(parts)
+    return b''.join([
+        _PREAMBLE.pack(MAGIC, VERSION, len(header)),
+        header,
+        payload
+    ])
+
+
+def decode_header(buff):
+    try:
+        (magic, version, length) = _PREAMBLE.unpack_from(buff)
+    except struct.error as e:
+        raise RecordError("truncated record") from e
+
+    if magic != MAGIC:
+        raise RecordError("not a record")
+
+    if version != VERSION:
+        raise RecordError(version, "unsupported record version")
+
+    try:
+        offset = _PREAMBLE.size
+        (micros, encoding, key_len) = _FIXED.unpack_from(buff, offset)
+        offset = offset + _FIXED.size
+        key = buff[offset:offset + key_len].decode('utf-8')
+        offset = offset + key_len
+
+        (count,) = _LENGTH.unpack_from(buff, offset)
+        offset = offset + _LENGTH.size
+
+        attachments = {}
+        for idx in range(count):
+            (name_len,) = _LENGTH.unpack_from(buff, offset)
+            offset = offset + _LENGTH.size
+            name = buff[offset:offset + name_len].decode('utf-8')
+            offset = offset + name_len
+            attachments[name] = buff[offset:offset + 20].hex()
+            offset = offset + 20
+
+    except (struct.error, UnicodeDecodeError) as e:
+        raise RecordError("corrupted record header") from e
+
+    timestamp = EPOCH + datetime.timedelta(microseconds=micros)
+    return Header(key, timestamp, attachments, encoding,
+                  _PREAMBLE.size + length)
+
+
+def is_delta(buff):
+    return bool(decode_header(buff).encoding & ENCODING_DELTA)
+
+
+def decode(buff, base=None, reuse_base=False):
+    """
+    Decodes a record, delta records need base, the packet of the previous
+    record. With reuse_base the payload of base may be reused and modified
+    instead of copied, for bases that are thrown away afterwards.
+    """
+    header = decode_header(buff)
+
+    payload = buff[header.payload_offset:]
+    codec_id = header.encoding & ~ENCODING_DELTA
+    if codec_id != ENCODING_JSON:
+        try:
+            codec = compression.get(codec_id)
+        except KeyError:
+            raise RecordError(header.encoding, "unknown payload encoding")
+
+        payload = codec.decompress(payload)
+
+    payload = json.loads(payload.decode('utf-8'))
+    if header.encoding & ENCODING_DELTA:
+        if base is None:
+            raise RecordError("delta record decoded without its base")
+
+        base = base.payload if reuse_base else copy.deepcopy(base.payload)
+        payload = delta.apply(base, payload)
+
+    packet = Packet(header.key, payload,
+                    timestamp=header.timestamp, trusted=True)
+    packet.attachments.update(header.attachments)
+    return packet
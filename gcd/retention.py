@@ -0,0 +1,130 @@
+import datetime
+import logging
+import threading
+
+
+_logger = logging.getLogger(__name__)
+
+
+class Policy:
+    FIELDS = {
+        'entries': 'max_entries',
+        'age': 'max_age',
+        'bytes': 'max_bytes'
+    }
+
+    def __init__(self, max_entries=None, max_age=None, max_bytes=None):
+        for value in (max_entries, max_age, max_bytes):
+            if value is not None and value <= 0:
+                raise ValueError(value, "limits must be positive")
+
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def fromstring(cls, s):
+        """
+        Builds a policy from a string like 'entries=100,age=3600,bytes=1024'
+        where age is in seconds. Missing fields mean no limit.
+        """
+        kwargs = {}
+        for item in s.split(','):
+            try:
+                (name, value) = item.split('=')
+                kwargs[cls.FIELDS[name.strip()]] = int(value)
+            except (KeyError, ValueError) as e:
+                raise ValueError(item, "invalid retention setting") from e
+
+        return cls(**kwargs)
+
+    def retained(self, records, now=None):
+        """
+        Counts how many records are kept out of an iterable of
+        (timestamp, size) pairs sorted from newest to oldest.
+
+        The newest record is always kept and records are consumed only until
+        the first one is dropped, so callers can pass lazy iterables.
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+
+        count = 0
+        size = 0
+        for (timestamp, nbytes) in records:
+            if count:
+                if self.max_entries and count >= self.max_entries:
+                    break
+
+                if self.max_bytes and size + nbytes > self.max_bytes:
+                    break
+
+                age = (now - timestamp).total_seconds()
+                if self.max_age and age > self.max_age:
+                    break
+
+            count = count + 1
+            size = size + nbytes
+
+        return count
+
+    def __bool__(self):
+        return any([self.max_entries, self.max_age, self.max_bytes])
+
+    def __repr__(self):
+        return '<Policy entries={} age={} bytes={}>'.format(
+            self.max_entries, self.max_age, self.max_bytes)
+
+
+class Compactor(threading.Thread):
+    """
+    Periodically prunes keys saved since the last pass.
+
+    Each pass handles at most `batch` keys so a large backlog of dirty keys
+    is worked through over several passes instead of holding the storage
+    for a long time.
+    """
+    def __init__(self, storage, interval=60, batch=100):
+        super().__init__(daemon=True)
+        self.storage = storage
+        self.interval = interval
+        self.batch = batch
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.storage.compact(limit=self.batch)
+
+    def stop(self):
+        self._stopped.set()
+
+
+class Sweeper(threading.Thread):
+    """
+    Periodically deletes attachments no record references anymore, see
+    StorageAPI.collect().
+
+    Like Compactor each pass handles at most `batch` attachments, which
+    bounds how much disk I/O the sweeper adds to the server's own.
+    """
+    def __init__(self, storage, interval=300, batch=100, grace=3600,
+                 dry_run=False):
+        super().__init__(daemon=True)
+        self.storage = storage
+        self.interval = interval
+        self.batch = batch
+        self.grace = grace
+        self.dry_run = dry_run
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            (count, size) = self.storage.collect(
+                limit=self.batch, grace=self.grace, dry_run=self.dry_run)
+            if count:
+                _logger.info("%s %d files, %d bytes",
+                             "Would reclaim" if self.dry_run else "Reclaimed",
+                             count, size)
+
+    def stop(self):
+        self._stopped.set()
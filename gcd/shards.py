@@ -0,0 +1,368 @@
+"""
+Partitioning of the storage dbm across several files.
+
+A sharded datadir has a shards.json layout file, the shards and the
+namespace index under shards/. Unsharded datadirs keep everything in a
+single 'db' file. Changing the number of shards is an offline operation,
+see rebalance().
+
+Shared datadirs can be opened by several processes at once: each dbm file
+then has a lock file next to it, flock()ed by whoever uses the dbm, which
+also holds a counter bumped on every change so other processes know what
+they may have cached is stale. The dbm is opened while the lock is held,
+which needs a backend writing changes in place like gdbm: dbm.dumb
+rewrites its whole index on every close.
+"""
+
+
+import contextlib
+import dbm
+import fcntl
+import glob
+import json
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import zlib
+
+
+LAYOUT = 'shards.json'
+
+STRATEGIES = ('hash', 'namespace')
+
+
+def log_key(name):
+    """
+    Returns the key owning a dbm name: heads are stored under the key itself
+    and records as 'key/idx'
+    """
+    if isinstance(name, bytes):
+        name = name.decode('utf-8')
+
+    return name.split('/', 1)[0]
+
+
+_GENERATION = struct.Struct('>Q')
+
+
+class Shard:
+    """
+    A dbm file and the lock guarding it, a reentrant context manager.
+
+    Unshared shards only take a thread lock. Shared ones then flock() the
+    lock file and open the dbm until the lock is released. If another
+    process changed it since, on_change(shard) is called.
+    """
+    def __init__(self, path, shared=False, on_change=None):
+        self.path = path
+        self.shared = shared
+        self.on_change = on_change
+        self.lock = threading.RLock()
+        self.db = None
+        self._depth = 0
+        self._changed = False
+
+        if not shared:
+            self.db = dbm.open(path, 'c')
+            return
+
+        self._fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        self.generation = None
+        try:
+            with self:
+                backend = type(self.db).__module__
+        except BaseException:
+            os.close(self._fd)
+            raise
+
+        if backend == 'dbm.dumb':
+            os.close(self._fd)
+            raise ValueError(path, "shared datadirs need a dbm backend "
+                                   "writing in place, like dbm.gnu")
+
+    def _read_generation(self):
+        buff = os.pread(self._fd, _GENERATION.size, 0)
+        return _GENERATION.unpack(buff)[0] if buff else 0
+
+    def outdated(self):
+        """
+        Returns whether another process changed the shard since this one
+        last used it, without taking the lock
+        """
+        return self.shared and self.generation is not None and \
+            self._read_generation() != self.generation
+
+    def __enter__(self):
+        self.lock.acquire()
+        if self.shared and not self._depth:
+            try:
+                self._acquire()
+            except BaseException:
+                self.lock.release()
+                raise
+
+        self._depth = self._depth + 1
+        return self
+
+    def _acquire(self):
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            self.db = dbm.open(self.path, 'c')
+            generation = self._read_generation()
+            changed = self.generation is not None and \
+                generation != self.generation
+
+            self.generation = generation
+            if changed and self.on_change:
+                self.on_change(self)
+        except BaseException:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            raise
+
+    def __exit__(self, *exc_info):
+        self._depth = self._depth - 1
+        try:
+            if self.shared and not self._depth:
+                self._release()
+        finally:
+            self.lock.release()
+
+    def _release(self):
+        try:
+            self.db.close()
+            self.db = None
+
+            if self._changed:
+                self._changed = False
+                self.generation = self.generation + 1
+                os.pwrite(self._fd, _GENERATION.pack(self.generation), 0)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def changed(self):
+        self._changed = True
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+            if self.shared:
+                os.close(self._fd)
+
+
+class ShardedDB:
+    """
+    dict-like view over the dbm files of a datadir.
+
+    A key's head and records live in the shard picked by hashing the key, or
+    its top level namespace, and are guarded by that shard's lock alone:
+    writers of keys in different shards don't wait for each other, ex: the
+    workers of a shared datadir. Namespace index nodes and attachment
+    reference counts, the '@' names, live in a file of their own with its
+    own lock.
+
+    Shared datadirs can be used by several processes, on_change(shard) is
+    called when a shard is found changed by another process.
+    """
+    def __init__(self, datadir, count=1, by='hash', shared=False,
+                 on_change=None):
+        if count < 1:
+            raise ValueError(count, "the number of shards must be positive")
+
+        if by not in STRATEGIES:
+            raise ValueError(by, "unknown sharding strategy")
+
+        self.datadir = datadir
+        self.count = count
+        self.by = by
+        self.shared = shared
+
+        def shard(path):
+            return Shard(path, shared=shared, on_change=on_change)
+
+        if count == 1:
+            self.shards = [shard(datadir + '/db')]
+            self.nodes = self.shards[0]
+        else:
+            os.makedirs(datadir + '/shards', exist_ok=True)
+            self.shards = [
+                shard('{}/shards/{:03d}'.format(datadir, idx))
+                for idx in range(count)
+            ]
+            self.nodes = shard(datadir + '/shards/nodes')
+
+    @classmethod
+    def open(cls, datadir, count=None, by=None, shared=False,
+             on_change=None):
+        """
+        Opens datadir with its current layout. count and by only apply to
+        new datadirs, asking for another layout than the stored one raises
+        ValueError.
+        """
+        layout = load_layout(datadir)
+        if layout is None:
+            if not count or count == 1:
+                return cls(datadir, shared=shared, on_change=on_change)
+
+            if dbm.whichdb(datadir + '/db') is not None:
+                raise ValueError(datadir, "datadir isn't sharded, "
+                                          "rebalance it first")
+
+            layout = {'count': count, 'by': by or 'hash'}
+            save_layout(datadir, layout)
+
+        if (count and count != layout['count']) or \
+           (by and by != layout['by']):
+            raise ValueError(
+                datadir,
+                "datadir has {count} shards by {by}, rebalance it "
+                "first".format(**layout))
+
+        return cls(datadir, layout['count'], layout['by'], shared=shared,
+                   on_change=on_change)
+
+    def shard(self, name):
+        key = log_key(name)
+        if self.count == 1:
+            return 0
+
+        if self.by == 'namespace':
+            key = key.split('.', 1)[0]
+
+        return zlib.crc32(key.encode('utf-8')) % self.count
+
+    def lock(self, name):
+        """
+        Returns the Shard holding name, which is also its lock
+        """
+        if log_key(name).startswith('@'):
+            return self.nodes
+
+        return self.shards[self.shard(name)]
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        Holds every lock, always taken in the same order
+        """
+        with contextlib.ExitStack() as stack:
+            for shard in self._files():
+                stack.enter_context(shard)
+
+            yield
+
+    def __getitem__(self, name):
+        with self.lock(name) as shard:
+            return shard.db[name]
+
+    def __setitem__(self, name, value):
+        with self.lock(name) as shard:
+            shard.db[name] = value
+            shard.changed()
+
+    def __delitem__(self, name):
+        with self.lock(name) as shard:
+            del shard.db[name]
+            shard.changed()
+
+    def __contains__(self, name):
+        with self.lock(name) as shard:
+            return name in shard.db
+
+    def _files(self):
+        if self.nodes is self.shards[0]:
+            return self.shards
+
+        return self.shards + [self.nodes]
+
+    def keys(self):
+        names = []
+        for shard in self._files():
+            with shard:
+                names.extend(shard.db.keys())
+
+        return names
+
+    def names(self, prefix):
+        """
+        Returns the '@' names starting with prefix, only reading the file
+        they live in
+        """
+        prefix = prefix.encode('utf-8')
+        with self.nodes as shard:
+            return [x.decode('utf-8') for x in shard.db.keys()
+                    if x.startswith(prefix)]
+
+    def close(self):
+        for shard in self._files():
+            shard.close()
+
+
+def load_layout(datadir):
+    try:
+        with open(datadir + '/' + LAYOUT) as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return None
+
+
+def save_layout(datadir, layout):
+    with tempfile.NamedTemporaryFile('w', dir=datadir, delete=False) as fh:
+        json.dump(layout, fh)
+
+    os.replace(fh.name, datadir + '/' + LAYOUT)
+
+
+def _files(datadir, count):
+    if count == 1:
+        return glob.glob(datadir + '/db') + glob.glob(datadir + '/db.*')
+
+    return [datadir + '/shards']
+
+
+def rebalance(datadir, count, by='hash'):
+    """
+    Moves the contents of datadir to a layout of count shards, 1 meaning a
+    single unsharded file. No server may be using datadir meanwhile.
+
+    The new layout is built aside and swapped in once complete, the old
+    files are kept in a backup directory until then. Returns the number of
+    moved dbm entries.
+    """
+    old = ShardedDB.open(datadir)
+    work = tempfile.mkdtemp(dir=datadir, prefix='rebalance-')
+    os.makedirs(work + '/new')
+    new = ShardedDB(work + '/new', count, by)
+
+    moved = 0
+    try:
+        for name in old.keys():
+            new[name] = old[name]
+            moved = moved + 1
+    finally:
+        new.close()
+        old.close()
+
+    os.makedirs(work + '/old')
+    for path in _files(datadir, old.count):
+        os.replace(path, work + '/old/' + os.path.basename(path))
+
+    if os.path.exists(datadir + '/' + LAYOUT):
+        os.unlink(datadir + '/' + LAYOUT)
+
+    for path in _files(work + '/new', count):
+        os.replace(path, datadir + '/' + os.path.basename(path))
+
+    if count > 1:
+        save_layout(datadir, {'count': count, 'by': by})
+
+    shutil.rmtree(work)
+    return moved
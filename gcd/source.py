@@ -1,9 +1,224 @@
-from gcd import consts
+from gcd import (
+    Client,
+    consts
+)
+from gcd.client import unsent
+
+
+import collections
+import logging
+import threading
+import time
+
+
+_logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
 
 
 class Source:
-    def __init__(self, storage_uri=consts.DEFAULT_STORAGE_URI):
-        self.storage_uri = uri
+    """
+    Non-blocking packet emitter.
+
+    send() only queues the packet, a background worker saves queued packets
+    in batches of up to batch_size, as soon as a batch is full or
+    flush_interval seconds after the oldest queued packet.
+
+    With coalesce a queued packet is replaced by newer packets for the same
+    key, so only the latest value of each key is sent. When max_queue
+    packets are waiting the overflow policy decides: 'block' waits for room
+    (raising QueueFull after block_timeout), 'drop' discards the new packet
+    and 'drop-oldest' discards the oldest queued one.
+
+    Batches are retried up to retries times, with exponential backoff,
+    only while they can't have reached the server: a batch failing
+    otherwise, ex: timing out waiting for the response, may have been saved
+    and is dropped instead of saved twice. Requests time out after timeout
+    seconds unless client is given.
+
+    stats counts packets sent, coalesced, dropped (by the overflow policy,
+    on close, after every retry failed or when they may have been saved)
+    and failed (rejected by the server), and attempt_errors the failed
+    attempts to send a batch.
+    """
+    POLICIES = ('block', 'drop', 'drop-oldest')
+
+    def __init__(self, storage_uri=consts.DEFAULT_STORAGE_URI, client=None,
+                 max_queue=10000, batch_size=100, flush_interval=1.0,
+                 coalesce=True, overflow='block', block_timeout=None,
+                 retries=3, backoff=0.5, timeout=10):
+        if overflow not in self.POLICIES:
+            raise ValueError(overflow, "unknown overflow policy")
+
+        self.storage_uri = storage_uri
+        self.client = client or Client(storage_uri, timeout=timeout)
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.coalesce = coalesce
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        self.stats = {
+            'sent': 0,
+            'coalesced': 0,
+            'dropped': 0,
+            'failed': 0,
+            'attempt_errors': 0
+        }
+
+        # Queued packets, by key when coalescing or by sequence number
+        self._queue = collections.OrderedDict()
+        self._seq = 0
+        self._oldest = None
+        self._inflight = 0
+        self._flushing = False
+        self._closed = False
+        self._cond = threading.Condition()
+        self._worker = None
 
     def send(self, packet):
-        pass
+        with self._cond:
+            if self._closed:
+                raise ValueError("source is closed")
+
+            if self.coalesce and packet.key in self._queue:
+                self._queue[packet.key] = packet
+                self.stats['coalesced'] += 1
+                return
+
+            if len(self._queue) >= self.max_queue:
+                if not self._make_room():
+                    return
+
+            self._seq = self._seq + 1
+            qkey = packet.key if self.coalesce else self._seq
+            self._queue[qkey] = packet
+
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+
+            self._start()
+            self._cond.notify_all()
+
+    def _make_room(self):
+        if self.overflow == 'drop':
+            self.stats['dropped'] += 1
+            return False
+
+        if self.overflow == 'drop-oldest':
+            self._queue.popitem(last=False)
+            self.stats['dropped'] += 1
+            return True
+
+        has_room = self._cond.wait_for(
+            lambda: len(self._queue) < self.max_queue or self._closed,
+            timeout=self.block_timeout)
+        if not has_room:
+            raise QueueFull()
+
+        if self._closed:
+            self.stats['dropped'] += 1
+            return False
+
+        return True
+
+    def _start(self):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, daemon=True)
+            self._worker.start()
+
+    def _next_batch(self):
+        def ready():
+            if not self._queue:
+                return self._closed
+
+            due = self._oldest + self.flush_interval
+            return (self._closed or self._flushing or
+                    len(self._queue) >= self.batch_size or
+                    time.monotonic() >= due)
+
+        with self._cond:
+            while not ready():
+                timeout = None
+                if self._queue:
+                    timeout = self._oldest + self.flush_interval - \
+                        time.monotonic()
+
+                self._cond.wait(timeout)
+
+            batch = []
+            while self._queue and len(batch) < self.batch_size:
+                batch.append(self._queue.popitem(last=False)[1])
+
+            self._oldest = time.monotonic() if self._queue else None
+            self._inflight = len(batch)
+            self._cond.notify_all()
+
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+
+            self._flush(batch)
+
+            with self._cond:
+                self._inflight = 0
+                self._cond.notify_all()
+
+    def _flush(self, batch):
+        for attempt in range(self.retries + 1):
+            try:
+                results = self.client.save_many(batch)
+            except Exception as e:
+                _logger.warning("Failed to send %d packets", len(batch),
+                                exc_info=True)
+                self._count('attempt_errors', 1)
+                if not unsent(e):
+                    break
+
+                if attempt < self.retries:
+                    time.sleep(self.backoff * 2 ** attempt)
+                continue
+
+            failed = sum(1 for x in results if isinstance(x, Exception))
+            self._count('sent', len(results) - failed)
+            self._count('failed', failed)
+            return
+
+        self._count('dropped', len(batch))
+
+    def _count(self, stat, n):
+        with self._cond:
+            self.stats[stat] += n
+
+    def flush(self, timeout=None):
+        """
+        Waits until every queued packet has been handled, returns False if
+        timeout expires first.
+        """
+        with self._cond:
+            self._flushing = True
+            self._cond.notify_all()
+
+            try:
+                return self._cond.wait_for(
+                    lambda: not self._queue and not self._inflight,
+                    timeout=timeout)
+            finally:
+                self._flushing = False
+
+    def close(self, timeout=None):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+        if self._worker is not None:
+            self._worker.join(timeout)
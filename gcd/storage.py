@@ -1,155 +1,1394 @@
 from gcd import (
     Packet,
+    compression,
     consts,
+    events,
+    query,
+    record,
+    retention,
     utils
 )
+from gcd.metrics import (
+    Metrics,
+    instrument
+)
+from gcd.shards import ShardedDB
+from gcd.packet import (
+    EPOCH,
+    format_timestamp,
+    parse_timestamp
+)
 
 
+import asyncio
 import builtins
-import dbm
+import collections
+import concurrent.futures
+import copy
+import datetime
+import functools
 import hashlib
+import inspect
+import io
 import json
+import logging
 import os
 import pickle
 import re
 import shutil
 import tempfile
+import threading
+import time
+import urllib.parse
 
 
 import apistar
+from apistar.server.asgi import (
+    ASGIScope,
+    ASGISend
+)
+from apistar.server.wsgi import (
+    RESPONSE_STATUS_TEXT,
+    WSGIEnviron,
+    WSGIStartResponse
+)
+import werkzeug.formparser
+import werkzeug.http
+
+
+_logger = logging.getLogger(__name__)
+
+# ASGI extension for servers able to send files themselves
+ZERO_COPY_SEND = 'http.response.zerocopysend'
+
+
+class _Hashing:
+    """
+    Reads fileobj feeding what is read to digest
+    """
+    def __init__(self, fileobj, digest):
+        self.fileobj = fileobj
+        self.digest = digest
+
+    def read(self, size=-1):
+        buff = self.fileobj.read(size)
+        self.digest.update(buff)
+        return buff
 
 
 class StorageAPI:
-    def __init__(self, datadir):
+    def __init__(self, datadir, retention=None, cache_size=1024,
+                 metrics=None, indexes=None, shards=None, shard_by=None,
+                 compression=None, delta=None, shared=False, grace=3600):
         os.makedirs(datadir, exist_ok=True)
         os.makedirs(datadir + "/attachments", exist_ok=True)
 
         self.attachments = datadir + "/attachments"
-        self.db = dbm.open(datadir + "/db", "c")
+
+        # Uploads are staged on the same filesystem as the attachments tree
+        # so storing them is an atomic rename
+        self.staging = datadir + "/staging"
+        os.makedirs(self.staging, exist_ok=True)
+
+        self.attachment_stats = {
+            'written': 0,
+            'written_bytes': 0,
+            'deduplicated': 0,
+            'deduplicated_bytes': 0,
+            'reclaimed': 0,
+            'reclaimed_bytes': 0
+        }
+
+        # aid -> time.monotonic() of its last write, oldest first. collect()
+        # leaves attachments written in the last grace seconds alone, their
+        # packets may not be saved yet.
+        self._written = collections.OrderedDict()
+        self.grace = grace
+
+        # namespace -> retention.Policy, '' applies to every key
+        self.retention = retention or {}
+
+        # namespace -> compression.Rule for payloads and attachments, looked
+        # up like retention policies. Reads detect the codec on their own.
+        self.compression = compression or {}
+
+        # namespace -> keyframe interval. Keys under these namespaces store
+        # payloads as deltas against the previous one, but for a full
+        # keyframe every interval records so reading any record decodes
+        # at most interval of them.
+        self.delta = delta or {}
+        self.lock = threading.RLock()
+        self._dirty = set()
+
+        # Latest packet of hot keys, decoded from their records. Callers only
+        # ever get copies of them.
+        self.cache = utils.LRUCache(cache_size)
+
+        self.metrics = metrics or Metrics()
+        self.metrics.collectors.append(self._collect)
+
+        # namespace -> field paths of the latest payloads to index. Indexes
+        # live in memory, they are built by the first query and then kept
+        # up to date by saves.
+        self.indexes = [
+            query.Index(ns, path)
+            for (ns, paths) in (indexes or {}).items()
+            for path in paths
+        ]
+        self._indexes_built = False
+        self._build_lock = threading.Lock()
+        # While indexes are built: the shards done and keys saved to the
+        # others meanwhile, see _build_indexes()
+        self._indexed = None
+        self._saved = None
+        # Shards other processes changed since they were indexed
+        self._stale = set()
+
+        # event -> callbacks, see connect()
+        self._listeners = {}
+        self.changes = events.ChangeLog()
+
+        # Each key's log is guarded by the lock of its shard, see
+        # gcd.shards. self.lock only guards in-memory state and is always
+        # taken after shard locks. Shared datadirs can be used by several
+        # processes at once, each keeping its cache and indexes in sync
+        # with the saves of the others.
+        self.shared = shared
+        self.db = ShardedDB.open(
+            datadir, count=shards, by=shard_by, shared=shared,
+            on_change=self._changed if shared else None)
+
+        if self._node_key('') not in self.db:
+            self.reindex()
+
+        if self._ref_key('') not in self.db:
+            self.recount()
+
+    def close(self):
+        self.db.close()
+
+    def _changed(self, shard):
+        # Another process wrote to shard, drop what may be stale
+        with self.lock:
+            for key in self.cache.keys():
+                if self.db.lock(key) is shard:
+                    self.cache.discard(key)
+
+            if shard in self.db.shards:
+                self._stale.add(shard)
 
     def isaid(self, aid):
-        return re.match('^[0-9a-f]$', aid)
+        return re.match('^[0-9a-f]{40}$', aid) is not None
+
+    @staticmethod
+    def _record_key(key, idx):
+        return '{}/{}'.format(key, idx)
+
+    def _head(self, key):
+        """
+        Returns the (first, next) record indexes of key's log.
+
+        The head lives under the key itself while each packet is stored as
+        an individual record so saving never rewrites the previous history.
+        """
+        raw = self.db[key]
+        try:
+            (first, next_) = raw.split(b' ')
+            return (int(first), int(next_))
+        except ValueError:
+            return self._upgrade(key, raw)
+
+    def _set_head(self, key, first, next_):
+        self.db[key] = '{} {}'.format(first, next_).encode('ascii')
+
+    def _upgrade(self, key, raw):
+        # Old datadirs keep the whole pickled backlog (newest first) under
+        # the key, split it into records on first access.
+        packets = pickle.loads(raw)
+        for (idx, packet) in enumerate(reversed(packets)):
+            self.db[self._record_key(key, idx)] = record.encode(packet)
+
+        self._set_head(key, 0, len(packets))
+        return (0, len(packets))
+
+    def _record(self, key, idx):
+        return self._records(key, idx, idx + 1)[0]
+
+    def _records(self, key, lo, hi):
+        """
+        Returns the packets of key's records from lo to hi - 1, oldest
+        first. Delta records are rebuilt decoding forward from the closest
+        keyframe, once for the whole range.
+        """
+        if lo >= hi:
+            return []
+
+        raws = {}
+        start = lo
+        while True:
+            raws[start] = raw = self.db[self._record_key(key, start)]
+            if not record.is_record(raw) or not record.is_delta(raw):
+                break
+
+            start = start - 1
+
+        packets = []
+        packet = None
+        for idx in range(start, hi):
+            raw = raws.pop(idx, None)
+            if raw is None:
+                raw = self.db[self._record_key(key, idx)]
+
+            if record.is_record(raw):
+                # Only copy the payloads of bases that are returned
+                packet = record.decode(raw, base=packet, reuse_base=idx <= lo)
+            else:
+                # Pickled packet, see migrate()
+                packet = pickle.loads(raw)
+
+            if idx >= lo:
+                packets.append(packet)
+
+        return packets
+
+    def _record_meta(self, key, idx):
+        raw = self.db[self._record_key(key, idx)]
+        if record.is_record(raw):
+            return (record.decode_header(raw).timestamp, len(raw))
+
+        return (pickle.loads(raw).timestamp, len(raw))
 
+    def _record_attachments(self, key, idx):
+        raw = self.db[self._record_key(key, idx)]
+        if record.is_record(raw):
+            return list(record.decode_header(raw).attachments.values())
+
+        return list(pickle.loads(raw).attachments.values())
+
+    def heads(self):
+        """
+        Returns every stored key
+        """
+        with self.db.locked():
+            keys = [x.decode('utf-8') for x in self.db.keys()]
+
+        return [x for x in keys if x[0] != '@' and '/' not in x]
+
+    def migrate(self):
+        """
+        Rewrites records stored by older versions in the current record
+        format. Returns the number of rewritten records.
+        """
+        count = 0
+        for key in self.heads():
+            with self.db.lock(key):
+                (first, next_) = self._head(key)
+                for idx in range(first, next_):
+                    rkey = self._record_key(key, idx)
+                    raw = self.db[rkey]
+                    if not record.is_record(raw):
+                        self.db[rkey] = record.encode(
+                            pickle.loads(raw), self.compression_rule(key))
+                        count = count + 1
+
+        return count
+
+    @staticmethod
+    def _node_key(namespace):
+        return '@' + namespace
+
+    def _node(self, namespace):
+        name = self._node_key(namespace)
+        with self.db.lock(name):
+            try:
+                raw = self.db[name]
+            except KeyError:
+                return []
+
+        return raw.decode('utf-8').split('\n') if raw else []
+
+    def _index(self, key):
+        """
+        Adds key to the namespace index.
+
+        Each namespace has a node listing its direct children, walking down
+        the segments of key only touches the nodes along its path.
+        """
+        parts = key.split('.')
+        for idx in range(len(parts)):
+            namespace = '.'.join(parts[:idx])
+            with self.db.lock(self._node_key(namespace)):
+                children = self._node(namespace)
+                if parts[idx] not in children:
+                    children.append(parts[idx])
+                    self.db[self._node_key(namespace)] = \
+                        '\n'.join(children).encode('utf-8')
+
+    @staticmethod
+    def _ref_key(aid):
+        # Reference counts live with the namespace nodes, '@@' alone marks
+        # datadirs that keep them. Markers aren't empty, ndbm doesn't find
+        # empty values.
+        return '@@' + aid
+
+    @staticmethod
+    def _orphan_key(aid):
+        # Queues an attachment left without references for collect()
+        return '@@-' + aid
+
+    def _orphans(self):
+        prefix = self._orphan_key('')
+        return sorted(x[len(prefix):] for x in self.db.names(prefix))
+
+    def _queue_orphans(self, aids):
+        for aid in aids:
+            self.db[self._orphan_key(aid)] = b'1'
+
+    def _unqueue_orphan(self, aid):
+        try:
+            del self.db[self._orphan_key(aid)]
+        except KeyError:
+            pass
+
+    def _count_refs(self, aids, delta):
+        """
+        Adds delta to the reference count of each of aids, once per
+        occurrence. Attachments left without references are queued for
+        collect().
+        """
+        if not aids:
+            return
+
+        with self.db.lock(self._ref_key('')):
+            orphans = []
+            for aid in aids:
+                name = self._ref_key(aid)
+                try:
+                    count = int(self.db[name]) + delta
+                except KeyError:
+                    count = delta
+
+                if count > 0:
+                    self.db[name] = str(count).encode('ascii')
+                    continue
+
+                try:
+                    del self.db[name]
+                except KeyError:
+                    pass
+
+                orphans.append(aid)
+
+            self._queue_orphans(orphans)
+
+    def _stored(self):
+        """
+        Yields the aid of every attachment file, walking the whole tree
+        """
+        for (dirpath, dirnames, filenames) in os.walk(self.attachments):
+            for name in filenames:
+                if self.isaid(name):
+                    yield name
+
+    def recount(self):
+        """
+        Rebuilds the attachment reference counts from the stored records
+        and queues the attachments no record references for collect().
+        Only needed for datadirs created before reference counting, it
+        reads every record and walks the whole attachments tree.
+        """
+        with self.db.locked():
+            counts = collections.Counter()
+            for key in self.heads():
+                (first, next_) = self._head(key)
+                for idx in range(first, next_):
+                    counts.update(self._record_attachments(key, idx))
+
+            for name in self.db.keys():
+                if name.startswith(b'@@'):
+                    del self.db[name]
+
+            for (aid, count) in counts.items():
+                self.db[self._ref_key(aid)] = str(count).encode('ascii')
+
+            self.db[self._ref_key('')] = b'1'
+            self._queue_orphans(x for x in self._stored() if x not in counts)
+
+    def reindex(self):
+        """
+        Rebuilds the namespace index from the stored keys. Only needed for
+        datadirs created before the index existed, empty datadirs have
+        nothing to index.
+        """
+        with self.db.locked():
+            for key in self.heads():
+                self._index(key)
+
+    @instrument('list')
     def list(self, namespace=''):
-        keys = (x.decode('utf-8') for x in self.db.keys())
+        if namespace:
+            Packet.validate_key(namespace)
 
-        if not namespace:
-            tmp = (x.split('.')[0] for x in keys)
+        return self._node(namespace)
 
-        else:
+    @instrument('count')
+    def count(self, namespace=''):
+        """
+        Returns the number of direct children of namespace
+        """
+        if namespace:
             Packet.validate_key(namespace)
-            ns_len = len(namespace) + 1
-            tmp = (x[ns_len:] for x in keys if x.startswith(namespace+'.'))
 
-        return list(set(tmp))
+        name = self._node_key(namespace)
+        with self.db.lock(name):
+            try:
+                raw = self.db[name]
+            except KeyError:
+                return 0
 
+        return raw.count(b'\n') + 1 if raw else 0
+
+    @instrument('get')
     def get(self, key):
-        return self.backlog(key)[0]
+        with self.db.lock(key):
+            return self._copy(self._latest(key))
+
+    @instrument('get')
+    def latest(self, key):
+        """
+        Returns the record index of key's latest packet and the packet
+        """
+        with self.db.lock(key):
+            (first, next_) = self._head(key)
+            return (next_ - 1, self._copy(self._latest(key)))
 
+    @staticmethod
+    def _copy(packet):
+        # Callers may modify the packets they get
+        _packet = Packet(packet.key, copy.deepcopy(packet.payload),
+                         timestamp=packet.timestamp, trusted=True)
+        _packet.attachments.update(packet.attachments)
+        return _packet
+
+    def _latest(self, key):
+        # Only holders of key's shard lock read or write its cache entry,
+        # self.lock keeps the cache itself consistent
+        with self.lock:
+            packet = self.cache.get(key)
+
+        if packet is None:
+            (first, next_) = self._head(key)
+            packet = self._record(key, next_ - 1)
+            with self.lock:
+                self.cache.set(key, packet)
+
+        return packet
+
+    @instrument('save')
     def save(self, packet):
-        try:
-            packets = self.backlog(packet.key)
-        except KeyError:
-            packets = []
+        _packet = self._prepare(packet)
+
+        with self.db.lock(_packet.key):
+            prev = self._append(_packet)
+
+        self._emit(events.Event.VALUE_CHANGED, _packet, prev)
+        return _packet
+
+    @instrument('save_many')
+    def save_many(self, packets):
+        """
+        Saves several packets taking each shard lock only once.
+
+        Returns a list with the saved packet, or the exception that
+        prevented saving it, for each item of packets.
+        """
+        results = []
+        for packet in packets:
+            try:
+                results.append(self._prepare(packet))
+            except (OSError, TypeError, ValueError) as e:
+                results.append(e)
 
-        _packet = Packet(packet.key, packet.payload)
+        groups = collections.OrderedDict()
+        for (pos, packet) in enumerate(results):
+            if isinstance(packet, Packet):
+                groups.setdefault(self.db.lock(packet.key), []).append(pos)
+
+        changes = []
+        for (lock, group) in groups.items():
+            with lock:
+                for pos in group:
+                    packet = results[pos]
+                    try:
+                        changes.append((packet, self._append(packet)))
+                    except (TypeError, ValueError) as e:
+                        results[pos] = e
+
+        for (packet, prev) in changes:
+            self._emit(events.Event.VALUE_CHANGED, packet, prev)
+
+        return results
+
+    def _prepare(self, packet):
+        _packet = Packet(packet.key, packet.payload, trusted=True)
+        rule = self.compression_rule(packet.key)
         for (name, fh) in packet.attachments.items():
-            aid = self.write(fh)
+            aid = self.write(fh, compress=rule)
             _packet.attachments[name] = aid
 
-        packets.insert(0, _packet)
-        dump = pickle.dumps(packets)
-
-        self.db[packet.key] = dump
         return _packet
 
-    def query(self, key, **params):
-        return []
+    def _append(self, packet):
+        """
+        Writes packet as the latest of its key. Returns the packet it
+        replaces when someone listens to VALUE_CHANGED, None otherwise.
+        """
+        try:
+            (first, next_) = self._head(packet.key)
+            new = False
+        except KeyError:
+            (first, next_) = (0, 0)
+            new = True
+
+        # Stamp under the shard lock, never before the latest record, so
+        # timestamps grow with record indexes as _window() expects
+        timestamp = datetime.datetime.utcnow()
+        if next_ > first:
+            timestamp = max(timestamp,
+                            self._record_meta(packet.key, next_ - 1)[0])
+        packet.timestamp = timestamp
+
+        prev = None
+        if next_ > first and self._listeners.get(events.Event.VALUE_CHANGED):
+            prev = self._latest(packet.key)
+
+        # Records at multiples of the interval are keyframes. Others diff
+        # against the previous record as decoded, never against a payload
+        # the caller may have modified since, see _latest().
+        base = None
+        interval = self.keyframe_interval(packet.key)
+        if interval and next_ > first and next_ % interval:
+            base = prev if prev is not None else self._latest(packet.key)
+
+        # Encode before writing anything, payloads that aren't JSON fail
+        # here. Count references first, an interrupted save leaks
+        # attachments instead of losing them. Then write the record before
+        # moving the head, an interrupted save leaves an unreachable record
+        # instead of a broken log.
+        raw = record.encode(packet, self.compression_rule(packet.key),
+                            base=base)
+        if new:
+            self._index(packet.key)
+
+        self._count_refs(list(packet.attachments.values()), 1)
+        self.db[self._record_key(packet.key, next_)] = raw
+        self._set_head(packet.key, first, next_ + 1)
+
+        # Cache what was stored rather than packet, its payload belongs to
+        # the caller
+        cached = record.decode(raw, base=base)
+
+        with self.lock:
+            self.cache.set(packet.key, cached)
+
+            if self._indexes_built or (
+                    self._indexed is not None and
+                    self.db.lock(packet.key) in self._indexed):
+                self._update_indexes(packet.key, packet)
+            elif self._saved is not None:
+                self._saved.add(packet.key)
+
+            if self.policy(packet.key):
+                self._dirty.add(packet.key)
+
+            self.changes.append(packet)
+
+        return prev
+
+    def connect(self, event, callback):
+        """
+        Calls callback(storage, packet, prev) on every event. Callbacks run
+        on the saving thread once the storage lock is released, they should
+        return quickly.
+        """
+        with self.lock:
+            callbacks = self._listeners.get(event, [])
+            self._listeners[event] = callbacks + [callback]
+
+    def disconnect(self, event, callback):
+        with self.lock:
+            callbacks = list(self._listeners.get(event, []))
+            callbacks.remove(callback)
+            self._listeners[event] = callbacks
+
+    def _emit(self, event, *args):
+        for callback in self._listeners.get(event, []):
+            try:
+                callback(self, *args)
+            except Exception:
+                _logger.exception("%s callback %r failed", event, callback)
+
+    @staticmethod
+    def _closest(settings, key):
+        parts = key.split('.')
+        for idx in range(len(parts), -1, -1):
+            value = settings.get('.'.join(parts[:idx]))
+            if value is not None:
+                return value
+
+        return None
+
+    def policy(self, key):
+        """
+        Returns the retention policy of the closest namespace of key
+        """
+        return self._closest(self.retention, key)
+
+    def compression_rule(self, key):
+        """
+        Returns the compression.Rule of the closest namespace of key
+        """
+        return self._closest(self.compression, key)
+
+    def keyframe_interval(self, key):
+        """
+        Returns the delta keyframe interval of the closest namespace of key,
+        None if key isn't delta encoded
+        """
+        return self._closest(self.delta, key)
+
+    @instrument('prune')
+    def prune(self, key, policy=None, now=None, chunk=100):
+        """
+        Drops the records of key that fall out of its retention policy.
+
+        The head is moved first so readers never see a dropped record, then
+        the records are deleted in chunks releasing the lock in between to
+        let writers go on. Returns the number of dropped records.
+        """
+        if policy is None:
+            policy = self.policy(key)
+
+        if not policy:
+            return 0
+
+        with self.db.lock(key):
+            (first, next_) = self._head(key)
+            records = (self._record_meta(key, idx)
+                       for idx in range(next_ - 1, first - 1, -1))
+            keep = next_ - policy.retained(records, now=now)
+
+            if keep == first:
+                return 0
+
+            # The new first record can't be a delta, its base is dropped
+            rkey = self._record_key(key, keep)
+            raw = self.db[rkey]
+            if record.is_record(raw) and record.is_delta(raw):
+                self.db[rkey] = record.encode(self._record(key, keep),
+                                              self.compression_rule(key))
+
+            self._set_head(key, keep, next_)
+
+        for offset in range(first, keep, chunk):
+            with self.db.lock(key):
+                aids = []
+                for idx in range(offset, min(offset + chunk, keep)):
+                    aids.extend(self._record_attachments(key, idx))
+                    del self.db[self._record_key(key, idx)]
+
+                self._count_refs(aids, -1)
+
+        return keep - first
+
+    @instrument('compact')
+    def compact(self, limit=None):
+        """
+        Prunes up to limit keys saved since the last call
+        """
+        with self.lock:
+            keys = list(self._dirty)[:limit]
+            self._dirty.difference_update(keys)
+
+        return sum(self.prune(key) for key in keys)
+
+    @instrument('collect')
+    def collect(self, limit=100, grace=None, dry_run=False):
+        """
+        Deletes up to limit attachments no record references anymore and
+        staged uploads abandoned for more than grace seconds, self.grace by
+        default. Returns the number of deleted files and the reclaimed
+        bytes, with dry_run nothing is deleted and the returned figures are
+        what would be.
+
+        Attachments written in the last grace seconds are left alone, their
+        packets may not be saved yet. Each file is deleted holding the
+        locks on its own so saves go on meanwhile.
+        """
+        if grace is None:
+            grace = self.grace
+
+        now = time.monotonic()
+        with self.lock:
+            expired = [aid for (aid, written) in self._written.items()
+                       if now - written >= grace]
+
+        # Written and never referenced, ex: the save failed
+        with self.db.lock(self._ref_key('')):
+            queued = self._orphans()
+            known = set(queued)
+            unreferenced = [x for x in expired if x not in known and
+                            self._ref_key(x) not in self.db]
+            queued = queued + unreferenced
+
+            if not dry_run:
+                self._queue_orphans(unreferenced)
+                with self.lock:
+                    for aid in expired:
+                        written = self._written.get(aid)
+                        if written is not None and now - written >= grace:
+                            del self._written[aid]
+
+        (count, size) = self._collect_staging(grace, dry_run)
+        for aid in queued[:limit]:
+            with self.db.lock(self._ref_key('')), self.lock:
+                if not dry_run:
+                    self._unqueue_orphan(aid)
+
+                if self._ref_key(aid) in self.db or \
+                   now - self._written.get(aid, now - grace) < grace:
+                    # Referenced or written again meanwhile
+                    continue
+
+                try:
+                    stat = os.stat(self.path(aid))
+                    if self.shared and time.time() - stat.st_mtime < grace:
+                        # Written again by another process, see _touch()
+                        continue
+
+                    nbytes = stat.st_size
+                    if not dry_run:
+                        os.unlink(self.path(aid))
+                except FileNotFoundError:
+                    continue
 
-    def backlog(self, key, start=0, end=100):
-        dbdump = self.db[key]
-        packets = pickle.loads(dbdump)
+            count = count + 1
+            size = size + nbytes
 
-        return packets[start:end]
+        if not dry_run:
+            with self.lock:
+                self.attachment_stats['reclaimed'] += count
+                self.attachment_stats['reclaimed_bytes'] += size
 
-    def open(self, aid, flags='rb'):
-        dest = "{d}/{a}/{a}{b}/{f}".format(
+        return (count, size)
+
+    def _collect_staging(self, grace, dry_run):
+        count = 0
+        size = 0
+        for entry in os.scandir(self.staging):
+            try:
+                stat = entry.stat()
+                if time.time() - stat.st_mtime < grace:
+                    continue
+
+                if not dry_run:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                continue
+
+            count = count + 1
+            size = size + stat.st_size
+
+        return (count, size)
+
+    def _walk(self, namespace):
+        """
+        Yields every name below namespace, namespaces without packets
+        included
+        """
+        pending = [namespace]
+        while pending:
+            ns = pending.pop()
+            for name in self._node(ns):
+                key = ns + '.' + name if ns else name
+                yield key
+                pending.append(key)
+
+    def _update_indexes(self, key, packet):
+        for index in self.indexes:
+            if index.covers(key):
+                index.update(key, packet.payload)
+
+    def _build_indexes(self):
+        """
+        Indexes the stored keys shard by shard, saves only wait for the
+        shard being indexed. Saves to indexed shards update the indexes as
+        usual, keys saved to the others meanwhile are indexed with their
+        shard.
+
+        Once built, only the shards other processes changed are indexed
+        again.
+        """
+        if not self.indexes or (self._indexes_built and not self.shared):
+            return
+
+        with self._build_lock:
+            shards = self.db.shards
+            if self._indexes_built:
+                shards = [x for x in shards
+                          if x in self._stale or x.outdated()]
+
+            if not shards:
+                return
+
+            with self.lock:
+                (self._indexed, self._saved) = (set(), set())
+
+            keys = set(key
+                       for ns in set(x.namespace for x in self.indexes)
+                       for key in self._walk(ns))
+            try:
+                for shard in shards:
+                    with shard:
+                        with self.lock:
+                            # Read from now on, see _changed()
+                            self._stale.discard(shard)
+                            pending = [x for x in keys | self._saved
+                                       if self.db.lock(x) is shard]
+
+                        for key in pending:
+                            try:
+                                packet = self._latest(key)
+                            except KeyError:
+                                continue
+
+                            with self.lock:
+                                self._update_indexes(key, packet)
+
+                        with self.lock:
+                            self._indexed.add(shard)
+
+                with self.lock:
+                    self._indexes_built = True
+            finally:
+                with self.lock:
+                    (self._indexed, self._saved) = (None, None)
+
+    def _find_index(self, namespace, path):
+        for index in self.indexes:
+            if index.path == path and (
+                    index.namespace == namespace or
+                    index.covers(namespace + '.')):
+                return index
+
+        return None
+
+    @instrument('query')
+    def query(self, namespace='', **params):
+        """
+        Returns the latest packet of every key below namespace whose payload
+        matches the predicates in params, see gcd.query. Results are sorted
+        by key.
+
+        Predicates on indexed fields are answered by the index, the
+        remaining ones are checked against the latest packet of each
+        candidate key.
+        """
+        if namespace:
+            Packet.validate_key(namespace)
+
+        predicates = query.parse(params)
+
+        self._build_indexes()
+
+        keys = None
+        pending = []
+        with self.lock:
+            for predicate in predicates:
+                index = self._find_index(namespace, predicate.path)
+                matched = index.candidates(predicate) if index else None
+                if matched is None:
+                    pending.append(predicate)
+                elif keys is None:
+                    keys = matched
+                else:
+                    keys = keys & matched
+
+        if keys is None:
+            keys = self._walk(namespace)
+        elif namespace:
+            keys = (x for x in keys if x.startswith(namespace + '.'))
+
+        results = []
+        for key in sorted(keys):
+            try:
+                with self.db.lock(key):
+                    packet = self._latest(key)
+            except KeyError:
+                continue
+
+            if all(x.match(query.lookup(packet.payload, x.path))
+                   for x in pending):
+                results.append(self._copy(packet))
+
+        return results
+
+    def _window(self, key, first, next_, since=None, until=None):
+        """
+        Narrows the [first, next_) record range of key to the records saved
+        since <= timestamp < until.
+
+        Saves stamp packets with the current time so timestamps grow with
+        record indexes, a binary search reading only record headers finds
+        the bounds.
+        """
+        def timestamp(idx):
+            return self._record_meta(key, idx)[0]
+
+        lo = first
+        if since is not None:
+            lo = utils.lower_bound(first, next_, timestamp, since)
+
+        hi = next_
+        if until is not None:
+            hi = utils.lower_bound(lo, next_, timestamp, until)
+
+        return (lo, hi)
+
+    @instrument('backlog')
+    def backlog(self, key, start=0, end=100, since=None, until=None):
+        """
+        Returns key's packets from start to end, newest first. With since
+        and until offsets count from the newest packet in that time range.
+        """
+        with self.db.lock(key):
+            (first, next_) = self._window(key, *self._head(key),
+                                          since=since, until=until)
+
+            # Records are numbered from oldest to newest, backlog goes
+            # backwards
+            top = next_ - 1 - start
+            bottom = max(first, next_ - end)
+
+            return list(reversed(self._records(key, bottom, top + 1)))
+
+    @instrument('page')
+    def page(self, key, cursor=None, limit=100, since=None, until=None):
+        """
+        Returns up to limit packets of key's backlog starting at cursor and
+        the cursor for the next page, None once the oldest packet is reached.
+        since and until restrict the backlog to a time range as in backlog().
+
+        Cursors point to records, unlike backlog() offsets they keep pages
+        stable while new packets are being saved.
+        """
+        if limit < 1:
+            raise ValueError(limit, "limit must be positive")
+
+        if cursor is not None:
+            cursor = int(cursor)
+
+        with self.db.lock(key):
+            (first, next_) = self._window(key, *self._head(key),
+                                          since=since, until=until)
+
+            top = next_ - 1 if cursor is None else min(cursor, next_ - 1)
+            bottom = max(first, top - limit + 1)
+
+            packets = list(reversed(self._records(key, bottom, top + 1)))
+
+        next_cursor = str(bottom - 1) if bottom > first else None
+        return (packets, next_cursor)
+
+    def path(self, aid):
+        return "{d}/{a}/{a}{b}/{f}".format(
             d=self.attachments,
             a=aid[0],
             b=aid[1],
             f=aid)
 
-        return open(dest, flags)
+    @instrument('attachment_open')
+    def open_raw(self, aid):
+        """
+        Opens the attachment file as stored. Returns the file, positioned at
+        the start of the contents, their codec, None if stored as they are,
+        and their decoded size.
+        """
+        fh = open(self.path(aid), 'rb')
+        try:
+            (codec, size) = compression.read_header(fh)
+        except Exception:
+            fh.close()
+            raise
+
+        if codec is None:
+            size = os.fstat(fh.fileno()).st_size
 
+        return (fh, codec, size)
+
+    def open(self, aid):
+        """
+        Opens the attachment for reading its decoded contents
+        """
+        (fh, codec, size) = self.open_raw(aid)
+        if codec is None:
+            return fh
+
+        return compression.DecodedFile(fh, codec)
+
+    @instrument('attachment_read')
     def read(self, aid):
         with self.open(aid) as fh:
             return fh.read()
 
-    def write(self, fh):
+    @instrument('attachment_write')
+    def write(self, fh, compress=None):
+        """
+        Stores the contents of fh as an attachment and returns its aid.
+
+        Seekable files are hashed before writing anything so already stored
+        contents cost no disk writes at all, new ones are read again to stage
+        them in their stored form. Other streams are staged inside the
+        datadir while hashing. Storing is then a rename on the same
+        filesystem to the path named after the hash.
+
+        New contents are compressed as stated by the compress
+        compression.Rule if it is worth it. The aid is always the hash of
+        the decoded contents.
+        """
         digest = hashlib.sha1()
+        seekable = self._seekable(fh)
 
-        tf = tempfile.NamedTemporaryFile(delete=False)
-        while True:
-            buff = fh.read(4*1024*1024)
-            if not buff:
-                break
+        if seekable:
+            (staged, start, size) = (None, fh.tell(), 0)
+            while True:
+                buff = fh.read(4*1024*1024)
+                if not buff:
+                    break
 
-            digest.update(buff)
-            tf.write(buff)
-        tf.close()
+                digest.update(buff)
+                size = size + len(buff)
+        else:
+            staged = self._stage(_Hashing(fh, digest))
+            size = os.path.getsize(staged)
 
         aid = digest.hexdigest()
-        dest = "{d}/{a}/{a}{b}".format(
-            d=self.attachments,
-            a=aid[0],
-            b=aid[1])
-        os.makedirs(dest, exist_ok=True)
-        dest = dest + "/" + aid
+        dest = self.path(aid)
+
+        # Keeps collect() from deleting the file from now on, until the
+        # packet referencing it is saved
+        self._pin(aid)
+
+        if self._touch(dest):
+            if staged:
+                os.unlink(staged)
 
-        shutil.move(tf.name, dest)
+            self._count_write('deduplicated', size)
+            return aid
+
+        if seekable:
+            fh.seek(start)
+            staged = self._encode(fh, size, compress)
+            if staged is None:
+                fh.seek(start)
+                staged = self._stage(fh)
+        else:
+            with open(staged, 'rb') as src:
+                encoded = self._encode(src, size, compress)
+
+            if encoded is not None:
+                os.unlink(staged)
+                staged = encoded
+
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(staged, dest)
+
+        self._count_write('written', size)
         return aid
 
+    def _pin(self, aid):
+        """
+        Records that aid was just written. Records older than grace are
+        dropped meanwhile, as collect() would, so they don't pile up when
+        it doesn't run: their attachments are queued for it unless
+        referenced.
+        """
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            self._written.pop(aid, None)
+            self._written[aid] = now
+            for (written_aid, written) in self._written.items():
+                if written_aid == aid or now - written < self.grace:
+                    break
+
+                expired.append(written_aid)
+
+            for written_aid in expired:
+                del self._written[written_aid]
+
+        if expired:
+            with self.db.lock(self._ref_key('')):
+                self._queue_orphans(
+                    x for x in expired if self._ref_key(x) not in self.db)
+
+    def _touch(self, path):
+        """
+        Returns whether the attachment file exists. In shared datadirs it
+        is also touched, under the lock collect() deletes with, as other
+        processes only know it was written again from its modification
+        time.
+        """
+        if not self.shared:
+            return os.path.exists(path)
+
+        with self.db.lock(self._ref_key('')):
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                return False
+
+        return True
+
+    def _stage(self, src, codec=None, size=None):
+        """
+        Copies src to a staging file, encoded with codec behind an
+        attachment header if given. Returns the staged path.
+        """
+        with tempfile.NamedTemporaryFile(dir=self.staging,
+                                         delete=False) as staged:
+            if codec is None:
+                shutil.copyfileobj(src, staged, 4*1024*1024)
+            else:
+                staged.write(compression.header(codec, size))
+                with codec.open(staged, 'wb') as out:
+                    shutil.copyfileobj(src, out, 4*1024*1024)
+
+        return staged.name
+
+    def _encode(self, src, size, compress):
+        """
+        Stages the contents of the seekable src in their stored form if it
+        differs from the contents themselves: compressed, or behind an
+        identity header when they start like an attachment header. Returns
+        the staged path, None when the contents are stored as they are.
+        """
+        start = src.tell()
+        if compress and compress.applies(size):
+            path = self._stage(src, compress.codec, size)
+            if os.path.getsize(path) < size:
+                return path
+
+            # Incompressible, ex: already compressed files
+            os.unlink(path)
+            src.seek(start)
+
+        magic = src.read(len(compression.MAGIC))
+        src.seek(start)
+        if magic == compression.MAGIC:
+            return self._stage(src, compression.IDENTITY, size)
+
+        return None
+
+    @staticmethod
+    def _seekable(fh):
+        try:
+            return fh.seekable()
+        except AttributeError:
+            return False
+
+    def _count_write(self, kind, size):
+        with self.lock:
+            self.attachment_stats[kind] += 1
+            self.attachment_stats[kind + '_bytes'] += size
+
+    def _collect(self):
+        stats = self.attachment_stats
+        for kind in ('written', 'deduplicated', 'reclaimed'):
+            yield ('gcd_attachments_total', 'counter', {'kind': kind},
+                   stats[kind])
+            yield ('gcd_attachment_bytes_total', 'counter', {'kind': kind},
+                   stats[kind + '_bytes'])
+
+        cache = self.cache.stats()
+        yield ('gcd_cache_requests_total', 'counter', {'result': 'hit'},
+               cache['hits'])
+        yield ('gcd_cache_requests_total', 'counter', {'result': 'miss'},
+               cache['misses'])
+        yield ('gcd_cache_size', 'gauge', {}, cache['size'])
+
+
+class FileResponse(apistar.http.Response):
+    """
+    Response with length bytes of an open file starting at offset as body.
+
+    The file is never read as a whole. WSGI servers get bodies that run up
+    to the end of the file through their wsgi.file_wrapper, ASGI servers
+    offering the zero-copy send extension get any range of a plain file,
+    both may send them with sendfile. Anything else, files decoded on the
+    fly included, is streamed in chunks: werkzeug's debug server and
+    uvicorn offer neither.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, fh, offset, length, status_code=200, headers=None):
+        self.fh = fh
+        self.offset = offset
+        self.length = length
+
+        headers = dict(headers or {})
+        headers['Content-Length'] = str(length)
+        super().__init__(b'', status_code=status_code, headers=headers)
+
+    def plain(self):
+        # Whether the body is stored as is in a file with a descriptor
+        try:
+            self.fh.fileno()
+        except io.UnsupportedOperation:
+            return False
+
+        return True
+
+    def to_end(self):
+        if not self.plain():
+            return False
+
+        size = os.fstat(self.fh.fileno()).st_size
+        return self.offset + self.length == size
+
+    def iter_content(self):
+        try:
+            self.fh.seek(self.offset)
+            remaining = self.length
+            while remaining:
+                buff = self.fh.read(min(self.chunk_size, remaining))
+                if not buff:
+                    break
+
+                remaining = remaining - len(buff)
+                yield buff
+        finally:
+            self.fh.close()
+
 
 class StorageServer(apistar.App):
     def __init__(self, storage, *args, **kwargs):
         routes = [
             apistar.Route(
                 '/packets',
-                method='GET', handler=self.children, name='list_rootns'),
+                method='GET', handler=self.handler(self.children),
+                name='list_rootns'),
+            apistar.Route(
+                '/packets',
+                method='POST', handler=self.handler(self.save_many),
+                name='save_packets'),
             apistar.Route(
                 '/packet/{key}',
-                method='GET', handler=self.get, name='get_packet'),
+                method='GET', handler=self.handler(self.get),
+                name='get_packet'),
             apistar.Route(
                 '/packet/{key}',
-                method='POST', handler=self.save, name='save_packet'),
+                method='POST', handler=self.handler(self.save),
+                name='save_packet'),
             apistar.Route(
                 '/packet/{ns}/children',
-                method='GET', handler=self.children, name='list_packet_children'),
+                method='GET', handler=self.handler(self.children),
+                name='list_packet_children'),
+            apistar.Route(
+                '/query',
+                method='GET', handler=self.handler(self.query),
+                name='query_rootns'),
+            apistar.Route(
+                '/packet/{ns}/query',
+                method='GET', handler=self.handler(self.query),
+                name='query_packets'),
+            apistar.Route(
+                '/watch',
+                method='GET', handler=self.handler(self.watch),
+                name='watch_rootns'),
+            apistar.Route(
+                '/packet/{ns}/watch',
+                method='GET', handler=self.handler(self.watch),
+                name='watch_packets'),
             apistar.Route(
                 '/packet/{key}/backlog',
-                method='GET', handler=self.backlog, name='packet_backlog'),
+                method='GET', handler=self.handler(self.backlog),
+                name='packet_backlog'),
             apistar.Route(
                 '/attachment/{aid}',
-                method='GET', handler=self.attachment, name='get_attachment'),
+                method='GET', handler=self.handler(self.attachment),
+                name='get_attachment'),
+            apistar.Route(
+                '/metrics',
+                method='GET', handler=self.handler(self.render_metrics),
+                name='metrics'),
         ]
         super().__init__(*args, routes=routes, **kwargs)
         self.storage = storage
+        self.metrics = storage.metrics
+        self.max_watch_timeout = 60
+
+    def route_name(self, path, method):
+        try:
+            (route, _) = self.router.lookup(path, method)
+        except apistar.exceptions.HTTPException:
+            return 'unmatched'
+
+        return route.name
+
+    def observe_request(self, route, method, status, elapsed,
+                        request_bytes, response_bytes):
+        """
+        Records a served request, elapsed is the time until the response
+        headers were sent
+        """
+        self.metrics.inc('gcd_http_requests_total', route=route,
+                         method=method, status=status)
+        self.metrics.observe('gcd_http_request_seconds', elapsed,
+                             route=route)
+        self.metrics.inc('gcd_http_request_bytes_total', request_bytes,
+                         route=route)
+        self.metrics.inc('gcd_http_response_bytes_total', response_bytes,
+                         route=route)
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        method = environ['REQUEST_METHOD'].upper()
+        route = self.route_name(environ['PATH_INFO'], method)
+        sent = {}
+
+        def _start_response(status, headers, *exc_info):
+            sent['status'] = status.split(' ', 1)[0]
+            sent['length'] = dict(
+                (k.lower(), v) for (k, v) in headers).get('content-length')
+            return start_response(status, headers, *exc_info)
+
+        try:
+            return super().__call__(environ, _start_response)
+        finally:
+            self.observe_request(
+                route, method, sent.get('status', '500'),
+                time.perf_counter() - start,
+                int(environ.get('CONTENT_LENGTH') or 0),
+                int(sent.get('length') or 0))
+
+    def handler(self, fn):
+        """
+        Adapts a route handler to the server flavour
+        """
+        return fn
 
     def serialize(self, packet):
         return {
             'key': packet.key,
             'payload': packet.payload,
-            'timestamp': str(packet.timestamp),
+            'timestamp': format_timestamp(packet.timestamp),
             'attachments': {
                 name: self.reverse_url('get_attachment', aid=aid)
                 for (name, aid) in packet.attachments.items()
             }
         }
 
-    def get(self, key) -> dict:
-        packet = self.storage.get(key)
-        return self.serialize(packet)
-
     def save(self, key,
              content_type: apistar.http.Header,
              data: apistar.http.RequestData) -> dict:
@@ -182,44 +1421,651 @@ class StorageServer(apistar.App):
         pckt = self.storage.save(pckt)
         return self.serialize(pckt)
 
+    def save_many(self,
+                  content_type: apistar.http.Header,
+                  body: apistar.http.Body) -> list:
+        """
+        Saves a batch of packets from a JSON array or NDJSON body of
+        {"key": ..., "payload": ...} objects.
+
+        Multipart bodies carry the array in the 'packets' field and the
+        attachments of the N-th packet as 'attachment:N:name' files.
+
+        Responds with one item per packet, either the saved packet or an
+        {"error": ...} object.
+        """
+        (content_type, options) = \
+            werkzeug.http.parse_options_header(content_type)
+        files = {}
+
+        try:
+            if content_type == 'application/json':
+                items = json.loads(body.decode('utf-8'))
+
+            elif content_type in ('application/x-ndjson',
+                                  'application/jsonlines'):
+                items = [json.loads(line)
+                         for line in body.decode('utf-8').splitlines()
+                         if line.strip()]
+
+            elif content_type == 'multipart/form-data':
+                (_, form, files) = werkzeug.formparser.FormDataParser().parse(
+                    io.BytesIO(body), content_type, len(body), options)
+                if 'packets' in form:
+                    items = json.loads(form['packets'])
+                else:
+                    items = json.loads(files['packets'].stream.read())
+
+            else:
+                raise apistar.exceptions.UnsupportedMediaType()
+
+        except (KeyError, ValueError) as e:
+            raise apistar.exceptions.BadRequest("invalid batch") from e
+
+        if not isinstance(items, list):
+            raise apistar.exceptions.BadRequest("expected a list of packets")
+
+        attachments = {}
+        for (name, f) in files.items():
+            (prefix, idx, name) = (name.split(':', 2) + ['', ''])[:3]
+            if prefix == 'attachment' and idx.isdigit():
+                attachments.setdefault(int(idx), {})[name] = f.stream
+
+        packets = []
+        for (idx, item) in enumerate(items):
+            try:
+                packets.append(Packet(item['key'], item['payload'],
+                                      attachments=attachments.get(idx)))
+            except (KeyError, TypeError, ValueError) as e:
+                packets.append(e)
+
+        pending = [x for x in packets if isinstance(x, Packet)]
+        saved = iter(self.storage.save_many(pending))
+
+        results = []
+        for packet in packets:
+            if isinstance(packet, Packet):
+                packet = next(saved)
+
+            if isinstance(packet, Exception):
+                results.append({'error': repr(packet)})
+            else:
+                results.append(self.serialize(packet))
+
+        return results
+
     @utils.unroll
     def children(self, ns='') -> list:
-        for key in self.storage.list(ns):
+        for name in self.storage.list(ns):
+            key = ns + '.' + name if ns else name
             yield {
-                'key': key,
-                'uri': self.reverse_url('get_packet', key=key)
+                'key': name,
+                'uri': self.reverse_url('get_packet', key=key),
+                'children': self.storage.count(key)
             }
 
-    def get(self, key) -> dict:
-        return self.storage.get(key).asdict()
+    def get(self, key,
+            if_none_match: apistar.http.Header,
+            if_modified_since: apistar.http.Header) -> apistar.http.Response:
+        """
+        Latest packet of key. The ETag comes from its record index and
+        timestamp, Last-Modified from its timestamp, conditional requests
+        get a 304 until a new packet is saved.
+        """
+        (idx, packet) = self.storage.latest(key)
 
-    def query(self) -> list:
-        return []
+        # Consecutive packets may share a timestamp but not an index, the
+        # timestamp tells apart logs pruned and saved again
+        micros = (packet.timestamp - EPOCH) // datetime.timedelta(
+            microseconds=1)
+        etag = '"{}-{}"'.format(idx, micros)
+        headers = {
+            'ETag': etag,
+            'Last-Modified': werkzeug.http.http_date(packet.timestamp)
+        }
 
-    @utils.unroll
-    def backlog(self, key) -> list:
-        for packet in self.storage.backlog(key):
-            yield {
+        if self.not_modified(etag, if_none_match, packet.timestamp,
+                             if_modified_since):
+            return apistar.http.Response(b'', status_code=304,
+                                         headers=headers)
+
+        return apistar.http.JSONResponse(packet.asdict(), headers=headers)
+
+    @staticmethod
+    def not_modified(etag, if_none_match, modified=None,
+                     if_modified_since=None):
+        """
+        Evaluates conditional request headers, If-Modified-Since only
+        counts without If-None-Match
+        """
+        if if_none_match:
+            tags = [x.strip() for x in if_none_match.split(',')]
+            tags = [x[2:] if x.startswith('W/') else x for x in tags]
+            return '*' in tags or etag in tags
+
+        if if_modified_since and modified is not None:
+            since = werkzeug.http.parse_date(if_modified_since)
+            # HTTP dates have no fractions of a second
+            return since is not None and \
+                modified.replace(microsecond=0) <= since
+
+        return False
+
+    def watch_params(self, cursor, timeout):
+        # The change log only has the saves of this process
+        if self.storage.shared:
+            raise apistar.exceptions.HTTPException(
+                "watches aren't available on shared datadirs",
+                status_code=501)
+
+        try:
+            cursor = self.storage.changes.seq if not cursor else int(cursor)
+            timeout = min(float(timeout or 30), self.max_watch_timeout)
+        except ValueError as e:
+            raise apistar.exceptions.BadRequest(
+                "invalid cursor or timeout") from e
+
+        return (cursor, max(timeout, 0))
+
+    def watch_result(self, packets, cursor, missed):
+        return {
+            'cursor': str(cursor),
+            'missed': missed,
+            'packets': [self.serialize(x) for x in packets]
+        }
+
+    def watch(self,
+              cursor: apistar.http.QueryParam,
+              timeout: apistar.http.QueryParam,
+              ns='') -> dict:
+        """
+        Long-polls for packets saved under ns, a key or a namespace, after
+        cursor. Responds as soon as there are some or after timeout seconds
+        with the packets and the cursor to pass on the next call.
+
+        Without cursor only packets saved from now on are returned. missed
+        is true if the server no longer has some of the changes after
+        cursor.
+        """
+        (cursor, timeout) = self.watch_params(cursor, timeout)
+        return self.watch_result(
+            *self.storage.changes.wait(cursor, ns, timeout=timeout))
+
+    def render_metrics(self) -> apistar.http.Response:
+        return apistar.http.Response(
+            self.metrics.render(),
+            headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+    def query(self, params: apistar.http.QueryParams, ns='') -> list:
+        """
+        Latest packets below ns matching the predicates in the query string,
+        ex: ?result__code__ne=0. Values are parsed as JSON, falling back to
+        plain strings.
+        """
+        def load(value):
+            try:
+                return json.loads(value)
+            except ValueError:
+                return value
+
+        predicates = {name: load(value) for (name, value) in params.items()}
+        try:
+            packets = self.storage.query(ns, **predicates)
+        except ValueError as e:
+            raise apistar.exceptions.BadRequest("invalid query") from e
+
+        return [self.serialize(x) for x in packets]
+
+    def backlog(self, key,
+                cursor: apistar.http.QueryParam,
+                limit: apistar.http.QueryParam,
+                since: apistar.http.QueryParam,
+                until: apistar.http.QueryParam) -> list:
+        """
+        Pages of key's backlog, newest first. since and until restrict it to
+        packets saved in that time range, as timestamps or epoch seconds.
+        """
+        try:
+            limit = min(int(limit or 100), 1000)
+            (packets, next_cursor) = self.storage.page(
+                key, cursor=cursor, limit=limit,
+                since=parse_timestamp(since) if since else None,
+                until=parse_timestamp(until) if until else None)
+        except ValueError as e:
+            raise apistar.exceptions.BadRequest(
+                "invalid cursor, limit or time range") from e
+
+        data = [
+            {
                 'payload': packet.payload,
-                'timestamp': str(packet.timestamp),
+                'timestamp': format_timestamp(packet.timestamp),
             }
+            for packet in packets
+        ]
 
-    def attachment(self, aid):
-        return
+        headers = {}
+        if next_cursor is not None:
+            params = [('cursor', next_cursor), ('limit', limit)]
+            params.extend((name, value)
+                          for (name, value) in [('since', since),
+                                                ('until', until)]
+                          if value)
+            url = '{}?{}'.format(
+                self.reverse_url('packet_backlog', key=key),
+                urllib.parse.urlencode(params))
+            headers['Link'] = '<{}>; rel="next"'.format(url)
 
-def main():
+        return apistar.http.JSONResponse(data, headers=headers)
+
+    def attachment(self, aid,
+                   range: apistar.http.Header,
+                   if_none_match: apistar.http.Header,
+                   accept_encoding: apistar.http.Header) -> FileResponse:
+        """
+        Serves an attachment, ranges included. Compressed attachments are
+        sent as stored, with their Content-Encoding, to clients accepting
+        it and decoded on the fly for the others.
+        """
+        if not self.storage.isaid(aid):
+            raise apistar.exceptions.NotFound()
+
+        try:
+            (fh, codec, size) = self.storage.open_raw(aid)
+        except FileNotFoundError as e:
+            raise apistar.exceptions.NotFound() from e
+
+        # Attachments are content addressed, the aid is a strong ETag of
+        # the decoded contents
+        etag = '"{}"'.format(aid)
+        headers = {
+            'Accept-Ranges': 'bytes',
+            'Content-Type': 'application/octet-stream'
+        }
+
+        encoding = codec.content_encoding if codec else None
+        if encoding:
+            headers['Vary'] = 'Accept-Encoding'
+
+        # Ranges are over the decoded contents, they are always decoded
+        passthrough = encoding and not range and \
+            werkzeug.http.parse_accept_header(
+                accept_encoding or '').quality(encoding) > 0
+        if passthrough:
+            etag = '"{}-{}"'.format(aid, encoding)
+            headers['Content-Encoding'] = encoding
+
+        headers['ETag'] = etag
+
+        if self.not_modified(etag, if_none_match):
+            fh.close()
+            return apistar.http.Response(b'', status_code=304,
+                                         headers=headers)
+
+        if passthrough:
+            offset = fh.tell()
+            return FileResponse(fh, offset,
+                                os.fstat(fh.fileno()).st_size - offset,
+                                headers=headers)
+
+        if codec is not None:
+            fh = compression.DecodedFile(fh, codec)
+
+        try:
+            span = utils.parse_range(range, size)
+        except ValueError:
+            fh.close()
+            headers['Content-Range'] = 'bytes */{}'.format(size)
+            return apistar.http.Response(b'', status_code=416,
+                                         headers=headers)
+
+        if span is None:
+            return FileResponse(fh, 0, size, headers=headers)
+
+        (first, last) = span
+        headers['Content-Range'] = 'bytes {}-{}/{}'.format(first, last, size)
+        return FileResponse(fh, first, last - first + 1, status_code=206,
+                            headers=headers)
+
+    def finalize_wsgi(self, response,
+                      start_response: WSGIStartResponse,
+                      environ: WSGIEnviron):
+        if not isinstance(response, FileResponse):
+            return super().finalize_wsgi(response, start_response)
+
+        start_response(
+            RESPONSE_STATUS_TEXT[response.status_code],
+            list(response.headers)
+        )
+
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None and response.to_end():
+            response.fh.seek(response.offset)
+            return file_wrapper(response.fh, response.chunk_size)
+
+        return response.iter_content()
+
+
+class AsyncStorageServer(StorageServer, apistar.ASyncApp):
+    """
+    ASGI flavour of StorageServer.
+
+    Route handlers run on a pool of threads so blocking dbm and file I/O
+    never stalls the event loop.
+    """
+    def __init__(self, storage, *args, threads=8, **kwargs):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads)
+        super().__init__(storage, *args, **kwargs)
+
+        # ns -> asyncio.Event set by the next save under ns. A single
+        # storage listener, connected by the first watch, wakes the
+        # watches of every namespace.
+        self._watchers = {}
+        self._waiting = collections.Counter()
+        self._loop = None
+        self._listening = False
+
+    def handler(self, fn):
+        if asyncio.iscoroutinefunction(fn):
+            return fn
+
+        async def _wrap(*args, **kwargs):
+            return await self.run_in_executor(fn, *args, **kwargs)
+
+        # apistar injects arguments based on the handler's signature
+        _wrap.__name__ = fn.__name__
+        _wrap.__signature__ = inspect.signature(fn)
+        return _wrap
+
+    def __call__(self, scope):
+        app = apistar.ASyncApp.__call__(self, scope)
+        method = scope['method'].upper()
+        route = self.route_name(scope['path'], method)
+        request_bytes = int(dict(scope['headers']).get(
+            b'content-length', 0))
+
+        async def _wrap(receive, send):
+            start = time.perf_counter()
+            sent = {}
+
+            async def _send(message):
+                if message['type'] == 'http.response.start':
+                    sent['status'] = str(message['status'])
+                    sent['elapsed'] = time.perf_counter() - start
+                    sent['length'] = dict(
+                        (bytes(k).lower(), v)
+                        for (k, v) in message['headers']).get(
+                            b'content-length')
+
+                await send(message)
+
+            try:
+                await app(receive, _send)
+            finally:
+                self.observe_request(
+                    route, method, sent.get('status', '500'),
+                    sent.get('elapsed', time.perf_counter() - start),
+                    request_bytes, int(sent.get('length') or 0))
+
+        return _wrap
+
+    async def watch(self,
+                    cursor: apistar.http.QueryParam,
+                    timeout: apistar.http.QueryParam,
+                    ns='') -> dict:
+        # Waits on the event loop instead of holding one of the I/O threads
+        # for the whole long-poll
+        (cursor, timeout) = self.watch_params(cursor, timeout)
+        loop = asyncio.get_event_loop()
+        if loop is not self._loop:
+            # Events bind to the loop they are used in
+            (self._loop, self._watchers) = (loop, {})
+            self._waiting.clear()
+
+        if not self._listening:
+            self._listening = True
+            self.storage.connect(events.Event.VALUE_CHANGED, self._wake)
+
+        deadline = loop.time() + timeout
+        while True:
+            # Waited on before looking for changes, saves from then on
+            # set it
+            changed = self._watchers.setdefault(ns, asyncio.Event())
+            (packets, seq, missed) = self.storage.changes.since(cursor, ns)
+            remaining = deadline - loop.time()
+            if packets or missed or remaining <= 0:
+                if not self._waiting[ns] and \
+                   self._watchers.get(ns) is changed:
+                    del self._watchers[ns]
+
+                return self.watch_result(packets, seq, missed)
+
+            self._waiting[ns] += 1
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._waiting[ns] -= 1
+                if not self._waiting[ns]:
+                    del self._waiting[ns]
+
+    def _wake(self, storage, packet, prev):
+        # Runs on the saving thread
+        loop = self._loop
+        if self._watchers and not loop.is_closed():
+            loop.call_soon_threadsafe(self._notify, packet.key)
+
+    def _notify(self, key):
+        for ns in [x for x in self._watchers if events.matches(key, x)]:
+            self._watchers.pop(ns).set()
+
+    async def run_in_executor(self, fn, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(fn, *args, **kwargs))
+
+    async def finalize_asgi(self, response, send: ASGISend,
+                            scope: ASGIScope):
+        if not isinstance(response, FileResponse):
+            return await super().finalize_asgi(response, send)
+
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': [
+                [key.encode(), value.encode()]
+                for key, value in response.headers
+            ]
+        })
+
+        extensions = scope.get('extensions') or {}
+        if ZERO_COPY_SEND in extensions and response.plain():
+            try:
+                await send({
+                    'type': ZERO_COPY_SEND,
+                    'file': response.fh,
+                    'offset': response.offset,
+                    'count': response.length,
+                    'more_body': False
+                })
+            finally:
+                response.fh.close()
+
+            return
+
+        # Read one chunk ahead so the last one goes out flagged as such
+        chunks = response.iter_content()
+        buff = await self.run_in_executor(next, chunks, b'')
+        while True:
+            following = await self.run_in_executor(next, chunks, None)
+            await send({
+                'type': 'http.response.body',
+                'body': buff,
+                'more_body': following is not None
+            })
+
+            if following is None:
+                break
+
+            buff = following
+
+def build_parser():
     import argparse
-    import sys
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--storage', required=True)
     parser.add_argument('--host', default=consts.DEFAULT_STORAGE_HOST)
-    parser.add_argument('--port', default=consts.DEFAULT_STORAGE_PORT)
+    parser.add_argument('--port', type=int,
+                        default=consts.DEFAULT_STORAGE_PORT)
+    parser.add_argument(
+        '--retention', action='append', default=[],
+        metavar='NAMESPACE=SPEC',
+        help="Retention for a namespace, ex: 'ci=entries=100,age=86400'. "
+             "Use '=SPEC' for all keys")
+    parser.add_argument(
+        '--cache-size', type=int, default=1024,
+        help="Number of keys to keep in the read cache, 0 disables it")
+    parser.add_argument(
+        '--compact-interval', type=int, default=60,
+        help="Seconds between compaction passes")
+    parser.add_argument(
+        '--sweep-interval', type=int, default=0,
+        help="Seconds between passes deleting unreferenced attachments, "
+             "off by default")
+    parser.add_argument(
+        '--sweep-batch', type=int, default=100,
+        help="Attachments deleted at most per sweep pass")
+    parser.add_argument(
+        '--sweep-dry-run', action='store_true',
+        help="Only log what sweep passes would delete")
+    parser.add_argument(
+        '--shards', type=int,
+        help="Number of dbm files to spread keys over, only for new "
+             "datadirs. Use gcd.migrate --shards to change it")
+    parser.add_argument(
+        '--shard-by', choices=['hash', 'namespace'],
+        help="Partition keys by hash or by top level namespace")
+    parser.add_argument(
+        '--compression', action='append', default=[],
+        metavar='NAMESPACE=SPEC',
+        help="Compression for a namespace, ex: 'logs=lzma' or "
+             "'ci=codec=gzip,threshold=512'. Use '=SPEC' for all keys")
+    parser.add_argument(
+        '--delta', action='append', default=[],
+        metavar='NAMESPACE=INTERVAL',
+        help="Store payloads as deltas against the previous one with a "
+             "full keyframe every INTERVAL records, ex: 'ci=32'. Use "
+             "'=INTERVAL' for all keys")
+    parser.add_argument(
+        '--index', action='append', default=[],
+        metavar='NAMESPACE=PATH',
+        help="Index a payload field for queries, ex: 'ci=result.code'. "
+             "Use '=PATH' for all keys")
+    parser.add_argument(
+        '--asgi', action='store_true',
+        help="Serve the ASGI app with uvicorn instead of the debug server")
+    parser.add_argument(
+        '--threads', type=int, default=8,
+        help="Threads for blocking storage I/O (ASGI mode)")
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help="Processes serving the datadir (ASGI mode), needs a dbm "
+             "backend writing in place like dbm.gnu. Watches aren't "
+             "available, they would miss the saves of other processes")
+
+    return parser
+
+
+def build_storage(args, shared=False):
+    policies = {}
+    for item in args.retention:
+        (ns, spec) = item.split('=', 1)
+        policies[ns] = retention.Policy.fromstring(spec)
 
+    rules = {}
+    for item in args.compression:
+        (ns, spec) = item.split('=', 1)
+        rules[ns] = compression.Rule.fromstring(spec)
+
+    intervals = {}
+    for item in args.delta:
+        (ns, interval) = item.split('=', 1)
+        intervals[ns] = int(interval)
+
+    indexes = {}
+    for item in args.index:
+        (ns, path) = item.split('=', 1)
+        indexes.setdefault(ns, []).append(path)
+
+    storage = StorageAPI(args.storage, retention=policies,
+                         cache_size=args.cache_size, indexes=indexes,
+                         shards=args.shards, shard_by=args.shard_by,
+                         compression=rules, delta=intervals, shared=shared)
+    if policies:
+        retention.Compactor(storage, interval=args.compact_interval).start()
+
+    if args.sweep_interval:
+        retention.Sweeper(storage, interval=args.sweep_interval,
+                          batch=args.sweep_batch,
+                          dry_run=args.sweep_dry_run).start()
+
+    return storage
+
+
+# Command line of the --workers processes, see asgi_app()
+WORKER_ARGV = 'GCD_STORAGE_ARGV'
+
+
+def asgi_app():
+    """
+    Builds the app of a --workers process from the command line main()
+    leaves in the environment
+    """
+    args = build_parser().parse_args(json.loads(os.environ[WORKER_ARGV]))
+    return AsyncStorageServer(build_storage(args, shared=True),
+                              threads=args.threads)
+
+
+def main():
+    import sys
+
+    parser = build_parser()
     args = parser.parse_args(sys.argv[1:])
 
-    storage = StorageAPI(args.storage)
-    StorageServer(storage).serve(args.host, args.port, debug=True)
+    if args.workers < 1:
+        parser.error("--workers must be positive")
+
+    if args.workers > 1 and not args.asgi:
+        parser.error("--workers needs --asgi")
+
+    if not args.asgi:
+        StorageServer(build_storage(args)).serve(
+            args.host, args.port, debug=True, threaded=True)
+        return
+
+    try:
+        import uvicorn
+    except ImportError:
+        parser.error("ASGI mode needs uvicorn installed")
+
+    if args.workers > 1:
+        # Sets the datadir up once instead of racing workers for it
+        try:
+            StorageAPI(args.storage, shards=args.shards,
+                       shard_by=args.shard_by, shared=True).close()
+        except ValueError as e:
+            parser.error(e.args[-1])
+
+        os.environ[WORKER_ARGV] = json.dumps(sys.argv[1:])
+        uvicorn.run('gcd.storage:asgi_app', factory=True,
+                    workers=args.workers, host=args.host, port=args.port,
+                    interface='asgi2')
+        return
+
+    uvicorn.run(
+        AsyncStorageServer(build_storage(args), threads=args.threads),
+        host=args.host, port=args.port, interface='asgi2')
 
 
 if __name__ == '__main__':
@@ -1,3 +1,4 @@
+import collections
 import functools
 
 
@@ -7,3 +8,110 @@ def unroll(fn):
         return list(fn(*args, **kwargs))
 
     return _wrap
+
+
+class LRUCache:
+    """
+    Bounded mapping that evicts the least recently used items.
+
+    A maxsize of 0 disables the cache.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses = self.misses + 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits = self.hits + 1
+        return value
+
+    def set(self, key, value):
+        if not self.maxsize:
+            return
+
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def discard(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def keys(self):
+        return list(self._data)
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+    def __len__(self):
+        return len(self._data)
+
+
+def parse_range(header, size):
+    """
+    Parses a single 'bytes=' HTTP Range header against a resource of size
+    bytes, returns an inclusive (first, last) pair.
+
+    Returns None when the header should be ignored (missing, not bytes
+    based, multiple ranges or malformed) and raises ValueError when the
+    range can't be satisfied.
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+
+    spec = header[len('bytes='):].strip()
+    if ',' in spec or '-' not in spec:
+        return None
+
+    (first, last) = spec.split('-', 1)
+    if not (first or last) or not all(x.isdigit() for x in (first, last) if x):
+        return None
+
+    if not first:
+        # Suffix range, the last N bytes
+        length = int(last)
+        if not length or not size:
+            raise ValueError(header, "unsatisfiable range")
+
+        return (max(size - length, 0), size - 1)
+
+    first = int(first)
+    if first >= size:
+        raise ValueError(header, "unsatisfiable range")
+
+    last = int(last) if last else size - 1
+    if first > last:
+        return None
+
+    return (first, min(last, size - 1))
+
+
+def lower_bound(lo, hi, get, value):
+    """
+    Returns the first index in [lo, hi) for which get(index) >= value, hi if
+    there is none. get must be non-decreasing over the range.
+    """
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if get(mid) < value:
+            lo = mid + 1
+        else:
+            hi = mid
+
+    return lo
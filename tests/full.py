@@ -1,20 +1,61 @@
 import unittest
+import unittest.mock
 
 
+import asyncio
+import datetime
+import dbm.dumb
+import hashlib
 import io
 import json
+import multiprocessing
+import os
+import pickle
 import tempfile
+import threading
+import time
 
 
 from apistar.test import TestClient as APIStarTestClient
+import requests
+import urllib3
 
 
 from gcd import (
+    AsyncClient,
     Client,
+    Event,
     Packet,
     StorageAPI,
     StorageServer
 )
+from gcd import (
+    compression,
+    delta,
+    record,
+    shards
+)
+from gcd.packet import (
+    EPOCH,
+    parse_timestamp
+)
+from gcd.retention import Policy
+from gcd.storage import AsyncStorageServer
+from gcd.source import Source
+
+try:
+    from gcd.backends import sa
+except ImportError:
+    sa = None
+
+# Shared datadirs need a dbm writing in place
+try:
+    import dbm.gnu as shared_dbm
+except ImportError:
+    try:
+        import dbm.ndbm as shared_dbm
+    except ImportError:
+        shared_dbm = None
 
 
 # def save(client, path, payload, attachments=None):
@@ -122,6 +163,18 @@ class StorageTests:
             set(['foo', 'bar'])
         )
 
+    def test_list_namespace(self):
+        for key in ['ns.foo', 'ns.bar.a', 'ns.bar.b', 'ns', 'other']:
+            self.storage.save(Packet(key, None))
+
+        self.assertEqual(set(self.storage.list()), set(['ns', 'other']))
+        self.assertEqual(set(self.storage.list('ns')), set(['foo', 'bar']))
+        self.assertEqual(set(self.storage.list('ns.bar')), set(['a', 'b']))
+        self.assertEqual(self.storage.list('missing'), [])
+
+        self.assertEqual(self.storage.count('ns'), 2)
+        self.assertEqual(self.storage.count('ns.foo'), 0)
+
     def test_backlog(self):
         for x in range(3):
             self.storage.save(Packet('foo', x))
@@ -133,6 +186,283 @@ class StorageTests:
             [2, 1, 0]
         )
 
+    def test_backlog_window(self):
+        for x in range(10):
+            self.storage.save(Packet('foo', x))
+
+        backlog = self.storage.backlog('foo', start=2, end=5)
+        payloads = [x.payload for x in backlog]
+        self.assertEqual(
+            payloads,
+            [7, 6, 5]
+        )
+
+    def test_backlog_time_range(self):
+        stamps = [self.storage.save(Packet('foo', x)).timestamp
+                  for x in range(10)]
+
+        backlog = self.storage.backlog('foo', since=stamps[3],
+                                       until=stamps[7])
+        self.assertEqual([x.payload for x in backlog], [6, 5, 4, 3])
+
+        backlog = self.storage.backlog('foo', start=1, end=3,
+                                       since=stamps[3])
+        self.assertEqual([x.payload for x in backlog], [8, 7])
+
+        (packets, cursor) = self.storage.page('foo', limit=3,
+                                              until=stamps[5])
+        self.assertEqual([x.payload for x in packets], [4, 3, 2])
+        (packets, cursor) = self.storage.page('foo', cursor=cursor, limit=3,
+                                              until=stamps[5])
+        self.assertEqual([x.payload for x in packets], [1, 0])
+        self.assertIsNone(cursor)
+
+        later = stamps[-1] + datetime.timedelta(seconds=1)
+        self.assertEqual(self.storage.backlog('foo', since=later), [])
+
+    def test_timestamps_follow_records(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        class SlowReader(io.BytesIO):
+            def read(self, *args):
+                started.set()
+                release.wait()
+                return super().read(*args)
+
+        def save_slow():
+            self.storage.save(Packet(
+                'foo', 'a', attachments={'x': SlowReader(b'slow')}))
+
+        thread = threading.Thread(target=save_slow)
+        thread.start()
+        started.wait()
+        b = self.storage.save(Packet('foo', 'b'))
+        release.set()
+        thread.join()
+
+        backlog = self.storage.backlog('foo')
+        self.assertEqual([x.payload for x in backlog], ['a', 'b'])
+        self.assertGreaterEqual(backlog[0].timestamp, b.timestamp)
+        self.assertEqual(
+            [x.payload for x in self.storage.backlog('foo',
+                                                     until=b.timestamp)],
+            [])
+
+    def test_save_many(self):
+        closed = io.BytesIO()
+        closed.close()
+
+        results = self.storage.save_many([
+            Packet('foo', 1),
+            Packet('foo', 2),
+            Packet('bar', None, attachments={'x': closed})
+        ])
+
+        self.assertEqual([x.payload for x in results[:2]], [1, 2])
+        self.assertIsInstance(results[2], Exception)
+        self.assertEqual(
+            [x.payload for x in self.storage.backlog('foo')], [2, 1])
+        with self.assertRaises(KeyError):
+            self.storage.get('bar')
+
+    def test_save_not_json(self):
+        bad = Packet('bad', datetime.datetime.utcnow(),
+                     attachments={'x': io.BytesIO(b'data')})
+        with self.assertRaises(TypeError):
+            self.storage.save(bad)
+
+        self.assertEqual(self.storage.list(), [])
+        aid = hashlib.sha1(b'data').hexdigest()
+        self.assertNotIn(self.storage._ref_key(aid), self.storage.db)
+
+        results = self.storage.save_many([
+            Packet('a', 1),
+            Packet('b', {'when': datetime.datetime.utcnow()}),
+            Packet('c', 3)
+        ])
+        self.assertEqual(results[0].payload, 1)
+        self.assertIsInstance(results[1], TypeError)
+        self.assertEqual(results[2].payload, 3)
+        self.assertEqual(self.storage.list(), ['a', 'c'])
+
+    def test_prune_max_entries(self):
+        for x in range(10):
+            self.storage.save(Packet('foo', x))
+
+        dropped = self.storage.prune('foo', Policy(max_entries=3))
+        self.assertEqual(dropped, 7)
+
+        payloads = [x.payload for x in self.storage.backlog('foo')]
+        self.assertEqual(payloads, [9, 8, 7])
+
+    def test_prune_max_age(self):
+        now = datetime.datetime.utcnow()
+        for x in range(3):
+            self.storage.save(Packet('foo', x))
+
+        later = now + datetime.timedelta(seconds=3600)
+        self.storage.prune('foo', Policy(max_age=60), now=later)
+
+        payloads = [x.payload for x in self.storage.backlog('foo')]
+        self.assertEqual(payloads, [2])
+
+    def test_compact_uses_namespace_policy(self):
+        self.storage.retention = {'ns': Policy(max_entries=2)}
+        for x in range(5):
+            self.storage.save(Packet('ns.foo', x))
+            self.storage.save(Packet('bar', x))
+
+        self.assertEqual(self.storage.compact(), 3)
+
+        self.assertEqual(len(self.storage.backlog('ns.foo')), 2)
+        self.assertEqual(len(self.storage.backlog('bar')), 5)
+
+    def test_delta(self):
+        self.storage.delta = {'ns': 4}
+        payloads = [
+            {'build': x, 'env': {'os': 'linux', 'tags': ['a'] * x},
+             'log': 'x' * 500}
+            for x in range(10)
+        ]
+        for payload in payloads:
+            self.storage.save(Packet('ns.foo', payload))
+
+        encodings = [
+            record.is_delta(self.storage.db['ns.foo/{}'.format(idx)])
+            for idx in range(10)
+        ]
+        self.assertEqual(encodings, [x % 4 != 0 for x in range(10)])
+        self.assertLess(len(self.storage.db['ns.foo/3']), 100)
+
+        backlog = self.storage.backlog('ns.foo')
+        self.assertEqual([x.payload for x in backlog], payloads[::-1])
+        (packets, cursor) = self.storage.page('ns.foo', cursor=6, limit=2)
+        self.assertEqual([x.payload for x in packets], payloads[6:4:-1])
+
+        self.storage.cache.clear()
+        self.assertEqual(self.storage.get('ns.foo').payload, payloads[-1])
+
+        # Dropping the keyframe turns the first kept record into one
+        self.storage.prune('ns.foo', Policy(max_entries=3))
+        self.assertFalse(record.is_delta(self.storage.db['ns.foo/7']))
+        self.assertEqual([x.payload for x in self.storage.backlog('ns.foo')],
+                         payloads[:6:-1])
+
+    def test_delta_modified_payloads(self):
+        self.storage.delta = {'': 16}
+        payload = {'n': 0}
+        self.storage.save(Packet('foo', payload))
+
+        # The base of the next delta isn't the caller's payload
+        payload['n'] = 1
+        self.storage.save(Packet('foo', payload))
+        packet = self.storage.get('foo')
+        packet.payload['n'] = 2
+        self.storage.save(packet)
+
+        self.storage.cache.clear()
+        self.assertEqual([x.payload['n'] for x in self.storage.backlog('foo')],
+                         [2, 1, 0])
+
+    def test_collect(self):
+        for data in [b'old', b'shared', b'new']:
+            self.storage.save(Packet(
+                'foo', None, attachments={'x': io.BytesIO(data)}))
+        shared = self.storage.save(Packet(
+            'bar', None, attachments={'x': io.BytesIO(b'shared')}))
+        old = self.storage.backlog('foo')[-1].attachments['x']
+
+        self.storage.prune('foo', Policy(max_entries=1))
+
+        # Too recent
+        self.assertEqual(self.storage.collect(), (0, 0))
+
+        self.assertEqual(self.storage.collect(grace=0, dry_run=True), (1, 3))
+        self.assertTrue(os.path.exists(self.storage.path(old)))
+
+        self.assertEqual(self.storage.collect(grace=0), (1, 3))
+        self.assertFalse(os.path.exists(self.storage.path(old)))
+        self.assertEqual(self.storage.read(shared.attachments['x']),
+                         b'shared')
+        self.assertEqual(self.storage.attachment_stats['reclaimed_bytes'], 3)
+        self.assertEqual(self.storage.collect(grace=0), (0, 0))
+
+    def test_collect_unreferenced(self):
+        aid = self.storage.write(io.BytesIO(b'lost'))
+        self.assertEqual(self.storage.collect(grace=3600), (0, 0))
+
+        self.assertEqual(self.storage.collect(grace=0), (1, 4))
+        self.assertFalse(os.path.exists(self.storage.path(aid)))
+
+        # Saved again after being queued
+        aid = self.storage.write(io.BytesIO(b'found'))
+        self.storage.collect(grace=0, limit=0)
+        self.storage.save(Packet(
+            'foo', None, attachments={'x': io.BytesIO(b'found')}))
+        self.assertEqual(self.storage.collect(grace=0), (0, 0))
+        self.assertEqual(self.storage.read(aid), b'found')
+
+    def test_written_expiry(self):
+        lost = self.storage.write(io.BytesIO(b'lost'))
+        saved = self.storage.save(Packet(
+            'foo', None, attachments={'x': io.BytesIO(b'saved')}))
+        for aid in [lost, saved.attachments['x']]:
+            self.storage._written[aid] -= 7200
+            stamp = time.time() - 7200
+            os.utime(self.storage.path(aid), (stamp, stamp))
+
+        # Expired by the next write, without collect() running
+        new = self.storage.write(io.BytesIO(b'new'))
+        self.assertEqual(list(self.storage._written), [new])
+        self.assertEqual(self.storage._orphans(), [lost])
+        self.assertIn(self.storage._orphan_key(lost), self.storage.db)
+
+        self.assertEqual(self.storage.collect(), (1, 4))
+        self.assertEqual(self.storage._orphans(), [])
+        self.assertEqual(self.storage.read(new), b'new')
+
+    def test_page(self):
+        for x in range(5):
+            self.storage.save(Packet('foo', x))
+
+        (packets, cursor) = self.storage.page('foo', limit=2)
+        self.assertEqual([x.payload for x in packets], [4, 3])
+
+        # New packets don't shift pages
+        self.storage.save(Packet('foo', 5))
+
+        (packets, cursor) = self.storage.page('foo', cursor=cursor, limit=2)
+        self.assertEqual([x.payload for x in packets], [2, 1])
+
+        (packets, cursor) = self.storage.page('foo', cursor=cursor, limit=2)
+        self.assertEqual([x.payload for x in packets], [0])
+        self.assertIsNone(cursor)
+
+    def test_query(self):
+        self.storage.save(Packet('ci.a', {'result': {'code': 0}}))
+        self.storage.save(Packet('ci.b', {'result': {'code': 1}}))
+        self.storage.save(Packet('ci.c.d', {'result': {'code': 2}}))
+        self.storage.save(Packet('ci.e', 'not a dict'))
+        self.storage.save(Packet('other', {'result': {'code': 1}}))
+
+        def keys(*args, **kwargs):
+            return [x.key for x in self.storage.query(*args, **kwargs)]
+
+        self.assertEqual(keys('ci', result__code__ne=0), ['ci.b', 'ci.c.d'])
+        self.assertEqual(keys('ci', result__code=1), ['ci.b'])
+        self.assertEqual(keys('ci', result__code__in=[0, 2]),
+                         ['ci.a', 'ci.c.d'])
+        self.assertEqual(keys('ci.c', result__code__ge=1), ['ci.c.d'])
+        self.assertEqual(keys('ci', result__exists=False), ['ci.e'])
+        self.assertEqual(keys(result__code=1), ['ci.b', 'other'])
+
+        self.storage.save(Packet('ci.a', {'result': {'code': 3}}))
+        self.assertEqual(keys('ci', result__code__gt=2), ['ci.a'])
+
+        with self.assertRaises(ValueError):
+            self.storage.query('ci', result__code__in=1)
+
     def test_backlog_for_missing(self):
         with self.assertRaises(KeyError) as ctx:
             self.storage.backlog('x')
@@ -181,6 +511,464 @@ class TestDBMStorage(StorageTests, unittest.TestCase):
         d = tempfile.mkdtemp()
         self.storage = StorageAPI(datadir=d)
 
+    def test_attachments_dedup(self):
+        for idx in range(3):
+            self.storage.save(Packet(
+                'foo', None, attachments={'x': io.BytesIO(b'same')}))
+
+        stats = self.storage.attachment_stats
+        self.assertEqual(stats['written'], 1)
+        self.assertEqual(stats['deduplicated'], 2)
+        self.assertEqual(stats['deduplicated_bytes'], 8)
+        self.assertEqual(os.listdir(self.storage.staging), [])
+
+    def test_attachments_unseekable(self):
+        (rfd, wfd) = os.pipe()
+        os.write(wfd, b'piped')
+        os.close(wfd)
+
+        with os.fdopen(rfd, 'rb') as fh:
+            aid = self.storage.write(fh)
+
+        self.assertEqual(self.storage.read(aid), b'piped')
+        self.assertEqual(os.listdir(self.storage.staging), [])
+
+    def test_attachments_dedup_no_writes(self):
+        contents = b'line\n' * 1000
+        rule = compression.Rule('lzma', threshold=100)
+        aid = self.storage.write(io.BytesIO(contents), compress=rule)
+
+        with unittest.mock.patch.object(
+                self.storage, '_stage', side_effect=AssertionError), \
+                unittest.mock.patch.object(
+                    compression.get('lzma'), 'open',
+                    side_effect=AssertionError):
+            self.assertEqual(
+                self.storage.write(io.BytesIO(contents), compress=rule), aid)
+
+        self.assertEqual(self.storage.read(aid), contents)
+        self.assertEqual(self.storage.attachment_stats['deduplicated'], 1)
+        self.assertEqual(os.listdir(self.storage.staging), [])
+
+        # Unseekable contents are compressed from their staged copy
+        (rfd, wfd) = os.pipe()
+        os.write(wfd, contents + b'!')
+        os.close(wfd)
+        with os.fdopen(rfd, 'rb') as fh:
+            aid = self.storage.write(fh, compress=rule)
+
+        self.assertLess(os.path.getsize(self.storage.path(aid)),
+                        len(contents))
+        self.assertEqual(self.storage.read(aid), contents + b'!')
+        self.assertEqual(os.listdir(self.storage.staging), [])
+
+    def test_compression(self):
+        self.storage.compression = {
+            'logs': compression.Rule('lzma', threshold=100)
+        }
+        contents = b'line\n' * 1000
+        packet = self.storage.save(Packet(
+            'logs.build', {'text': 'x' * 1000},
+            attachments={'out': io.BytesIO(contents)}))
+        aid = packet.attachments['out']
+
+        with open(self.storage.path(aid), 'rb') as fh:
+            self.assertEqual(fh.read(4), compression.MAGIC)
+        self.assertLess(os.path.getsize(self.storage.path(aid)),
+                        len(contents))
+        self.assertEqual(self.storage.read(aid), contents)
+        with self.storage.open(aid) as fh:
+            fh.seek(5)
+            self.assertEqual(fh.read(4), b'line')
+
+        raw = self.storage.db['logs.build/0']
+        self.assertEqual(record.decode_header(raw).encoding, 2)
+        self.storage.cache.clear()
+        self.assertEqual(self.storage.get('logs.build').payload,
+                         {'text': 'x' * 1000})
+
+        # Outside the namespace, below the threshold or incompressible
+        for (key, data) in [('other', contents + b'!'),
+                            ('logs.small', b'tiny'),
+                            ('logs.random', os.urandom(1000))]:
+            packet = self.storage.save(Packet(
+                key, None, attachments={'out': io.BytesIO(data)}))
+            aid = packet.attachments['out']
+            self.assertEqual(os.path.getsize(self.storage.path(aid)),
+                             len(data))
+            self.assertEqual(self.storage.read(aid), data)
+
+    def test_attachment_with_magic(self):
+        contents = compression.MAGIC + b'not really compressed'
+        aid = self.storage.write(io.BytesIO(contents))
+        self.assertEqual(self.storage.read(aid), contents)
+        with self.storage.open(aid) as fh:
+            fh.seek(4)
+            self.assertEqual(fh.read(4), b'not ')
+
+    def test_get_cache(self):
+        self.storage.save(Packet('foo', 1))
+        self.storage.get('foo')
+        self.assertEqual(self.storage.cache.hits, 1)
+
+        self.storage.save(Packet('foo', 2))
+        self.assertEqual(self.storage.get('foo').payload, 2)
+
+        self.storage.cache.clear()
+        self.assertEqual(self.storage.get('foo').payload, 2)
+        self.assertEqual(self.storage.cache.misses, 1)
+
+    def test_get_cache_copies(self):
+        payload = {'a': 1}
+        self.storage.save(Packet('foo', payload))
+        payload['a'] = 2
+        self.assertEqual(self.storage.get('foo').payload, {'a': 1})
+
+        self.storage.get('foo').payload['a'] = 3
+        self.assertEqual(self.storage.get('foo').payload, {'a': 1})
+        self.assertEqual(self.storage.latest('foo')[1].payload, {'a': 1})
+        self.assertEqual(self.storage.backlog('foo')[0].payload, {'a': 1})
+
+    def test_get_cache_bounded(self):
+        self.storage.cache.maxsize = 2
+        for key in ['a', 'b', 'c']:
+            self.storage.save(Packet(key, None))
+
+        self.assertEqual(len(self.storage.cache), 2)
+        self.assertEqual(self.storage.get('a').key, 'a')
+        self.assertEqual(self.storage.cache.misses, 1)
+
+    def test_metrics(self):
+        self.storage.save(Packet('foo', 1))
+        self.storage.get('foo')
+        with self.assertRaises(KeyError):
+            self.storage.get('bar')
+
+        metrics = self.storage.metrics
+        self.assertEqual(
+            metrics.histogram('gcd_storage_operation_seconds', op='get').count,
+            2)
+        self.assertEqual(
+            metrics.counter('gcd_storage_errors_total', op='get',
+                            error='KeyError'),
+            1)
+
+        text = metrics.render()
+        self.assertIn('# TYPE gcd_storage_operation_seconds histogram', text)
+        self.assertIn('gcd_storage_operation_seconds_bucket'
+                      '{op="save",le="+Inf"} 1', text)
+        self.assertIn('gcd_cache_requests_total{result="hit"} 1', text)
+
+    def test_query_indexed(self):
+        d = tempfile.mkdtemp()
+        self.storage = StorageAPI(datadir=d, indexes={'ci': ['result.code']})
+        self.test_query()
+
+        index = self.storage.indexes[0]
+        self.assertEqual(
+            index.values,
+            {'ci.a': 3, 'ci.b': 1, 'ci.c.d': 2})
+
+        # Answered by the index alone, the packet is read to be returned
+        self.storage.cache.clear()
+        misses = self.storage.cache.misses
+        (packet,) = self.storage.query('ci', result__code=1)
+        self.assertEqual(packet.key, 'ci.b')
+        self.assertEqual(self.storage.cache.misses - misses, 1)
+
+    def test_query_numbers(self):
+        payloads = {'a': 1, 'b': 1.0, 'c': True, 'd': 1.5, 'e': [1.0],
+                    'f': '1'}
+
+        results = []
+        for indexes in [None, {'': ['v']}]:
+            self.storage = StorageAPI(datadir=tempfile.mkdtemp(),
+                                      indexes=indexes)
+            for (key, value) in sorted(payloads.items()):
+                self.storage.save(Packet(key, {'v': value}))
+
+            results.append([
+                [x.key for x in self.storage.query(**params)]
+                for params in [{'v': 1}, {'v__in': [1.5, [1]]}]])
+
+        self.assertEqual(results[0], [['a', 'b', 'c'], ['d', 'e']])
+        self.assertEqual(results[1], results[0])
+
+    def test_connect(self):
+        calls = []
+
+        def callback(sender, packet, prev):
+            calls.append((sender, packet.payload, prev and prev.payload))
+
+        def broken(sender, packet, prev):
+            raise RuntimeError()
+
+        self.storage.connect(Event.VALUE_CHANGED, broken)
+        self.storage.connect(Event.VALUE_CHANGED, callback)
+        self.storage.save(Packet('foo', 1))
+        self.storage.save_many([Packet('foo', 2), Packet('bar', 3)])
+
+        self.storage.disconnect(Event.VALUE_CHANGED, callback)
+        self.storage.save(Packet('foo', 4))
+
+        self.assertEqual(calls, [
+            (self.storage, 1, None),
+            (self.storage, 2, 1),
+            (self.storage, 3, None)
+        ])
+
+    def test_changes(self):
+        changes = self.storage.changes
+        cursor = changes.seq
+
+        self.storage.save(Packet('ns.foo', 1))
+        self.storage.save(Packet('other', 2))
+        self.storage.save(Packet('ns', 3))
+
+        (packets, cursor, missed) = changes.since(cursor, 'ns')
+        self.assertEqual([x.payload for x in packets], [1, 3])
+        self.assertFalse(missed)
+
+        self.assertEqual(changes.wait(cursor, timeout=0), ([], cursor, False))
+
+        # Cursors from another run of the server
+        (packets, _, missed) = changes.since(cursor + 10)
+        self.assertTrue(missed)
+
+        changes._changes.clear()
+        (packets, _, missed) = changes.since(0)
+        self.assertTrue(missed)
+
+    def test_upgrade_pickled_backlog(self):
+        packets = [Packet('foo', x) for x in range(3)]
+        self.storage.db['foo'] = pickle.dumps(list(reversed(packets)))
+
+        self.storage.save(Packet('foo', 3))
+        payloads = [x.payload for x in self.storage.backlog('foo')]
+        self.assertEqual(payloads, [3, 2, 1, 0])
+
+    def test_migrate(self):
+        self.storage.save(Packet('foo', 1))
+        self.storage.db['foo/1'] = pickle.dumps(Packet('foo', 2))
+        self.storage.db['foo'] = b'0 2'
+
+        self.assertEqual(self.storage.migrate(), 1)
+        self.assertTrue(record.is_record(self.storage.db['foo/1']))
+        self.assertEqual(
+            [x.payload for x in self.storage.backlog('foo')], [2, 1])
+
+    def test_reindex(self):
+        self.storage.save(Packet('ns.foo', 1))
+        self.storage.save(Packet('ns.bar', 1))
+        for node in ['@', '@ns']:
+            del self.storage.db[node]
+
+        self.storage.reindex()
+        self.assertEqual(set(self.storage.list('ns')), set(['foo', 'bar']))
+
+    def test_recount(self):
+        for data in [b'a', b'b']:
+            self.storage.save(Packet(
+                'foo', None, attachments={'x': io.BytesIO(data)}))
+        orphan = self.storage.write(io.BytesIO(b'c'))
+        for name in self.storage.db.keys():
+            if name.startswith(b'@@'):
+                del self.storage.db[name]
+
+        self.storage.recount()
+        self.assertEqual(self.storage._orphans(), [orphan])
+        self.storage.prune('foo', Policy(max_entries=1))
+        self.assertEqual(self.storage.collect(grace=0), (2, 2))
+        self.assertEqual(self.storage.read(
+            self.storage.get('foo').attachments['x']), b'b')
+
+
+class TestShardedStorage(StorageTests, unittest.TestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.storage = StorageAPI(datadir=self.datadir, shards=4)
+
+    def test_layout(self):
+        self.storage.save(Packet('ns.foo', 1))
+        self.storage.save(Packet('ns.bar', 2))
+        self.storage.close()
+
+        with self.assertRaises(ValueError):
+            StorageAPI(datadir=self.datadir, shards=2)
+
+        self.storage = StorageAPI(datadir=self.datadir)
+        self.assertEqual(self.storage.db.count, 4)
+        self.assertEqual(sorted(self.storage.list('ns')), ['bar', 'foo'])
+
+    def test_shared_dumb(self):
+        self.storage.close()
+        datadir = tempfile.mkdtemp()
+        dbm.dumb.open(datadir + '/db', 'c').close()
+        with self.assertRaises(ValueError):
+            StorageAPI(datadir=datadir, shared=True)
+
+    def test_shard_by_namespace(self):
+        self.storage = StorageAPI(datadir=tempfile.mkdtemp(), shards=4,
+                                  shard_by='namespace')
+        db = self.storage.db
+        self.assertEqual(db.shard('ci.a'), db.shard('ci.b.c/12'))
+
+    def test_rebalance(self):
+        for x in range(20):
+            self.storage.save(Packet('ns.k{}'.format(x % 5), x))
+        self.storage.close()
+
+        for count in [3, 1, 2]:
+            shards.rebalance(self.datadir, count)
+
+            self.storage = StorageAPI(datadir=self.datadir)
+            self.assertEqual(self.storage.db.count, count)
+            self.assertEqual(len(self.storage.list('ns')), 5)
+            self.assertEqual(
+                [x.payload for x in self.storage.backlog('ns.k4')],
+                [19, 14, 9, 4])
+            self.storage.close()
+
+        self.assertEqual(sorted(os.listdir(self.datadir)),
+                         ['attachments', 'shards', 'shards.json', 'staging'])
+
+    def test_build_indexes(self):
+        self.storage = StorageAPI(datadir=tempfile.mkdtemp(), shards=4,
+                                  indexes={'': ['v']})
+        db = self.storage.db
+        for x in range(20):
+            self.storage.save(Packet('k{}'.format(x), {'v': 0}))
+
+        latest = self.storage._latest
+        saved = []
+        saver = []
+
+        def save():
+            for key in saved:
+                self.storage.save(Packet(key, {'v': 1}))
+
+        def _latest(key):
+            if not saver:
+                # A stored key and a new one, outside the shard being
+                # indexed
+                others = [x for x in range(100)
+                          if db.lock('k{}'.format(x)) is not db.lock(key)]
+                saved.extend('k{}'.format(x) for x in
+                             [others[0], [x for x in others if x >= 20][0]])
+                saver.append(threading.Thread(target=save))
+                saver[0].start()
+                saver[0].join(5)
+                # Not kept waiting for the whole build
+                saver.append(saver[0].is_alive())
+            return latest(key)
+
+        self.storage._latest = _latest
+        self.storage.query(v=0)
+        self.assertFalse(saver[1])
+
+        self.assertEqual([x.key for x in self.storage.query(v=1)],
+                         sorted(saved))
+        self.assertTrue(self.storage._indexes_built)
+
+    def test_concurrent_saves(self):
+        def save(key):
+            for x in range(50):
+                self.storage.save(Packet(key, x))
+
+        threads = [threading.Thread(target=save, args=('k{}'.format(x),))
+                   for x in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.storage.list()), 8)
+        for x in range(8):
+            self.assertEqual(self.storage.get('k{}'.format(x)).payload, 49)
+            self.assertEqual(len(self.storage.backlog('k{}'.format(x))), 50)
+
+
+def save_shared(datadir, prefix, count):
+    storage = StorageAPI(datadir=datadir, shards=4, shared=True)
+    for x in range(count):
+        storage.save(Packet('{}.k{}'.format(prefix, x % 4), x))
+        storage.save(Packet('both', x))
+    storage.close()
+
+
+@unittest.skipIf(shared_dbm is None, "no dbm writing in place")
+class TestSharedStorage(StorageTests, unittest.TestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.storage = StorageAPI(datadir=self.datadir, shards=4,
+                                  shared=True)
+
+    def test_processes(self):
+        self.storage.close()
+
+        context = multiprocessing.get_context('fork')
+        child = context.Process(target=save_shared,
+                                args=(self.datadir, 'child', 40))
+        child.start()
+        self.storage = StorageAPI(datadir=self.datadir, shards=4,
+                                  shared=True)
+        # Cached before the child saves over it
+        self.storage.save(Packet('both', -1))
+        for x in range(40):
+            self.storage.save(Packet('parent.k{}'.format(x % 4), x))
+            self.storage.save(Packet('both', x))
+        child.join()
+        self.assertEqual(child.exitcode, 0)
+
+        self.assertEqual(sorted(self.storage.list()),
+                         ['both', 'child', 'parent'])
+        for prefix in ['child', 'parent']:
+            self.assertEqual(len(self.storage.list(prefix)), 4)
+            self.assertEqual(
+                [x.payload for x in self.storage.backlog(prefix + '.k3')],
+                [39, 35, 31, 27, 23, 19, 15, 11, 7, 3])
+
+        self.assertEqual(len(self.storage.backlog('both', end=1000)), 81)
+        self.storage.save(Packet('both', 'last'))
+        self.assertEqual(self.storage.get('both').payload, 'last')
+
+        self.storage.close()
+        self.storage = StorageAPI(datadir=self.datadir)
+        self.assertEqual(len(self.storage.backlog('both', end=1000)), 82)
+
+    def test_stale_cache(self):
+        other = StorageAPI(datadir=self.datadir, shards=4, shared=True)
+        self.storage.save(Packet('foo', 1))
+        self.assertEqual(other.get('foo').payload, 1)
+        self.storage.save(Packet('foo', 2))
+        self.assertEqual(other.get('foo').payload, 2)
+        other.close()
+
+    def test_stale_indexes(self):
+        self.storage.close()
+        self.storage = StorageAPI(datadir=self.datadir, shards=4,
+                                  shared=True, indexes={'': ['v']})
+        other = StorageAPI(datadir=self.datadir, shards=4, shared=True)
+        for x in range(8):
+            self.storage.save(Packet('k{}'.format(x), {'v': 0}))
+        self.assertEqual(len(self.storage.query(v=0)), 8)
+
+        other.save(Packet('k0', {'v': 1}))
+        other.close()
+
+        db = self.storage.db
+        neighbours = [x for x in range(8) if db.shard('k{}'.format(x)) ==
+                      db.shard('k0')]
+        with unittest.mock.patch.object(
+                self.storage, '_update_indexes',
+                wraps=self.storage._update_indexes) as update:
+            self.assertEqual([x.key for x in self.storage.query(v=1)],
+                             ['k0'])
+
+        # Only the keys of the changed shard are indexed again
+        self.assertEqual(update.call_count, len(neighbours))
+        self.assertEqual(len(self.storage.query(v=0)), 7)
+
 
 # class TestStorageServer(unittest.TestCase):
 #     def setUp(self):
@@ -275,6 +1063,7 @@ class TestDBMStorage(StorageTests, unittest.TestCase):
 
 
 from gcd import Client
+from gcd.client import APIError
 
 
 class TestClient(Client):
@@ -286,7 +1075,7 @@ class TestClient(Client):
         return APIStarTestClient(self.app)
 
     def request(self, method, path, *args, **kwargs):
-        return self.session.request(method, '/packet/' + path, **kwargs)
+        return self.session.request(method, '/' + path, **kwargs)
 
 class FooTest(unittest.TestCase):
     def setUp(self):
@@ -299,5 +1088,872 @@ class FooTest(unittest.TestCase):
         packet = self.client.save('foo', 1)
         self.assertEqual(packet.payload, 1)
 
+    def test_get_conditional(self):
+        self.client.save('foo', 1)
+        resp = self.client.request('GET', 'packet/foo')
+        self.assertEqual(resp.json()['payload'], 1)
+        etag = resp.headers['ETag']
+        modified = resp.headers['Last-Modified']
+
+        resp = self.client.request('GET', 'packet/foo',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.content, b'')
+
+        resp = self.client.request('GET', 'packet/foo',
+                                   headers={'If-Modified-Since': modified})
+        self.assertEqual(resp.status_code, 304)
+
+        self.client.save('foo', 2)
+        resp = self.client.request('GET', 'packet/foo',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+        # Same timestamp, new packet
+        etag = resp.headers['ETag']
+        latest = self.storage.get('foo')
+        self.storage.save(Packet('foo', 3))
+        self.storage.db[self.storage._record_key('foo', 2)] = record.encode(
+            Packet('foo', 3, timestamp=latest.timestamp))
+        self.storage.cache.clear()
+        resp = self.client.request('GET', 'packet/foo',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()['payload'], 3)
+
+    def test_get_cached(self):
+        self.client.save('foo', 1)
+        first = self.client.get('foo')
+        self.assertIs(self.client.get('foo'), first)
+        self.assertEqual(self.storage.metrics.counter(
+            'gcd_http_requests_total', route='get_packet', method='GET',
+            status='304'), 1)
+
+        self.client.save('foo', 2)
+        self.assertEqual(self.client.get('foo').payload, 2)
+
+    def test_save_many(self):
+        results = self.client.save_many(
+            [Packet('foo', 1), Packet('bar', 2), Packet('foo', 3)])
+        self.assertEqual([x.payload for x in results], [1, 2, 3])
+
+        self.assertEqual(self.storage.get('foo').payload, 3)
+        self.assertEqual(self.storage.get('bar').payload, 2)
+
+    def test_save_many_ndjson(self):
+        body = '{"key": "foo", "payload": 1}\n{"key": "Bad", "payload": 2}\n'
+        resp = self.client.request(
+            'POST', 'packets', data=body,
+            headers={'Content-Type': 'application/x-ndjson'})
+
+        (ok, error) = resp.json()
+        self.assertEqual(ok['payload'], 1)
+        self.assertIn('error', error)
+
+    def test_save_many_multipart(self):
+        files = {
+            'packets': json.dumps([{'key': 'foo', 'payload': None}]),
+            'attachment:0:out': io.BytesIO(b'hi')
+        }
+        resp = self.client.request('POST', 'packets', files=files)
+        self.assertEqual(resp.status_code, 200)
+
+        aid = self.storage.get('foo').attachments['out']
+        self.assertEqual(self.storage.read(aid), b'hi')
+
+    def test_backlog_pages(self):
+        for x in range(5):
+            self.client.save('foo', x)
+
+        resp = self.client.request('GET', 'packet/foo/backlog',
+                                   params={'limit': 2})
+        self.assertEqual([x['payload'] for x in resp.json()], [4, 3])
+        self.assertIn('next', resp.links)
+
+        payloads = [x.payload for x in self.client.backlog('foo', limit=2)]
+        self.assertEqual(payloads, [4, 3, 2, 1, 0])
+
+    def test_backlog_time_range(self):
+        for x in range(5):
+            self.client.save('foo', x)
+
+        stamps = [x.timestamp for x in self.storage.backlog('foo')]
+        payloads = [
+            x.payload
+            for x in self.client.backlog('foo', limit=1, since=stamps[3],
+                                         until=stamps[0])
+        ]
+        self.assertEqual(payloads, [3, 2, 1])
+
+        resp = self.client.request('GET', 'packet/foo/backlog',
+                                   params={'since': 'yesterday'})
+        self.assertEqual(resp.status_code, 400)
+
+        # Epoch seconds
+        before = int((stamps[-1] - EPOCH).total_seconds())
+        for (params, payloads) in [({'since': str(before)}, 5),
+                                   ({'until': str(before - 1) + '.5'}, 0),
+                                   ({'since': str(before + 10) + '.5'}, 0)]:
+            resp = self.client.request('GET', 'packet/foo/backlog',
+                                       params=params)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(resp.json()), payloads)
+
+    def test_attachment(self):
+        contents = b'0123456789'
+        packet = self.storage.save(
+            Packet('foo', None, attachments={'out': io.BytesIO(contents)}))
+        aid = packet.attachments['out']
+
+        resp = self.client.request('GET', 'attachment/' + aid)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content, contents)
+        self.assertEqual(resp.headers['ETag'], '"{}"'.format(aid))
+
+        resp = self.client.request('GET', 'attachment/' + aid,
+                                   headers={'Range': 'bytes=2-4'})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.content, b'234')
+        self.assertEqual(resp.headers['Content-Range'], 'bytes 2-4/10')
+
+        resp = self.client.request('GET', 'attachment/' + aid,
+                                   headers={'Range': 'bytes=-3'})
+        self.assertEqual(resp.content, b'789')
+
+        resp = self.client.request('GET', 'attachment/' + aid,
+                                   headers={'Range': 'bytes=20-'})
+        self.assertEqual(resp.status_code, 416)
+
+        resp = self.client.request('GET', 'attachment/' + aid,
+                                   headers={'If-None-Match': '"' + aid + '"'})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_attachment_compressed(self):
+        self.storage.compression = {'': compression.Rule('gzip', 0)}
+        contents = b'0123456789' * 100
+        packet = self.storage.save(
+            Packet('foo', None, attachments={'out': io.BytesIO(contents)}))
+        aid = packet.attachments['out']
+
+        resp = self.client.request('GET', 'attachment/' + aid,
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['ETag'], '"{}-gzip"'.format(aid))
+        self.assertLess(int(resp.headers['Content-Length']), len(contents))
+        self.assertEqual(resp.content, contents)
+
+        resp = self.client.request('GET', 'attachment/' + aid,
+                                   headers={'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.headers['ETag'], '"{}"'.format(aid))
+        self.assertEqual(resp.content, contents)
+
+        resp = self.client.request('GET', 'attachment/' + aid,
+                                   headers={'Accept-Encoding': 'gzip',
+                                            'Range': 'bytes=12-14'})
+        self.assertEqual(resp.status_code, 206)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.content, b'234')
+
+    def test_attachment_missing(self):
+        resp = self.client.request('GET', 'attachment/' + 'a' * 40)
+        self.assertEqual(resp.status_code, 404)
+
+        resp = self.client.request('GET', 'attachment/..')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_children(self):
+        self.client.save('ns.foo.a', 1)
+        self.client.save('ns.bar', 1)
+
+        data = self.client.request('GET', 'packet/ns/children').json()
+        data = {x['key']: x for x in data}
+        self.assertEqual(set(data), set(['foo', 'bar']))
+        self.assertEqual(data['foo']['children'], 1)
+        self.assertTrue(data['foo']['uri'].endswith('/packet/ns.foo'))
+
+    def test_query(self):
+        self.client.save('ci.a', {'status': 'ok', 'code': 0})
+        self.client.save('ci.b', {'status': 'failed', 'code': 1})
+
+        (packet,) = self.client.query('ci', code__ne=0)
+        self.assertEqual(packet.key, 'ci.b')
+        self.assertEqual(packet.payload['status'], 'failed')
+
+        self.assertEqual(
+            [x.key for x in self.client.query(status='ok')], ['ci.a'])
+
+        resp = self.client.request('GET', 'packet/ci/query',
+                                   params={'code__in': '0'})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_watch(self):
+        (packets, cursor, missed) = self.client.poll('ns', timeout=0)
+        self.assertEqual(packets, [])
+
+        self.client.save('ns.foo', 1)
+        self.client.save('other', 2)
+
+        (packets, cursor, missed) = self.client.poll('ns', cursor=cursor)
+        self.assertEqual([x.key for x in packets], ['ns.foo'])
+        self.assertFalse(missed)
+
+        saver = threading.Timer(
+            0.1, lambda: self.storage.save(Packet('ns.bar', 3)))
+        saver.start()
+
+        watch = self.client.watch('ns', cursor=cursor, timeout=5)
+        self.assertEqual(next(watch).payload, 3)
+        saver.join()
+
+        resp = self.client.request('GET', 'watch', params={'cursor': 'x'})
+        self.assertEqual(resp.status_code, 400)
+
+        # Would miss the saves of other processes
+        self.storage.shared = True
+        resp = self.client.request('GET', 'packet/ns/watch')
+        self.assertEqual(resp.status_code, 501)
+
+    def test_metrics(self):
+        self.client.save('foo', 1)
+        self.client.get('foo')
+        self.client.request('GET', 'attachment/' + 'a' * 40)
+
+        resp = self.client.request('GET', 'metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.headers['Content-Type'].startswith('text/plain'))
+
+        text = resp.text
+        self.assertIn('gcd_http_requests_total'
+                      '{method="GET",route="get_packet",status="200"} 1', text)
+        self.assertIn('gcd_http_requests_total'
+                      '{method="GET",route="get_attachment",status="404"} 1',
+                      text)
+        self.assertIn('gcd_http_request_seconds_count'
+                      '{route="save_packet"} 1', text)
+        self.assertIn('gcd_storage_operation_seconds_count{op="get"} 1', text)
+
+        length = len(self.client.request('GET', 'packet/foo').content)
+        metrics = self.storage.metrics
+        self.assertEqual(
+            metrics.counter('gcd_http_response_bytes_total',
+                            route='get_packet'),
+            2 * length)
+
+
+class AsyncServerTest(FooTest):
+    def setUp(self):
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+        d = tempfile.mkdtemp()
+        self.storage = StorageAPI(datadir=d)
+        self.server = AsyncStorageServer(storage=self.storage, threads=2)
+        self.client = TestClient(self.server)
+
+    def test_watch_listener(self):
+        loop = asyncio.get_event_loop()
+
+        def save(key, payload):
+            threading.Thread(
+                target=self.storage.save, args=(Packet(key, payload),)
+            ).start()
+
+        loop.call_later(0.1, save, 'ns.foo', 1)
+        loop.call_later(0.2, save, 'other', 2)
+        results = loop.run_until_complete(asyncio.gather(
+            self.server.watch(None, '5', 'ns'),
+            self.server.watch(None, '5', 'ns.foo'),
+            self.server.watch(None, '5', 'other'),
+            self.server.watch(None, '0.3', 'none')))
+
+        self.assertEqual([[x['payload'] for x in result['packets']]
+                          for result in results], [[1], [1], [2], []])
+        self.assertEqual(
+            self.storage._listeners[Event.VALUE_CHANGED],
+            [self.server._wake])
+        self.assertEqual(self.server._watchers, {})
+
+
+    def test_zero_copy_send(self):
+        aid = self.storage.write(io.BytesIO(b'0123456789'))
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'scheme': 'http',
+            'server': ('testserver', 80),
+            'path': '/attachment/' + aid,
+            'query_string': b'',
+            'headers': [[b'range', b'bytes=2-5']],
+            'extensions': {'http.response.zerocopysend': {}}
+        }
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            if message['type'] == 'http.response.zerocopysend':
+                fh = message['file']
+                fh.seek(message['offset'])
+                message = dict(message, body=fh.read(message['count']))
+            sent.append(message)
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self.server(scope)(receive, send))
+
+        self.assertEqual(sent[0]['status'], 206)
+        self.assertEqual([(x['type'], x['body'], x['more_body'])
+                          for x in sent[1:]],
+                         [('http.response.zerocopysend', b'2345', False)])
+        self.assertTrue(sent[1]['file'].closed)
+
+
+class AsyncClientTest(unittest.TestCase):
+    def setUp(self):
+        d = tempfile.mkdtemp()
+        self.storage = StorageAPI(datadir=d)
+        self.server = StorageServer(storage=self.storage)
+        self.client = AsyncClient(client=TestClient(self.server),
+                                  concurrency=4, backoff=0)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.client.close()
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_concurrent_save_and_get(self):
+        keys = ['k{}'.format(x) for x in range(20)]
+
+        self.run_async(asyncio.gather(
+            *[self.client.save(key, key) for key in keys]))
+        packets = self.run_async(asyncio.gather(
+            *[self.client.get(key) for key in keys]))
+
+        self.assertEqual([x.payload for x in packets], keys)
+
+    def test_backlog(self):
+        for x in range(5):
+            self.storage.save(Packet('foo', x))
+
+        async def collect():
+            return [x.payload
+                    async for x in self.client.backlog('foo', limit=2)]
+
+        self.assertEqual(self.run_async(collect()), [4, 3, 2, 1, 0])
+
+    def test_retry_server_errors(self):
+        calls = []
+
+        def flaky_get(key):
+            calls.append(key)
+            if len(calls) < 3:
+                raise APIError(status_code=503)
+
+            return key
+
+        self.client.client.get = flaky_get
+        self.assertEqual(self.run_async(self.client.get('foo')), 'foo')
+        self.assertEqual(len(calls), 3)
+
+    def test_no_retry_client_errors(self):
+        def missing_get(key):
+            raise APIError(status_code=404)
+
+        self.client.client.get = missing_get
+
+        with self.assertRaises(APIError):
+            self.run_async(self.client.get('foo'))
+
+    def test_no_retry_sent_saves(self):
+        calls = []
+
+        def failing_save(key, payload, attachments=None):
+            calls.append(key)
+            if len(calls) == 1:
+                raise APIError(status_code=503)
+
+            raise requests.ConnectionError("connection reset")
+
+        self.client.client.save = failing_save
+        with self.assertRaises(APIError):
+            self.run_async(self.client.save('foo', 1))
+        with self.assertRaises(requests.ConnectionError):
+            self.run_async(self.client.save('foo', 1))
+        self.assertEqual(len(calls), 2)
+
+    def test_retry_unsent_saves(self):
+        calls = []
+
+        def refused_save(key, payload, attachments=None):
+            calls.append(key)
+            if len(calls) < 3:
+                reason = urllib3.exceptions.NewConnectionError(
+                    None, "connection refused")
+                raise requests.ConnectionError(
+                    urllib3.exceptions.MaxRetryError(None, key, reason))
+
+            return payload
+
+        self.client.client.save = refused_save
+        self.assertEqual(self.run_async(self.client.save('foo', 1)), 1)
+        self.assertEqual(len(calls), 3)
+
+    def test_polls_keep_slots_free(self):
+        done = threading.Event()
+
+        def slow_poll(ns, cursor=None, timeout=30):
+            done.wait(5)
+            return ([], '0', False)
+
+        self.client.client.poll = slow_poll
+        self.client.client.get = lambda key: key
+        polls = [asyncio.ensure_future(self.client.poll(timeout=5),
+                                       loop=self.loop)
+                 for _ in range(4)]
+        self.assertEqual(
+            self.run_async(asyncio.wait_for(self.client.get('foo'), 1)),
+            'foo')
+
+        done.set()
+        self.run_async(asyncio.gather(*polls))
+
+    def test_timeouts_keep_slots(self):
+        self.client.timeout = 0.05
+        done = threading.Event()
+        running = []
+
+        def slow_get(key):
+            running.append(key)
+            done.wait(5)
+            return key
+
+        self.client.client.get = slow_get
+        self.client.retries = 0
+        for x in range(4):
+            with self.assertRaises(asyncio.TimeoutError):
+                self.run_async(self.client.get(x))
+
+        # Every slot is taken by a thread still running
+        self.assertTrue(self.client._semaphore.locked())
+        with self.assertRaises(asyncio.TimeoutError):
+            self.run_async(asyncio.wait_for(self.client.get('last'), 0.2))
+        self.assertEqual(running, [0, 1, 2, 3])
+
+        done.set()
+        self.client.timeout = 5
+        self.assertEqual(self.run_async(self.client.get('last')), 'last')
+
+
+class PacketTest(unittest.TestCase):
+    def test_dict_roundtrip(self):
+        packet = Packet('foo', 1, timestamp=datetime.datetime(2018, 1, 1))
+
+        for d in (packet.asdict(), packet.asdict(epoch=True)):
+            self.assertEqual(Packet.fromdict(d).timestamp, packet.timestamp)
+
+    def test_parse_timestamp(self):
+        self.assertEqual(
+            parse_timestamp('2018-01-02T03:04:05.5'),
+            datetime.datetime(2018, 1, 2, 3, 4, 5, 500000))
+        self.assertEqual(
+            parse_timestamp('2018-01-02 03:04:05'),
+            datetime.datetime(2018, 1, 2, 3, 4, 5))
+
+        self.assertEqual(parse_timestamp('1.5'),
+                         datetime.datetime(1970, 1, 1, 0, 0, 1, 500000))
+        self.assertEqual(parse_timestamp('60'),
+                         datetime.datetime(1970, 1, 1, 0, 1))
+
+        self.assertEqual(
+            parse_timestamp('2018-01-02T03:04:05.123456Z'),
+            datetime.datetime(2018, 1, 2, 3, 4, 5, 123456))
+        self.assertEqual(
+            parse_timestamp('2018-01-02T01:04:05+02:00'),
+            datetime.datetime(2018, 1, 1, 23, 4, 5))
+        self.assertEqual(
+            parse_timestamp('2018-01-01T23:34:05.5-0330'),
+            datetime.datetime(2018, 1, 2, 3, 4, 5, 500000))
+
+        for value in ['yesterday', '2018-01-02T03:04:05+2', None,
+                      '2018-01-02 03:04:05 UTC', '2018-02-30 00:00:00']:
+            with self.assertRaises(ValueError):
+                parse_timestamp(value)
+
+    def test_trusted_skips_validation(self):
+        with self.assertRaises(ValueError):
+            Packet('Foo', None)
+
+        self.assertEqual(Packet('Foo', None, trusted=True).key, 'Foo')
+
+    def test_unslotted_state(self):
+        # A backlog pickled by the storage before Packet had __slots__
+        pickled = (
+            b'\x80\x03]q\x00cgcd.packet\nPacket\nq\x01)\x81q\x02}q\x03(X'
+            b'\x03\x00\x00\x00keyq\x04X\x03\x00\x00\x00fooq\x05X\x07\x00'
+            b'\x00\x00payloadq\x06}q\x07X\x01\x00\x00\x00aq\x08K\x01sX\t'
+            b'\x00\x00\x00timestampq\tcdatetime\ndatetime\nq\nC\n\x07\xe2'
+            b'\x01\x02\x03\x04\x05\x00\x00\x06q\x0b\x85q\x0cRq\rX\x0b\x00'
+            b'\x00\x00attachmentsq\x0e}q\x0fX\x03\x00\x00\x00logq\x10X(\x00'
+            b'\x00\x00' + b'a' * 40 + b'q\x11suba.')
+
+        (packet,) = pickle.loads(pickled)
+        self.assertEqual((packet.key, packet.payload), ('foo', {'a': 1}))
+        self.assertEqual(packet.timestamp,
+                         datetime.datetime(2018, 1, 2, 3, 4, 5, 6))
+        self.assertEqual(packet.attachments, {'log': 'a' * 40})
+
+        packet = pickle.loads(pickle.dumps(packet))
+        self.assertEqual((packet.key, packet.payload), ('foo', {'a': 1}))
+
+
+class RecordTest(unittest.TestCase):
+    def test_roundtrip(self):
+        packet = Packet('ns.foo', {'a': [1, 'b', None]})
+        packet.attachments['log'] = 'a' * 40
+
+        decoded = record.decode(record.encode(packet))
+        self.assertEqual(decoded.key, packet.key)
+        self.assertEqual(decoded.payload, packet.payload)
+        self.assertEqual(decoded.timestamp, packet.timestamp)
+        self.assertEqual(decoded.attachments, packet.attachments)
+
+    def test_header_skips_payload(self):
+        packet = Packet('foo', 1)
+        buff = record.encode(packet)
+
+        # A broken payload doesn't matter for the header
+        header = record.decode_header(buff[:-1] + b'{')
+        self.assertEqual(header.key, 'foo')
+        self.assertEqual(header.timestamp, packet.timestamp)
+
+    def test_compressed(self):
+        rule = compression.Rule('gzip', threshold=100)
+        packet = Packet('foo', 'x' * 1000)
+        buff = record.encode(packet, rule)
+        self.assertEqual(record.decode_header(buff).encoding, 1)
+        self.assertLess(len(buff), 1000)
+        self.assertEqual(record.decode(buff).payload, packet.payload)
+
+        buff = record.encode(Packet('foo', 'x'), rule)
+        self.assertEqual(record.decode_header(buff).encoding,
+                         record.ENCODING_JSON)
+
+    def test_delta(self):
+        base = Packet('foo', {'a': 'x' * 100, 'b': [1, 2]})
+        packet = Packet('foo', {'a': 'x' * 100, 'b': [1, 2, 3], 'c': None})
+        rule = compression.Rule('lzma', threshold=0)
+
+        for compress in [None, rule]:
+            buff = record.encode(packet, compress, base=base)
+            self.assertTrue(record.is_delta(buff))
+            self.assertEqual(record.decode(buff, base=base).payload,
+                             packet.payload)
+
+        with self.assertRaises(record.RecordError):
+            record.decode(buff)
+
+        # Not worth it
+        buff = record.encode(Packet('foo', 2), base=Packet('foo', 1))
+        self.assertFalse(record.is_delta(buff))
+
+    def test_invalid(self):
+        with self.assertRaises(record.RecordError):
+            record.decode_header(pickle.dumps(Packet('foo', 1)))
+
+        with self.assertRaises(record.RecordError):
+            record.decode_header(record.encode(Packet('foo', 1))[:8])
+
+
+class DeltaTest(unittest.TestCase):
+    def assertRoundtrip(self, old, new):
+        patch = delta.diff(old, new)
+        self.assertEqual(delta.apply(json.loads(json.dumps(old)),
+                                     json.loads(json.dumps(patch))), new)
+        return patch
+
+    def test_diff(self):
+        self.assertEqual(self.assertRoundtrip({'a': 1}, {'a': 1}), {})
+        self.assertEqual(self.assertRoundtrip(1, True), {'=': True})
+        self.assertEqual(self.assertRoundtrip([1], [1, 2]), {'+': [2]})
+        self.assertEqual(
+            self.assertRoundtrip({'a': {'b': 1, 'c': 2}, 'd': 3},
+                                 {'a': {'b': 2, 'c': 2}, 'e': 3}),
+            {'-': ['d'], '~': {'a': {'~': {'b': {'=': 2}}},
+                               'e': {'=': 3}}})
+        self.assertEqual(
+            self.assertRoundtrip([{'a': 1}, 2], [{'a': 2}, 2]),
+            {'#': {'0': {'~': {'a': {'=': 2}}}}})
+
+        for (old, new) in [([1, 2], [2]), ({'a': 1}, [1]), (None, {}),
+                           ('a', 'b'), ({'a': [1]}, {'a': None})]:
+            self.assertRoundtrip(old, new)
+
+
+class RecordingClient:
+    def __init__(self):
+        self.batches = []
+
+    def save_many(self, packets):
+        self.batches.append([(x.key, x.payload) for x in packets])
+        return packets
+
+
+class SourceTest(unittest.TestCase):
+    def test_send_is_batched_and_coalesced(self):
+        client = RecordingClient()
+        source = Source(client=client, flush_interval=60)
+
+        for x in range(3):
+            source.send(Packet('foo', x))
+        source.send(Packet('bar', 1))
+
+        self.assertTrue(source.flush(timeout=5))
+        self.assertEqual(client.batches, [[('foo', 2), ('bar', 1)]])
+        self.assertEqual(source.stats['coalesced'], 2)
+        self.assertEqual(source.stats['sent'], 2)
+        source.close()
+
+    def test_batch_size(self):
+        client = RecordingClient()
+        source = Source(client=client, batch_size=2, coalesce=False,
+                        flush_interval=60)
+
+        for x in range(5):
+            source.send(Packet('foo', x))
+
+        source.close(timeout=5)
+        self.assertEqual(
+            [len(x) for x in client.batches], [2, 2, 1])
+
+    def test_drop_when_full(self):
+        source = Source(client=RecordingClient(), max_queue=2,
+                        overflow='drop', coalesce=False, flush_interval=60)
+
+        # Hold the worker so nothing leaves the queue
+        with source._cond:
+            for x in range(4):
+                source.send(Packet('foo', x))
+
+            self.assertEqual(source.stats['dropped'], 2)
+
+        source.close(timeout=5)
+
+    def test_block_then_closed(self):
+        source = Source(client=RecordingClient(), max_queue=1,
+                        coalesce=False, flush_interval=60)
+
+        # Hold the worker so nothing leaves the queue
+        source._start = lambda: None
+        source.send(Packet('foo', 1))
+        sender = threading.Thread(target=source.send,
+                                  args=(Packet('foo', 2),))
+        sender.start()
+        with source._cond:
+            source._cond.wait_for(lambda: source._cond._waiters, timeout=5)
+        source.close()
+        sender.join(5)
+
+        self.assertEqual(source.stats['dropped'], 1)
+
+    def test_failures(self):
+        class FailingClient(RecordingClient):
+            def save_many(self, packets):
+                super().save_many(packets)
+                if len(self.batches) < 3:
+                    raise requests.ConnectTimeout()
+
+                return [ValueError()] + packets[1:]
+
+        client = FailingClient()
+        source = Source(client=client, coalesce=False, retries=1, backoff=0)
+        source.send(Packet('foo', 1))
+        source.flush(timeout=5)
+        self.assertEqual(source.stats['attempt_errors'], 2)
+        self.assertEqual(source.stats['dropped'], 1)
+
+        source.send(Packet('foo', 2))
+        source.send(Packet('foo', 3))
+        source.close(timeout=5)
+        self.assertEqual(source.stats['failed'], 1)
+        self.assertEqual(source.stats['sent'], 1)
+        self.assertEqual(source.stats['attempt_errors'], 2)
+
+    def test_no_backoff_after_last_retry(self):
+        class FailingClient:
+            def save_many(self, packets):
+                raise requests.ConnectTimeout()
+
+        sleeps = []
+        source = Source(client=FailingClient(), retries=2, backoff=0.01)
+        with unittest.mock.patch('time.sleep', sleeps.append):
+            source._flush([Packet('foo', 1)])
+
+        self.assertEqual(sleeps, [0.01, 0.02])
+        self.assertEqual(source.stats['dropped'], 1)
+
+    def test_no_retry_sent(self):
+        class FailingClient(RecordingClient):
+            def save_many(self, packets):
+                super().save_many(packets)
+                raise requests.ReadTimeout()
+
+        client = FailingClient()
+        source = Source(client=client, retries=2, backoff=0)
+        source._flush([Packet('foo', 1)])
+
+        # May have been saved, not saved twice
+        self.assertEqual(len(client.batches), 1)
+        self.assertEqual(source.stats['attempt_errors'], 1)
+        self.assertEqual(source.stats['dropped'], 1)
+
+        self.assertEqual(Source().client.timeout, 10)
+
+    def test_storage_roundtrip(self):
+        storage = StorageAPI(datadir=tempfile.mkdtemp())
+        client = TestClient(StorageServer(storage=storage))
+        source = Source(client=client, flush_interval=0.01)
+
+        source.send(Packet('foo', 1))
+        source.send(Packet('bar', 2))
+        source.close(timeout=5)
+
+        self.assertEqual(storage.get('foo').payload, 1)
+        self.assertEqual(storage.get('bar').payload, 2)
+
+
+@unittest.skipIf(sa is None, "SQLAlchemy isn't installed")
+class SAStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.dburi = 'sqlite:///' + tempfile.mkdtemp() + '/db.sqlite'
+        self.stamps = [datetime.datetime(2020, 1, 1, 0, 0, x)
+                       for x in range(10)]
+
+    def packets(self, key='foo'):
+        return [Packet(key, x, timestamp=stamp)
+                for (x, stamp) in enumerate(self.stamps)]
+
+    def stored(self, storage):
+        # Read without flushing the pending packets like get() does
+        with storage.reader.connect() as conn:
+            return conn.execute(sa.sqlalchemy.select(
+                [sa.sqlalchemy.func.count()]).select_from(
+                    sa.NativePacket.__table__)).scalar()
+
+    def test_batch_size(self):
+        storage = sa.Storage(self.dburi, batch_size=4)
+        packets = self.packets()
+        for packet in packets[:3]:
+            storage.save(packet)
+        self.assertEqual(self.stored(storage), 0)
+
+        storage.save(packets[3])
+        self.assertEqual(self.stored(storage), 4)
+
+        storage.save_many(packets[4:])
+        self.assertEqual(self.stored(storage), 10)
+        storage.close()
+
+    def test_batch_interval(self):
+        storage = sa.Storage(self.dburi, batch_size=100,
+                             batch_interval=0.05)
+        storage.save(self.packets()[0])
+        self.assertEqual(self.stored(storage), 0)
+
+        # Flushed in the background, without further saves
+        for _ in range(100):
+            if self.stored(storage):
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.stored(storage), 1)
+        storage.close()
+
+    def test_batch_failures(self):
+        storage = sa.Storage(self.dburi, batch_size=10)
+        stamp = self.stamps[0]
+        storage.save(Packet('dup', 1, timestamp=stamp))
+        storage.save(Packet('dup', 2, timestamp=stamp))
+        storage.save(Packet('other', 3, timestamp=stamp))
+
+        # The clashing packet is dropped on its own
+        with self.assertLogs(sa._logger, 'ERROR'):
+            self.assertEqual(storage.get('other').payload, 3)
+        self.assertEqual(storage.get('dup').payload, 1)
+
+        # Unless it is the caller's
+        storage.batch_size = 1
+        with self.assertRaises(sa.sqlalchemy.exc.IntegrityError):
+            storage.save(Packet('dup', 4, timestamp=stamp))
+
+        storage.batch_size = 2
+        with self.assertRaises(sa.sqlalchemy.exc.IntegrityError):
+            storage.save_many([Packet('new', 5, timestamp=stamp),
+                               Packet('dup', 6, timestamp=stamp)])
+        self.assertEqual(storage.get('new').payload, 5)
+        self.assertEqual(self.stored(storage), 3)
+        storage.close()
+
+    def test_pooled_writes(self):
+        storage = sa.Storage(self.dburi)
+        connects = []
+        sa.event.listen(storage.db.get_bind(), 'connect',
+                        lambda *args: connects.append(args))
+        for packet in self.packets():
+            storage.save(packet)
+
+        self.assertEqual(connects, [])
+        with storage.reader.connect() as conn:
+            self.assertEqual(
+                conn.execute("PRAGMA journal_mode").scalar(), 'wal')
+        storage.close()
+
+    def test_reads_and_close_flush(self):
+        storage = sa.Storage(self.dburi, batch_size=100)
+        storage.save_many(self.packets()[:5])
+        self.assertEqual(storage.get('foo').payload, 4)
+
+        storage.save_many(self.packets()[5:])
+        storage.close()
+
+        storage = sa.Storage(self.dburi)
+        self.assertEqual(storage.get('foo').payload, 9)
+        with self.assertRaises(KeyError):
+            storage.get('bar')
+        storage.close()
+
+    def test_log_window(self):
+        storage = sa.Storage(self.dburi, batch_size=100)
+        storage.save_many(self.packets() + self.packets('bar'))
+
+        self.assertEqual(
+            [x.payload for x in storage.log('foo', page_size=3)],
+            list(range(9, -1, -1)))
+        self.assertEqual(
+            [x.payload for x in storage.log('foo', page_size=2,
+                                            since=self.stamps[3],
+                                            until=self.stamps[8])],
+            [7, 6, 5, 4, 3])
+
+        (packets, cursor) = storage.page('foo', limit=4,
+                                         before=self.stamps[6])
+        self.assertEqual([x.payload for x in packets], [5, 4, 3, 2])
+        (packets, cursor) = storage.page('foo', limit=4, before=cursor)
+        self.assertEqual([x.payload for x in packets], [1, 0])
+        self.assertIsNone(cursor)
+
+        # An empty time range isn't a missing key
+        self.assertEqual(
+            list(storage.log('foo', since=self.stamps[9],
+                             until=self.stamps[9])), [])
+        with self.assertRaises(KeyError):
+            list(storage.log('missing'))
+        storage.close()
+
+
 if __name__ == '__main__':
     unittest.main()